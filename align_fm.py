@@ -0,0 +1,21 @@
+import argparse
+from clean_fm import app_dir, store_path
+from utils_store import open_store
+from utils_align import *
+
+
+align_path = app_dir + "/align_fm.sqlite"
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        description="Pair Chinese and English responses in the cleaned China FM statements")
+    argparser.add_argument("--rebuild", action="store_true",
+                           help="align every partition again instead of only the ones with new rows")
+    args = argparser.parse_args()
+
+    conn = open_align(align_path)
+    store_conn = open_store(store_path)
+    print("partitions aligned:", update_alignments(conn, store_conn, args.rebuild))
+    store_conn.close()
+    conn.close()
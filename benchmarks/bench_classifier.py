@@ -0,0 +1,97 @@
+# Micro-benchmark: utils_clean.classify_entry, the line classification
+# clean_entry runs, against the old per-line chain (get_clean_remarks +
+# check_qa + check_answer) on a scraped archive. Entries with a 'bold' list
+# (what the spider sends now) go through classify_text, older html ones
+# through classify_line. Without a file, a synthetic corpus in the spider's
+# current shape is used.
+#
+#   python benchmarks/bench_classifier.py rawdata/chinafm_press_20200704.json
+#   python benchmarks/bench_classifier.py --paragraphs 100000
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from synthetic import generate_entries
+from utils_clean import *
+
+
+def old_classify(entry, spox, ch=True):
+    # plain text from the spider needs no tag stripping in either path, so
+    # only the flag checks are compared there
+    out = []
+    if 'bold' in entry:
+        for line, bold in zip(entry['text'], entry['bold']):
+            text = ' '.join(line.replace('\u3000', '').split())
+            out.append((text, bool(bold), check_answer(text, spox, ch), check_qa(text, ch)))
+        return(out)
+    for line in entry['text']:
+        text, question_flag = get_clean_remarks(line)
+        out.append((text, question_flag, check_answer(text, spox, ch), check_qa(text, ch)))
+    return(out)
+
+
+def new_classify(entry, spox, ch=True):
+    return(list(classify_entry(entry, spox, ch)))
+
+
+def load_entries(entries):
+    loaded = []
+    for entry in entries:
+        is_ch = entry['lang'] == "Chinese"
+        orig_spox, _ = get_clean_spox(entry, is_ch)
+        loaded.append((entry, orig_spox, is_ch))
+    return(loaded)
+
+
+def time_classifier(func, entries, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for entry, spox, is_ch in entries:
+            func(entry, spox, is_ch)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return(best)
+
+
+def compare(entries):
+    # the new classifier also collapses whitespace, strips the ends and
+    # decodes entities, so compare texts after normalizing the old output
+    diff_text = diff_flags = 0
+    for entry, spox, is_ch in entries:
+        for old, new in zip(old_classify(entry, spox, is_ch), new_classify(entry, spox, is_ch)):
+            if old[0].strip() == '':
+                continue
+            if ' '.join(old[0].replace('&amp;', '&').split()) != new[0]:
+                diff_text += 1
+            if old[1:] != new[1:]:
+                diff_flags += 1
+    return(diff_text, diff_flags)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Benchmark the line classifier")
+    argparser.add_argument("fname", nargs="?",
+                           help="scraped file (.json, .jsonl, .jsonl.gz or .jsonl.zst); synthetic if omitted")
+    argparser.add_argument("--paragraphs", type=int, default=100000, help="size of the synthetic corpus")
+    argparser.add_argument("--repeat", type=int, default=5)
+    args = argparser.parse_args()
+
+    if args.fname:
+        entries = load_entries(read_raw_entries(args.fname))
+    else:
+        entries = load_entries(generate_entries(args.paragraphs, plain=True))
+    n_lines = sum(len(entry['text']) for entry, _, _ in entries)
+    n_bold = sum('bold' in entry for entry, _, _ in entries)
+    print("lines: %d (%d of %d entries with bold flags)" % (n_lines, n_bold, len(entries)))
+
+    old_time = time_classifier(old_classify, entries, args.repeat)
+    new_time = time_classifier(new_classify, entries, args.repeat)
+    print("old chain:       %12.0f lines/s" % (n_lines / old_time))
+    print("classify_entry:  %12.0f lines/s" % (n_lines / new_time))
+    print("speedup:         %12.2fx" % (old_time / new_time))
+
+    diff_text, diff_flags = compare(entries)
+    print("lines with different text: %d, different flags: %d" % (diff_text, diff_flags))
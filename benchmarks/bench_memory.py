@@ -0,0 +1,104 @@
+# Memory benchmark: clean_fm.clean_batch with BlockTable against the path it
+# replaced, as clean_fm.py had it before any of the batch changes: a dict of
+# lists per cleaned entry, one DataFrame of those dicts per language, then
+# set_index(...).apply(pd.Series.explode).reset_index() to get one row per
+# content block, written to the store from the frame. Each variant runs in
+# its own process on the same synthetic corpus; both import pandas before
+# the baseline RSS is taken, so the reported growth is the cleaning itself.
+#
+#   python benchmarks/bench_memory.py --paragraphs 1000000
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(bench_dir))
+import clean_fm
+from synthetic import write_entries
+from utils_clean import *
+from utils_store import open_store, upsert_rows
+
+index_cols = entry_cols
+
+
+def old_entry(out):
+    # the dict clean_entry used to return
+    return({col: list(getattr(out, col)) if col in ['content', 'content_order', 'content_type']
+            else getattr(out, col) for col in row_cols})
+
+
+def old_frame_rows(df):
+    df = df[row_cols].astype(object)
+    return(df.where(df.notna(), None).itertuples(index=False, name=None))
+
+
+def run_old(fname, conn):
+    import pandas as pd
+    clean_output_en, clean_output_ch = [], []
+    for out in iter_clean_entries(read_raw_entries(fname)):
+        out = old_entry(out)
+        (clean_output_ch if out['lang'] == "Chinese" else clean_output_en).append(out)
+    rows = 0
+    for output in [clean_output_en, clean_output_ch]:
+        full_clean = pd.DataFrame(output)
+        del output[:]
+        expanded = full_clean.set_index(index_cols).apply(pd.Series.explode).reset_index()
+        del full_clean
+        rows += upsert_rows(conn, old_frame_rows(expanded))
+    return(rows)
+
+
+def run_new(fname, conn):
+    new_en, new_ch = clean_fm.clean_batch(fname)
+    return(upsert_rows(conn, new_en.rows()) + upsert_rows(conn, new_ch.rows()))
+
+
+def rss_mb():
+    # current resident set size
+    with open("/proc/self/statm") as f:
+        return(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2)
+
+
+def measure(variant, fname):
+    # run one variant in this process: (rows written, seconds, peak RSS and
+    # its growth over the RSS after the imports, in MB)
+    import pandas
+    base = rss_mb()
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = open_store(os.path.join(tmp, "clean_fm.sqlite"))
+        start = time.perf_counter()
+        rows = (run_old if variant == "old" else run_new)(fname, conn)
+        elapsed = time.perf_counter() - start
+        conn.close()
+    # ru_maxrss is in KB on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return(rows, elapsed, peak, peak - base)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Compare peak memory of the batch cleaning paths")
+    argparser.add_argument("--paragraphs", type=int, default=1000000)
+    argparser.add_argument("--fname", default=None, help="use this scrape instead of a synthetic one")
+    argparser.add_argument("--variant", choices=["old", "new"], default=None,
+                           help=argparse.SUPPRESS)
+    args = argparser.parse_args()
+
+    if args.variant:
+        print("%d %f %f %f" % measure(args.variant, args.fname))
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = args.fname
+        if fname is None:
+            fname = os.path.join(tmp, "synthetic.jsonl")
+            write_entries(fname, args.paragraphs)
+        for variant, label in [("old", "dicts + explode"), ("new", "BlockTable")]:
+            out = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), "--variant", variant, "--fname", fname])
+            rows, elapsed, peak, growth = out.split()
+            print("%-16s %9d rows %8.1fs   peak RSS %8.1f MB (+%.1f MB after imports)"
+                  % (label, int(rows), float(elapsed), float(peak), float(growth)))
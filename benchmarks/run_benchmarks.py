@@ -0,0 +1,183 @@
+# Benchmark suite for the scraper and cleaner. Times each utils_clean
+# function, the full clean_fm.py pipeline on a synthetic corpus, and the
+# spider's parse functions on the saved HTML fixtures; results are appended to
+# a JSON history file and compared against the previous comparable run.
+#
+#   python benchmarks/run_benchmarks.py --paragraphs 100000 --check
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, repo_dir)
+sys.path.insert(0, os.path.join(repo_dir, "chinafm_scraper"))
+
+import clean_fm
+from synthetic import generate_entries, write_entries
+from utils_clean import *
+from utils_store import open_store
+
+fixtures_dir = os.path.join(bench_dir, "fixtures")
+history_file = os.path.join(bench_dir, "history.json")
+
+
+def best_of(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return(best)
+
+
+def result(seconds, items):
+    return({'seconds': seconds, 'items': items, 'items_per_sec': items / seconds if seconds else None})
+
+
+def bench_utils(entries, repeat):
+    results = {}
+    lines = []
+    for entry in entries:
+        is_ch = entry['lang'] == "Chinese"
+        orig_spox, _ = get_clean_spox(entry, is_ch)
+        lines.extend((line, orig_spox, is_ch) for line in entry['text'])
+    cleaned = [(get_clean_remarks(line)[0], spox, is_ch) for line, spox, is_ch in lines]
+
+    def per_line(func, args):
+        return(lambda: [func(*a) for a in args])
+
+    results['get_clean_remarks'] = result(
+        best_of(per_line(get_clean_remarks, [(l,) for l, _, _ in lines]), repeat), len(lines))
+    results['check_qa'] = result(
+        best_of(per_line(check_qa, [(t, ch) for t, _, ch in cleaned]), repeat), len(lines))
+    results['check_answer'] = result(best_of(per_line(check_answer, cleaned), repeat), len(lines))
+    results['classify_line'] = result(best_of(per_line(classify_line, lines), repeat), len(lines))
+
+    entry_args = [(e, e['lang'] == "Chinese") for e in entries]
+    for func in [get_clean_type, get_clean_date, get_clean_spox]:
+        results[func.__name__] = result(best_of(per_line(func, entry_args), repeat), len(entries))
+    results['clean_entry'] = result(
+        best_of(per_line(clean_entry, [(e,) for e in entries]), repeat), len(entries))
+    return(results)
+
+
+def bench_pipeline(fname, n_entries, repeat):
+    results = {}
+    results['clean_fm.clean_batch'] = result(
+        best_of(lambda: clean_fm.clean_batch(fname), repeat), n_entries)
+
+    def stream():
+        with tempfile.TemporaryDirectory() as tmp:
+            conn = open_store(os.path.join(tmp, "clean_fm.sqlite"))
+            clean_fm.clean_stream(fname, conn)
+            conn.close()
+    results['clean_fm.clean_stream'] = result(best_of(stream, repeat), n_entries)
+    return(results)
+
+
+def bench_spider(repeat, number=200):
+    # offline: saved listing and article pages fed to the spider as fake responses
+    try:
+        from scrapy import Request
+        from scrapy.http import HtmlResponse
+        from scrapy.utils.test import get_crawler
+        from chinafm_scraper.spiders.chinafm import ChinaFmSpider, en_root, ch_root
+    except ImportError:
+        print("scrapy not installed, skipping spider benchmarks")
+        return({})
+
+    crawler = get_crawler(ChinaFmSpider, {'SEEN_INDEX_PATH': ':memory:'})
+    spider = ChinaFmSpider.from_crawler(crawler)
+
+    def response(fname, url, meta):
+        with open(os.path.join(fixtures_dir, fname), 'rb') as f:
+            body = f.read()
+        return(HtmlResponse(url=url, body=body, encoding='utf-8', request=Request(url, meta=meta)))
+
+    results = {}
+    for lang, root in [("en", en_root), ("ch", ch_root)]:
+        listing = response("listing_" + lang + ".html", root + "/default.shtml", {'page': 0})
+        article = response("article_" + lang + ".html", root + "/t1797000.shtml",
+                           {'is_ch_url': lang == "ch"})
+        results['spider.parse.' + lang] = result(
+            best_of(lambda: [list(spider.parse(listing)) for _ in range(number)], repeat), number)
+        results['spider.parse_mf_press.' + lang] = result(
+            best_of(lambda: [list(spider.parse_mf_press(article)) for _ in range(number)], repeat), number)
+    spider.closed('finished')
+    return(results)
+
+
+def git_commit():
+    try:
+        return(subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=repo_dir,
+            stderr=subprocess.DEVNULL).decode().strip())
+    except (OSError, subprocess.CalledProcessError):
+        return(None)
+
+
+def compare(results, history, paragraphs, threshold):
+    # regressions against the last run at the same scale
+    previous = [run for run in history if run['paragraphs'] == paragraphs]
+    if not previous:
+        return([])
+    last = previous[-1]['results']
+    regressions = []
+    for name, res in results.items():
+        if name in last and res['seconds'] > last[name]['seconds'] * (1 + threshold):
+            regressions.append((name, last[name]['seconds'], res['seconds']))
+    return(regressions)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Run the scraper and cleaner benchmarks")
+    argparser.add_argument("--paragraphs", type=int, default=10000,
+                           help="size of the synthetic corpus (1k to 1M paragraphs)")
+    argparser.add_argument("--repeat", type=int, default=3)
+    argparser.add_argument("--history", default=history_file)
+    argparser.add_argument("--threshold", type=float, default=0.2,
+                           help="slowdown against the last run that counts as a regression")
+    argparser.add_argument("--check", action="store_true",
+                           help="exit with status 1 if anything regressed")
+    args = argparser.parse_args()
+
+    entries = list(generate_entries(args.paragraphs))
+    results = {}
+    results.update(bench_utils(entries, args.repeat))
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, "synthetic.jsonl")
+        write_entries(fname, args.paragraphs)
+        results.update(bench_pipeline(fname, len(entries), args.repeat))
+    results.update(bench_spider(args.repeat))
+
+    for name, res in results.items():
+        print("%-30s %10.4fs %12.0f items/s" % (name, res['seconds'], res['items_per_sec'] or 0))
+
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history, 'rt', encoding='utf-8') as f:
+            history = json.load(f)
+    regressions = compare(results, history, args.paragraphs, args.threshold)
+    for name, before, after in regressions:
+        print("REGRESSION %s: %.4fs -> %.4fs" % (name, before, after))
+
+    history.append({
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'paragraphs': args.paragraphs,
+        'results': results,
+    })
+    with open(args.history, 'w', encoding='utf-8') as f:
+        json.dump(history, f, indent=1)
+
+    if args.check and regressions:
+        sys.exit(1)
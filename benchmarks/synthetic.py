@@ -0,0 +1,127 @@
+# Synthetic press-conference entries in the ChinaFmScraperItem shape, for
+# benchmarking the cleaner at any scale without a crawl.
+#
+#   python benchmarks/synthetic.py synthetic_100k.jsonl --paragraphs 100000
+#
+# --plain writes what the spider sends now (plain text with a bold flag per
+# line) instead of the raw <p> html of older scrapes.
+import argparse
+import html
+import json
+import os
+import random
+import re
+import sys
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils_spox import load_roster
+
+
+en_words = ("china united states cooperation development trade security sovereignty "
+            "relations policy side firmly opposes urge stop interference internal affairs "
+            "peace stability region international community dialogue consultation "
+            "mutual respect win-win pandemic vaccine economic global partners "
+            "position consistent clear relevant parties conducive measures visit minister").split()
+ch_words = ("中方 美方 合作 发展 贸易 安全 主权 关系 政策 坚决 反对 敦促 停止 干涉 内政 "
+            "和平 稳定 地区 国际社会 对话 协商 相互尊重 共赢 疫情 疫苗 经济 全球 伙伴 "
+            "立场 一贯 明确 有关 各方 有利于 措施 访问 外长").split()
+
+
+def sentence(rng, words, ch):
+    picked = [rng.choice(words) for _ in range(rng.randint(6, 25))]
+    if ch:
+        return("".join(picked) + "。")
+    return(" ".join(picked).capitalize() + ".")
+
+
+def paragraphs(rng, n, spox_name, ch):
+    # an opening statement, then question/answer pairs, with the markup
+    # quirks the spider leaves in: bold questions, &nbsp; and empty lines
+    words = ch_words if ch else en_words
+    colon = "：" if ch else ": "
+    out = ["<p>" + ("　　" if ch else "") + spox_name + colon + sentence(rng, words, ch) + "</p>"]
+    while len(out) < n:
+        tag = rng.choice(["b", "strong"])
+        question = ("问" if ch else "Q") + colon + sentence(rng, words, ch)
+        out.append("<p><" + tag + ">" + question + "</" + tag + "></p>")
+        answer = ("答" if ch else "A") + colon + sentence(rng, words, ch)
+        for _ in range(rng.randint(0, 2)):
+            if len(out) >= n - 1:
+                break
+            out.append("<p>" + answer + "</p>")
+            answer = sentence(rng, words, ch) + ("&nbsp;" if rng.random() < 0.1 else "")
+        out.append("<p>" + answer + "</p>")
+        if rng.random() < 0.05:
+            out.append("<p>&nbsp;</p>")
+    return(out[:n])
+
+
+def plain_lines(html_lines):
+    # the spider's text and bold lists for the same paragraphs: tags
+    # stripped, entities decoded, whitespace collapsed and empty lines dropped
+    text = []
+    bold = []
+    for p in html_lines:
+        clean = ' '.join(html.unescape(re.sub('<[^>]*>', '', p)).replace('\u3000', '').split())
+        if clean != '':
+            text.append(clean)
+            bold.append(int('</b>' in p or '</strong>' in p))
+    return(text, bold)
+
+
+def generate_entries(n_paragraphs, seed=0, per_entry=(10, 40), plain=False):
+    # yields scraped entries, alternating English and Chinese, until about
+    # n_paragraphs paragraphs have been produced
+    rng = random.Random(seed)
+    roster = load_roster()
+    day = date(2020, 7, 28)
+    produced = 0
+    i = 0
+    while produced < n_paragraphs:
+        # one press conference a day, in English then in Chinese
+        ch = i % 2 == 1
+        if not ch:
+            day -= timedelta(days=1)
+            active = [r for r in roster
+                      if r['start'] <= day.isoformat() and (r['end'] == '' or day.isoformat() <= r['end'])]
+            spox = rng.choice(active or roster)
+        n = min(rng.randint(*per_entry), n_paragraphs - produced)
+
+        if ch:
+            title = "%d年%d月%d日外交部发言人%s主持例行记者会" % (day.year, day.month, day.day, spox['name_ch'])
+            entry_date = [day.isoformat()]
+        else:
+            title = "Foreign Ministry Spokesperson %s's Regular Press Conference on %s" % (
+                spox['name_en'], day.strftime("%B ") + str(day.day) + day.strftime(", %Y"))
+            entry_date = [None]
+
+        entry = {
+            'title': [title],
+            'date': entry_date,
+            'text': paragraphs(rng, max(n, 1), spox['name_ch'] if ch else spox['name_en'], ch),
+            'url': "https://www.fmprc.gov.cn/synthetic/%s/t%d.shtml" % ("ch" if ch else "en", i),
+            'lang': "Chinese" if ch else "English",
+            'scrape_date': "20200728",
+        }
+        if plain:
+            entry['text'], entry['bold'] = plain_lines(entry['text'])
+        yield(entry)
+        produced += max(n, 1)
+        i += 1
+
+
+def write_entries(fname, n_paragraphs, seed=0, plain=False):
+    with open(fname, 'w', encoding='utf-8') as f:
+        for entry in generate_entries(n_paragraphs, seed, plain=plain):
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Write a synthetic scraped file (JSON Lines)")
+    argparser.add_argument("fname")
+    argparser.add_argument("--paragraphs", type=int, default=1000)
+    argparser.add_argument("--seed", type=int, default=0)
+    argparser.add_argument("--plain", action="store_true", help="plain text with bold flags, as the spider sends now")
+    args = argparser.parse_args()
+    write_entries(args.fname, args.paragraphs, args.seed, args.plain)
@@ -0,0 +1,59 @@
+import argparse
+import time
+from clean_fm import app_dir
+from cube_fm import cube_path
+from utils_burst import BurstState, open_bursts, write_bursts
+from utils_cube import WordCube
+
+
+# fed from the word cube, so run after `python cube_fm.py`
+state_path = app_dir + "/burst_fm"
+bursts_path = app_dir + "/burst_fm.sqlite"
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        description="Find words that suddenly come up far more than usual, per day and spokesperson")
+    argparser.add_argument("--rebuild", action="store_true",
+                           help="feed the whole history again instead of only the days after the last run")
+    argparser.add_argument("--half-life", type=float, default=30.0,
+                           help="statement days after which a day counts half in the averages")
+    argparser.add_argument("--min-count", type=int, default=3,
+                           help="fewest mentions on the day for a word to burst")
+    argparser.add_argument("--min-score", type=float, default=3.0,
+                           help="standard deviations above the average share for a word to burst")
+    argparser.add_argument("--limit", type=int, default=20, help="bursting words kept per day and spokesperson")
+    argparser.add_argument("--show", metavar="DATE", nargs="?", const="latest", default=None,
+                           help="print the bursting words of a day (the latest by default) instead of updating")
+    argparser.add_argument("--lang", default=None, choices=["English", "Chinese"])
+    args = argparser.parse_args()
+
+    conn = open_bursts(bursts_path)
+    if args.show:
+        day = args.show
+        if day == "latest":
+            day = conn.execute("SELECT max(date) FROM bursts").fetchone()[0]
+        sql = "SELECT lang, spox, term, count, expected, score FROM bursts WHERE date = ?"
+        params = [day]
+        if args.lang:
+            sql += " AND lang = ?"
+            params.append(args.lang)
+        print(day)
+        for lang, spox, term, count, expected, score in conn.execute(sql + " ORDER BY lang, spox, rank", params):
+            print("%-8s %-28s %-20s %5d %8.1f %6.1f" % (lang, spox, term, count, expected, score))
+    else:
+        start = time.perf_counter()
+        cube = WordCube(cube_path)
+        if args.rebuild:
+            state = BurstState(args.half_life)
+        else:
+            state = BurstState.load(state_path, args.half_life, cube)
+        since = None if args.rebuild else state.fed_up_to()
+        bursts = state.update(cube, args.min_count, args.min_score, limit=args.limit)
+        write_bursts(conn, bursts, since)
+        state.save(state_path)
+        fed = state.fed_up_to()
+        if fed:
+            print("fed up to", max(fed.values()))
+        print("days with bursts: %d, %.3fs" % (len(set(b[0] for b in bursts)), time.perf_counter() - start))
+    conn.close()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import sqlite3
+import struct
+import zlib
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks on Windows: one writer per archive there
+    fcntl = None
+
+
+# append-only archive of article responses: every record is compressed on its
+# own and appended to responses.dat behind a 4-byte length, and an SQLite index
+# maps each url to the offset of its latest record for random access. backfill
+# shards share one archive, so appending and indexing happen under a lock on
+# the data file and the offset is taken at its end at that moment
+class ResponseArchive(object):
+    def __init__(self, dirpath):
+        os.makedirs(dirpath, exist_ok=True)
+        self.data_path = os.path.join(dirpath, "responses.dat")
+        self.data = open(self.data_path, 'ab')
+        self.reader = open(self.data_path, 'rb')
+        self.conn = sqlite3.connect(os.path.join(dirpath, "index.sqlite"), timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "url TEXT PRIMARY KEY, offset INTEGER, length INTEGER, "
+            "fetched_at TEXT, is_ch_url INTEGER)")
+        self.conn.commit()
+
+    def add(self, response, is_ch_url):
+        header = {
+            'url': response.url,
+            'status': response.status,
+            'content_type': response.headers.get('Content-Type', b'').decode('latin-1'),
+            'is_ch_url': is_ch_url,
+            'fetched_at': datetime.now().isoformat(timespec='seconds'),
+        }
+        blob = zlib.compress(json.dumps(header).encode('utf-8') + b"\n" + response.body)
+
+        if fcntl is not None:
+            fcntl.flock(self.data, fcntl.LOCK_EX)
+        try:
+            offset = self.data.seek(0, os.SEEK_END) + 4
+            self.data.write(struct.pack('>I', len(blob)) + blob)
+            self.data.flush()
+            self._index(header, offset, len(blob))
+            self.conn.commit()
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self.data, fcntl.LOCK_UN)
+
+    def _index(self, header, offset, length):
+        self.conn.execute(
+            "INSERT INTO responses (url, offset, length, fetched_at, is_ch_url) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT(url) DO UPDATE SET "
+            "offset = excluded.offset, length = excluded.length, "
+            "fetched_at = excluded.fetched_at, is_ch_url = excluded.is_ch_url",
+            (header['url'], offset, length, header['fetched_at'], int(header['is_ch_url'])))
+
+    def read_at(self, offset, length):
+        # returns (header dict, body bytes)
+        self.reader.seek(offset)
+        raw = zlib.decompress(self.reader.read(length))
+        header, body = raw.split(b"\n", 1)
+        return(json.loads(header), body)
+
+    def get(self, url):
+        row = self.conn.execute(
+            "SELECT offset, length FROM responses WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return(None)
+        return(self.read_at(*row))
+
+    def urls(self):
+        # (url, is_ch_url) of every archived article, in the order they were archived
+        return(self.conn.execute(
+            "SELECT url, is_ch_url FROM responses ORDER BY offset").fetchall())
+
+    def rebuild_index(self):
+        # recover the index by scanning the data file, e.g. after a crash
+        # between appending a record and indexing it; a torn last record is skipped
+        self.conn.execute("DELETE FROM responses")
+        with open(self.data_path, 'rb') as f:
+            while True:
+                prefix = f.read(4)
+                if len(prefix) < 4:
+                    break
+                length = struct.unpack('>I', prefix)[0]
+                offset = f.tell()
+                blob = f.read(length)
+                if len(blob) < length:
+                    break
+                header = json.loads(zlib.decompress(blob).split(b"\n", 1)[0])
+                self._index(header, offset, length)
+        self.conn.commit()
+
+    def close(self):
+        self.data.close()
+        self.reader.close()
+        self.conn.close()
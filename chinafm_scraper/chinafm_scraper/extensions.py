@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from urllib.parse import urlparse
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+latency_buckets = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf')]
+
+
+def write_atomic(fname, text):
+    # a scraper reading the file never sees it half written
+    with open(fname + ".tmp", 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(fname + ".tmp", fname)
+
+
+# per-run crawl metrics: download latency histograms and bytes per domain,
+# listing and article response counts, and items per second. written when the
+# spider closes to METRICS_DIR as a Prometheus textfile (chinafm_scrape.prom,
+# for node_exporter's textfile collector) and a JSON run summary
+class RunMetrics(object):
+    def __init__(self, metrics_dir, stats):
+        self.metrics_dir = metrics_dir
+        self.stats = stats
+        self.latency = defaultdict(lambda: [0] * len(latency_buckets))
+        self.latency_sum = Counter()
+        self.bytes = Counter()
+        self.responses = Counter()
+        self.items = 0
+        self.start = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        metrics_dir = crawler.settings.get('METRICS_DIR')
+        if not metrics_dir:
+            raise NotConfigured
+        ext = cls(metrics_dir, crawler.stats)
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.response_received, signal=signals.response_received)
+        crawler.signals.connect(ext.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        return ext
+
+    def spider_opened(self, spider):
+        self.start = time.time()
+
+    def response_received(self, response, request, spider):
+        domain = urlparse(response.url).netloc
+        # backfill requests all go through parse_claimed, with their kind in meta
+        callback = getattr(request.callback, '__name__', None)
+        is_article = callback == 'parse_mf_press' or request.meta.get('kind') == 'article'
+        self.responses[(domain, 'article' if is_article else 'listing')] += 1
+        self.bytes[domain] += len(response.body)
+        # not set for responses replayed from the archive
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            counts = self.latency[domain]
+            for i, bound in enumerate(latency_buckets):
+                if latency <= bound:
+                    counts[i] += 1
+                    break
+            self.latency_sum[domain] += latency
+
+    def item_scraped(self, item, response, spider):
+        self.items += 1
+
+    def summary(self, spider, reason):
+        elapsed = time.time() - self.start
+        return({
+            'spider': spider.name,
+            'start_time': datetime.fromtimestamp(self.start).isoformat(timespec='seconds'),
+            'elapsed_seconds': elapsed,
+            'finish_reason': reason,
+            'items': self.items,
+            'items_per_second': self.items / elapsed if elapsed else None,
+            'responses': [{'domain': d, 'kind': k, 'count': n} for (d, k), n in sorted(self.responses.items())],
+            'bytes': dict(self.bytes),
+            'latency': {
+                domain: {'buckets': dict(zip(map(str, latency_buckets), counts)),
+                         'count': sum(counts), 'sum': self.latency_sum[domain]}
+                for domain, counts in self.latency.items()},
+            'stats': {k: v for k, v in self.stats.get_stats().items() if isinstance(v, (int, float))},
+        })
+
+    def textfile(self, summary):
+        lines = [
+            "# HELP chinafm_scrape_download_latency_seconds Download latency per domain.",
+            "# TYPE chinafm_scrape_download_latency_seconds histogram",
+        ]
+        for domain, counts in sorted(self.latency.items()):
+            total = 0
+            for bound, n in zip(latency_buckets, counts):
+                total += n
+                le = "+Inf" if bound == float('inf') else repr(bound)
+                lines.append('chinafm_scrape_download_latency_seconds_bucket{domain="%s",le="%s"} %d' % (domain, le, total))
+            lines.append('chinafm_scrape_download_latency_seconds_sum{domain="%s"} %f' % (domain, self.latency_sum[domain]))
+            lines.append('chinafm_scrape_download_latency_seconds_count{domain="%s"} %d' % (domain, total))
+
+        lines += ["# HELP chinafm_scrape_bytes Bytes downloaded per domain.",
+                  "# TYPE chinafm_scrape_bytes gauge"]
+        lines += ['chinafm_scrape_bytes{domain="%s"} %d' % (d, n) for d, n in sorted(self.bytes.items())]
+        lines += ["# HELP chinafm_scrape_responses Responses per domain and page kind (listing or article).",
+                  "# TYPE chinafm_scrape_responses gauge"]
+        lines += ['chinafm_scrape_responses{domain="%s",kind="%s"} %d' % (d, k, n)
+                  for (d, k), n in sorted(self.responses.items())]
+        lines += ["# HELP chinafm_scrape_items Items scraped in the last run.",
+                  "# TYPE chinafm_scrape_items gauge",
+                  "chinafm_scrape_items %d" % summary['items'],
+                  "# HELP chinafm_scrape_items_per_second Items per second over the last run.",
+                  "# TYPE chinafm_scrape_items_per_second gauge",
+                  "chinafm_scrape_items_per_second %f" % (summary['items_per_second'] or 0),
+                  "# HELP chinafm_scrape_duration_seconds Length of the last run.",
+                  "# TYPE chinafm_scrape_duration_seconds gauge",
+                  "chinafm_scrape_duration_seconds %f" % summary['elapsed_seconds'],
+                  "# HELP chinafm_scrape_last_run_timestamp_seconds When the last run finished.",
+                  "# TYPE chinafm_scrape_last_run_timestamp_seconds gauge",
+                  "chinafm_scrape_last_run_timestamp_seconds %d" % time.time()]
+        return("\n".join(lines) + "\n")
+
+    def spider_closed(self, spider, reason):
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        summary = self.summary(spider, reason)
+        write_atomic(os.path.join(self.metrics_dir, "chinafm_scrape.prom"), self.textfile(summary))
+        write_atomic(os.path.join(self.metrics_dir, "chinafm_scrape.json"),
+                     json.dumps(summary, indent=1, default=str))
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import zlib
+from datetime import datetime
+
+
+# persistent crawl frontier for backfills: every listing and article url with
+# its state (pending, claimed, done, failed) and a priority where lower is
+# newer. urls are split into shards by a hash of the url so several spider
+# processes can work through one frontier without overlapping, and a process
+# that dies only leaves its claimed urls behind, which go back to pending
+# when its shard is started again
+class Frontier(object):
+    def __init__(self, path, max_attempts=3):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.max_attempts = max_attempts
+        # other shards write to the same file
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS frontier ("
+            "url TEXT PRIMARY KEY, kind TEXT, is_ch_url INTEGER, page INTEGER, "
+            "priority INTEGER, shard_key INTEGER, state TEXT DEFAULT 'pending', "
+            "attempts INTEGER DEFAULT 0, updated_at TEXT)")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS frontier_state ON frontier (state, priority)")
+        # pages is NULL and error set when the count could not be found
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS page_counts (root TEXT PRIMARY KEY, pages INTEGER, "
+            "found_at TEXT, error TEXT)")
+        if 'error' not in [row[1] for row in self.conn.execute("PRAGMA table_info(page_counts)")]:
+            self.conn.execute("ALTER TABLE page_counts ADD COLUMN error TEXT")
+        self.conn.commit()
+
+    def now(self):
+        return(datetime.now().isoformat(timespec='seconds'))
+
+    def add(self, rows):
+        # rows are (url, kind, is_ch_url, page, priority); urls already in the
+        # frontier keep their state
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO frontier "
+                "(url, kind, is_ch_url, page, priority, shard_key, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(url, kind, int(is_ch_url), page, priority,
+                  zlib.crc32(url.encode('utf-8')), self.now())
+                 for url, kind, is_ch_url, page, priority in rows])
+
+    def page_count(self, root):
+        row = self.conn.execute(
+            "SELECT pages FROM page_counts WHERE root = ?", (root,)).fetchone()
+        return(None if row is None else row[0])
+
+    def set_page_count(self, root, pages):
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO page_counts (root, pages, found_at, error) VALUES (?, ?, ?, NULL) "
+                "ON CONFLICT(root) DO UPDATE SET pages = excluded.pages, "
+                "found_at = excluded.found_at, error = NULL", (root, pages, self.now()))
+
+    def page_count_error(self, root):
+        row = self.conn.execute(
+            "SELECT error FROM page_counts WHERE root = ?", (root,)).fetchone()
+        return(None if row is None else row[0])
+
+    def set_page_count_error(self, root, error):
+        # None clears it; a page count found earlier is kept either way
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO page_counts (root, pages, found_at, error) VALUES (?, NULL, ?, ?) "
+                "ON CONFLICT(root) DO UPDATE SET error = excluded.error",
+                (root, self.now(), error))
+
+    def release(self, shard, shards):
+        # put back what this shard had claimed when it last stopped
+        with self.conn:
+            cur = self.conn.execute(
+                "UPDATE frontier SET state = 'pending', updated_at = ? "
+                "WHERE state = 'claimed' AND shard_key % ? = ?", (self.now(), shards, shard))
+        return(cur.rowcount)
+
+    def claim(self, shard, shards, n):
+        # the n newest pending urls of this shard, as
+        # (url, kind, is_ch_url, page) tuples
+        if n <= 0:
+            return([])
+        with self.conn:
+            rows = self.conn.execute(
+                "SELECT url, kind, is_ch_url, page FROM frontier "
+                "WHERE state = 'pending' AND shard_key % ? = ? "
+                "ORDER BY priority LIMIT ?", (shards, shard, n)).fetchall()
+            self.conn.executemany(
+                "UPDATE frontier SET state = 'claimed', updated_at = ? WHERE url = ?",
+                [(self.now(), row[0]) for row in rows])
+        return([(url, kind, bool(is_ch_url), page) for url, kind, is_ch_url, page in rows])
+
+    def done(self, url):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE frontier SET state = 'done', updated_at = ? WHERE url = ?",
+                (self.now(), url))
+
+    def fail(self, url):
+        # back to pending until it has failed max_attempts times
+        with self.conn:
+            self.conn.execute(
+                "UPDATE frontier SET attempts = attempts + 1, updated_at = ?, "
+                "state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END "
+                "WHERE url = ?", (self.now(), self.max_attempts, url))
+
+    def open_work(self, shard, shards):
+        # urls this shard still has to crawl, and listing pages any shard still
+        # has to crawl (they can add articles to this shard)
+        mine = self.conn.execute(
+            "SELECT count(*) FROM frontier WHERE state IN ('pending', 'claimed') "
+            "AND shard_key % ? = ?", (shards, shard)).fetchone()[0]
+        listings = self.conn.execute(
+            "SELECT count(*) FROM frontier WHERE state IN ('pending', 'claimed') "
+            "AND kind = 'listing'").fetchone()[0]
+        return(mine, listings)
+
+    def counts(self):
+        # {(kind, state): n} over the whole frontier
+        return({(kind, state): n for kind, state, n in self.conn.execute(
+            "SELECT kind, state, count(*) FROM frontier GROUP BY kind, state")})
+
+    def close(self):
+        self.conn.close()
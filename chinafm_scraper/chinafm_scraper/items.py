@@ -9,6 +9,7 @@ import scrapy
 class ChinaFmScraperItem(scrapy.Item):
     title = scrapy.Field()
     text = scrapy.Field()
+    bold = scrapy.Field()  # 1 where the paragraph in text is bold (a question)
     date = scrapy.Field()
     url = scrapy.Field()
     lang = scrapy.Field()
@@ -6,6 +6,8 @@
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
 from scrapy import signals
+from scrapy.exceptions import IgnoreRequest
+from scrapy.http import HtmlResponse
 
 
 class ChinafmScraperSpiderMiddleware:
@@ -101,3 +103,25 @@ class ChinafmScraperDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class ArchiveReplayMiddleware:
+    # In replay mode (`scrapy crawl chinafm -a replay=1`) every request is
+    # answered from the spider's response archive, so nothing goes over the
+    # network; requests for pages that were never archived are dropped.
+
+    def process_request(self, request, spider):
+        if not getattr(spider, 'replay', False):
+            return None
+
+        archived = spider.archive.get(request.url)
+        if archived is None:
+            raise IgnoreRequest('Not in response archive: %s' % request.url)
+        header, body = archived
+        return HtmlResponse(
+            url=request.url,
+            status=header['status'],
+            headers={'Content-Type': header['content_type']},
+            body=body,
+            request=request
+        )
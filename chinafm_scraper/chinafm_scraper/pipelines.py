@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
-from scrapy.exporters import CsvItemExporter, JsonItemExporter
+import gzip
+from scrapy.exporters import CsvItemExporter, JsonItemExporter, JsonLinesItemExporter
 from datetime import datetime
 # Define your item pipelines here
 #
@@ -21,3 +22,49 @@ class JsonPipeline(object):
     def process_item(self, item, spider):
         self.exporter.export_item(item)
         return item
+
+
+# writes one JSON object per line so the file can be read back one record at
+# a time, and a crashed crawl still leaves every item written before the crash
+class JsonLinesPipeline(object):
+    def __init__(self, compression=None, suffix=""):
+        # backfill shards each append to their own file
+        filename = "rawdata/chinafm_press_" + datetime.today().strftime("%Y%m%d") + suffix + ".jsonl"
+        self.rawfile = None
+        self.flush_args = ()
+
+        if compression == 'gzip':
+            self.file = gzip.open(filename + ".gz", 'ab')
+        elif compression == 'zstd':
+            import zstandard
+            self.rawfile = open(filename + ".zst", 'ab')
+            self.file = zstandard.ZstdCompressor().stream_writer(self.rawfile)
+            self.flush_args = (zstandard.FLUSH_BLOCK,)
+        elif compression is None:
+            self.file = open(filename, 'ab')
+        else:
+            raise ValueError("Unknown JSONLINES_COMPRESSION: %s" % compression)
+
+        self.exporter = JsonLinesItemExporter(self.file, encoding='utf-8', ensure_ascii=False)
+        self.exporter.start_exporting()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        spider = crawler.spider
+        suffix = ""
+        if getattr(spider, 'backfill', False) and spider.shards > 1:
+            suffix = "_shard{:d}".format(spider.shard)
+        return cls(compression=crawler.settings.get('JSONLINES_COMPRESSION'), suffix=suffix)
+
+    def close_spider(self, spider):
+        self.exporter.finish_exporting()
+        self.file.close()
+        if self.rawfile is not None:
+            self.rawfile.close()
+
+    def process_item(self, item, spider):
+        self.exporter.export_item(item)
+        # flush each record through the compressor so it is readable on disk
+        # even if the crawl dies before close_spider
+        self.file.flush(*self.flush_args)
+        return item
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+from datetime import datetime
+
+
+# persistent index of article URLs that have already been scraped, with the
+# validators needed to re-request them conditionally
+class SeenUrlIndex(object):
+    def __init__(self, path):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS seen ("
+            "url TEXT PRIMARY KEY, lang TEXT, fetched_at TEXT, "
+            "etag TEXT, last_modified TEXT)")
+        self.conn.commit()
+
+    def get(self, url):
+        row = self.conn.execute(
+            "SELECT url, lang, fetched_at, etag, last_modified FROM seen WHERE url = ?",
+            (url,)).fetchone()
+        if row is None:
+            return(None)
+        return(dict(zip(['url', 'lang', 'fetched_at', 'etag', 'last_modified'], row)))
+
+    def known(self, urls):
+        # which of these urls are already in the index
+        urls = list(urls)
+        found = set()
+        # stay under SQLite's bound-parameter limit
+        for i in range(0, len(urls), 500):
+            chunk = urls[i:i + 500]
+            rows = self.conn.execute(
+                "SELECT url FROM seen WHERE url IN (%s)" % ",".join("?" * len(chunk)),
+                chunk)
+            found.update(r[0] for r in rows)
+        return(found)
+
+    def record(self, url, lang, etag=None, last_modified=None):
+        self.conn.execute(
+            "INSERT INTO seen (url, lang, fetched_at, etag, last_modified) "
+            "VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(url) DO UPDATE SET lang = excluded.lang, "
+            "fetched_at = excluded.fetched_at, etag = excluded.etag, "
+            "last_modified = excluded.last_modified",
+            (url, lang, datetime.now().isoformat(timespec='seconds'), etag, last_modified))
+        self.conn.commit()
+
+    def touch(self, url):
+        # article was re-requested and came back unchanged
+        self.conn.execute(
+            "UPDATE seen SET fetched_at = ? WHERE url = ?",
+            (datetime.now().isoformat(timespec='seconds'), url))
+        self.conn.commit()
+
+    def conditional_headers(self, url):
+        seen = self.get(url)
+        headers = {}
+        if seen is not None:
+            if seen['etag']:
+                headers['If-None-Match'] = seen['etag']
+            if seen['last_modified']:
+                headers['If-Modified-Since'] = seen['last_modified']
+        return(headers)
+
+    def close(self):
+        self.conn.close()
@@ -54,20 +54,30 @@ ROBOTSTXT_OBEY = True
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
 DOWNLOADER_MIDDLEWARES = {
     'scrapy.downloadermiddlewares.useragent.UserAgentMiddleware': None,
+    'chinafm_scraper.middlewares.ArchiveReplayMiddleware': 50,
 }
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
+EXTENSIONS = {
 #    'scrapy.extensions.telnet.TelnetConsole': None,
-#}
+    'chinafm_scraper.extensions.RunMetrics': 500,
+}
+
+# Where RunMetrics writes chinafm_scrape.prom (Prometheus textfile) and
+# chinafm_scrape.json (run summary); set to None to turn it off
+METRICS_DIR = "metrics"
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
-   'chinafm_scraper.pipelines.JsonPipeline': 300
+   # 'chinafm_scraper.pipelines.JsonPipeline': 300
+   'chinafm_scraper.pipelines.JsonLinesPipeline': 300
 }
 
+# Compression for the JSON Lines output: None, 'gzip' or 'zstd' (needs zstandard)
+JSONLINES_COMPRESSION = None
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
 #AUTOTHROTTLE_ENABLED = True
@@ -90,6 +100,29 @@ ITEM_PIPELINES = {
 #HTTPCACHE_IGNORE_HTTP_CODES = []
 #HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
 
+# Incremental crawling: page through the listings only until a page whose
+# articles are all in the seen-URL index, and skip articles already scraped.
+# Run `scrapy crawl chinafm -a full=1` to request every listing page again.
+INCREMENTAL_CRAWL = True
+SEEN_INDEX_PATH = "index/seen_urls.sqlite"
+# Re-request known articles with If-None-Match/If-Modified-Since instead of skipping
+RECHECK_KNOWN = False
+
+# Keep every article response in an append-only compressed archive so
+# parse_mf_press can be re-run offline with `scrapy crawl chinafm -a replay=1`
+# (set to None to turn the archive off)
+RESPONSE_ARCHIVE_DIR = "archive"
+
+# Backfill of the whole archive: `scrapy crawl chinafm -a backfill=1` finds
+# the number of listing pages and crawls every listing page and article from a
+# persistent frontier, newest pages first. Start several processes on one
+# frontier with `-a shard=i -a shards=n` (i from 0 to n - 1; shard 0 looks up
+# the page counts), and re-run a stopped shard to resume it.
+BACKFILL_FRONTIER_PATH = "index/frontier.sqlite"
+# URLs each backfill process has out at once, so the site sees at most
+# shards * BACKFILL_IN_FLIGHT concurrent requests
+BACKFILL_IN_FLIGHT = 2
+
 # Store logs
 LOG_FILE = "logs/chinafm_log_" + datetime.today().strftime("%Y%m%d") + ".log"
 LOG_LEVEL = "INFO"
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
+import re
 import scrapy
-from scrapy import Request
+from scrapy import Request, signals
+from scrapy.exceptions import CloseSpider, DontCloseSpider
 from datetime import datetime
 from ..items import ChinaFmScraperItem
-import re
+from ..seenindex import SeenUrlIndex
+from ..archive import ResponseArchive
+from ..frontier import Frontier
 
 # make list of URLs to scrape for English statements
 en_root = "https://www.fmprc.gov.cn/mfa_eng/xwfw_665399/s2510_665401/2511_665403"
@@ -16,18 +20,277 @@ ch_urls = [ch_root + "/default.shtml"]
 ch_urls.extend([ch_root + "/default_{:d}".format(x) + ".shtml" for x in range(1, 67)])
 
 
+def listing_url(rooturl, page):
+    # page 0 is default.shtml, page n is default_n.shtml
+    if page == 0:
+        return(rooturl + "/default.shtml")
+    return(rooturl + "/default_{:d}".format(page) + ".shtml")
+
+
+# listing pages build their pager with createPageHTML(countPage, ...)
+page_count_re = re.compile(r'countPage\s*=\s*(\d+)')
+
+# backfill priorities: listing page n comes right before its own articles and
+# after every article of page n - 1, so the newest pages are crawled first
+page_stride = 1000
+
+
+def is_true(value):
+    return(str(value).lower() in ('1', 'true', 'yes'))
+
+
+def _paragraph_events(el, bold, events):
+    # text and <br> events under an element, in document order, with whether
+    # the text sits inside <b>/<strong>
+    for child in el:
+        tag = child.tag.lower() if isinstance(child.tag, str) else None
+        if tag == 'br':
+            events.append(('br', None, bold))
+        elif tag is not None and tag not in ('script', 'style'):
+            inner_bold = bold or tag in ('b', 'strong')
+            if child.text:
+                events.append(('text', child.text, inner_bold))
+            _paragraph_events(child, inner_bold, events)
+        if child.tail:
+            events.append(('text', child.tail, bold))
+
+
+def paragraph_segments(p):
+    # plain-text parts of a <p>, split where it has <br><br>, as (text, bold)
+    events = [('text', p.text, False)] if p.text else []
+    _paragraph_events(p, False, events)
+
+    segments = []
+    parts = []
+    bold = False
+    last_br = False
+    for kind, text, in_bold in events + [('br', None, False), ('br', None, False)]:
+        if kind == 'br':
+            if last_br:
+                clean = ' '.join(''.join(parts).replace('\u3000', '').split())
+                if clean != '':
+                    segments.append((clean, bold))
+                parts = []
+                bold = False
+                last_br = False
+            else:
+                last_br = True
+            continue
+        # a single <br> inside a paragraph is just a line break
+        if last_br:
+            parts.append(' ')
+            last_br = False
+        parts.append(text)
+        if in_bold and text.strip() != '':
+            bold = True
+    return(segments)
+
+
 # China Foreign Ministry scraper
 class ChinaFmSpider(scrapy.Spider):
     name = 'chinafm'
 
     start_urls = en_urls + ch_urls
 
-    def parse(self, response):
-        # is it a url for a chinese site
-        is_ch_url = True if (ch_root in response.url) else False
-        self.logger.info('Parse function called on %s', response.url)
-        self.logger.info('URL identified as Chinese: %s', str(is_ch_url))
+    # last listing page to page through for each site
+    max_page = {en_root: len(en_urls) - 1, ch_root: len(ch_urls) - 1}
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(ChinaFmSpider, cls).from_crawler(crawler, *args, **kwargs)
+        settings = crawler.settings
+
+        # `scrapy crawl chinafm -a full=1` requests every listing page again
+        full = is_true(getattr(spider, 'full', '0'))
+        spider.incremental = settings.getbool('INCREMENTAL_CRAWL', True) and not full
+        spider.recheck_known = settings.getbool('RECHECK_KNOWN', False)
+        spider.seen = SeenUrlIndex(settings.get('SEEN_INDEX_PATH', 'index/seen_urls.sqlite'))
+
+        # `scrapy crawl chinafm -a replay=1` re-parses the archived articles
+        # without touching the network
+        spider.replay = is_true(getattr(spider, 'replay', '0'))
+        archive_dir = settings.get('RESPONSE_ARCHIVE_DIR')
+        spider.archive = ResponseArchive(archive_dir) if archive_dir else None
+        if spider.replay and spider.archive is None:
+            raise ValueError('Replay needs RESPONSE_ARCHIVE_DIR to be set')
+
+        # `scrapy crawl chinafm -a backfill=1 -a shard=0 -a shards=4` crawls
+        # the whole archive from the frontier, one shard per process
+        spider.backfill = is_true(getattr(spider, 'backfill', '0'))
+        spider.frontier = None
+        if spider.backfill:
+            spider.incremental = False
+            spider.shard = int(getattr(spider, 'shard', 0))
+            spider.shards = int(getattr(spider, 'shards', 1))
+            if not 0 <= spider.shard < spider.shards:
+                raise ValueError('Backfill shard must be between 0 and shards - 1')
+            spider.frontier = Frontier(settings.get('BACKFILL_FRONTIER_PATH', 'index/frontier.sqlite'))
+            # claimed urls out at once; this is the process's concurrency on the site
+            spider.max_in_flight = settings.getint('BACKFILL_IN_FLIGHT', 2)
+            spider.in_flight = 0
+            spider.discovering = set()
+            crawler.signals.connect(spider.backfill_idle, signal=signals.spider_idle)
+        return spider
+
+    def start_requests(self):
+        if self.replay:
+            # ArchiveReplayMiddleware answers these from the archive
+            for url, is_ch_url in self.archive.urls():
+                yield Request(
+                    url,
+                    callback=self.parse_mf_press,
+                    meta={'is_ch_url': bool(is_ch_url)},
+                    dont_filter=True
+                )
+            return
+
+        if self.backfill:
+            released = self.frontier.release(self.shard, self.shards)
+            self.logger.info('Backfill shard %d of %d: %d urls back from the last run',
+                             self.shard, self.shards, released)
+            # only the first shard looks for new listing pages
+            if self.shard == 0:
+                for rooturl in [en_root, ch_root]:
+                    self.discovering.add(rooturl)
+                    self.frontier.set_page_count_error(rooturl, None)
+                    yield Request(listing_url(rooturl, 0), callback=self.parse_page_count,
+                                  errback=self.page_count_failed, dont_filter=True,
+                                  meta={'root': rooturl})
+            for request in self.claim_requests():
+                yield request
+            return
+
+        if not self.incremental:
+            for url in self.start_urls:
+                yield Request(url, dont_filter=True)
+            return
+
+        # page through the listings from the newest page until one is fully known
+        for rooturl in [en_root, ch_root]:
+            yield Request(listing_url(rooturl, 0), callback=self.parse, meta={'page': 0})
 
+    async def start(self):
+        # Scrapy 2.13+ asks for start() instead of start_requests()
+        for request in self.start_requests():
+            yield request
+
+    def closed(self, reason):
+        self.seen.close()
+        if self.archive is not None:
+            self.archive.close()
+        if self.frontier is not None:
+            counts = self.frontier.counts()
+            self.logger.info('Backfill frontier: %s', ', '.join(
+                '%s %s %d' % (kind, state, n) for (kind, state), n in sorted(counts.items())))
+            self.frontier.close()
+
+    def parse_page_count(self, response):
+        # find how many listing pages there are, from the pager script or
+        # else by probing, and put them all in the frontier
+        rooturl = response.meta['root']
+        found = page_count_re.search(response.text)
+        if found:
+            for request in self.seed_listings(rooturl, int(found.group(1))):
+                yield request
+        else:
+            yield self.probe_request(rooturl, 0, None)
+
+    def probe_request(self, rooturl, lo, hi):
+        # page lo exists and page hi (if known) does not: double lo until a
+        # page is missing, then bisect
+        page = lo * 2 + 1 if hi is None else (lo + hi) // 2
+        return(Request(listing_url(rooturl, page), callback=self.parse_probe,
+                       errback=self.page_count_failed, dont_filter=True,
+                       meta={'root': rooturl, 'lo': lo, 'hi': hi, 'page': page,
+                             'handle_httpstatus_list': [404]}))
+
+    def parse_probe(self, response):
+        rooturl, lo, hi, page = [response.meta[k] for k in ['root', 'lo', 'hi', 'page']]
+        if response.status == 200 and self.listing_links(response, rooturl == ch_root):
+            lo = page
+        else:
+            hi = page
+        if hi is not None and hi - lo <= 1:
+            for request in self.seed_listings(rooturl, hi):
+                yield request
+        else:
+            yield self.probe_request(rooturl, lo, hi)
+
+    def page_count_failed(self, failure):
+        # the first listing page could not be fetched: probe for the last
+        # page instead. when probing fails too, keep the page count from an
+        # earlier run, if any, or record the failure so no shard waits for it
+        rooturl = failure.request.meta['root']
+        if 'page' not in failure.request.meta:
+            self.logger.warning('Could not fetch the pager of %s (%s), probing', rooturl, failure.value)
+            yield self.probe_request(rooturl, 0, None)
+            return
+        self.logger.error('Could not find the page count of %s: %s', rooturl, failure.value)
+        if self.frontier.page_count(rooturl) is None:
+            self.frontier.set_page_count_error(rooturl, repr(failure.value))
+        self.discovering.discard(rooturl)
+
+    def seed_listings(self, rooturl, pages):
+        self.logger.info('%s has %d listing pages', rooturl, pages)
+        self.frontier.set_page_count(rooturl, pages)
+        self.frontier.add([(listing_url(rooturl, page), 'listing', rooturl == ch_root, page,
+                            page * page_stride) for page in range(pages)])
+        self.discovering.discard(rooturl)
+        return(self.claim_requests())
+
+    def claim_requests(self):
+        # top this process back up to max_in_flight urls from its shard
+        claimed = self.frontier.claim(self.shard, self.shards, self.max_in_flight - self.in_flight)
+        for url, kind, is_ch_url, page in claimed:
+            self.in_flight += 1
+            yield Request(url, callback=self.parse_claimed, errback=self.claim_failed,
+                          dont_filter=True,
+                          meta={'frontier_url': url, 'kind': kind, 'is_ch_url': is_ch_url,
+                                'page': page})
+
+    def parse_claimed(self, response):
+        # a url from the frontier: parse it, then check it off and claim more
+        parse = self.parse_mf_press if response.meta['kind'] == 'article' else self.parse
+        for out in parse(response):
+            yield out
+        self.frontier.done(response.meta['frontier_url'])
+        self.in_flight -= 1
+        for request in self.claim_requests():
+            yield request
+
+    def claim_failed(self, failure):
+        url = failure.request.meta['frontier_url']
+        self.logger.warning('Backfill request failed: %s (%s)', url, failure.value)
+        self.frontier.fail(url)
+        self.in_flight -= 1
+        for request in self.claim_requests():
+            yield request
+
+    def backfill_idle(self):
+        # nothing is downloading, so anything still claimed was dropped
+        self.in_flight = 0
+        self.frontier.release(self.shard, self.shards)
+        claimed = list(self.claim_requests())
+        for request in claimed:
+            self.crawler.engine.crawl(request)
+        if claimed or self.discovering:
+            raise DontCloseSpider
+        # wait while other shards' listing pages can still add articles here,
+        # and for shard 0 to find the page counts unless it could not
+        mine, listings = self.frontier.open_work(self.shard, self.shards)
+        unknown = [rooturl for rooturl in [en_root, ch_root] if self.frontier.page_count(rooturl) is None]
+        failed = [rooturl for rooturl in unknown if self.frontier.page_count_error(rooturl) is not None]
+        waiting = len(unknown) > len(failed)
+        if mine or listings or waiting:
+            self.logger.info('Backfill shard %d waiting: %d own urls, %d listing pages left%s',
+                             self.shard, mine, listings,
+                             ', no page counts yet (start shard 0)' if waiting else '')
+            raise DontCloseSpider
+        if failed:
+            self.logger.error('Backfill stopped without the page count of %s', ', '.join(failed))
+            raise CloseSpider('backfill_page_count_failed')
+
+    def listing_links(self, response, is_ch_url):
         # depending on whether it's in Chinese, different XPath selector required
         ch_xp = '//*[contains(concat( " ", @class, " " ), concat( " ", "rebox_news", " " ))]//a/@href'
         en_xp = '//*[contains(concat( " ", @class, " " ), concat( " ", "fl", " " ))]//a/@href'
@@ -44,40 +307,87 @@ class ChinaFmSpider(scrapy.Spider):
             if "shtml" in u:
                 out = rooturl + u.replace(".", "", 1)
                 parseurls.append(out)
+        return(parseurls)
 
-        # call parsing function to grab data from statements
-        return(
-            Request(
-                suburl,
-                callback=self.parse_mf_press,
-                meta={'is_ch_url': is_ch_url}
-            ) for suburl in parseurls
-        )
+    def parse(self, response):
+        # is it a url for a chinese site
+        is_ch_url = True if (ch_root in response.url) else False
+        self.logger.info('Parse function called on %s', response.url)
+        self.logger.info('URL identified as Chinese: %s', str(is_ch_url))
+
+        rooturl = ch_root if is_ch_url else en_root
+        parseurls = self.listing_links(response, is_ch_url)
+
+        # backfill: new articles go to the frontier, in the listing's order
+        if self.backfill:
+            known = self.seen.known(parseurls)
+            page = response.meta['page']
+            self.frontier.add([(suburl, 'article', is_ch_url, page, page * page_stride + 1 + i)
+                               for i, suburl in enumerate(parseurls) if suburl not in known])
+            return
+
+        # skip articles scraped on earlier runs, or re-request them
+        # conditionally so an unchanged article comes back as an empty 304
+        known = self.seen.known(parseurls)
+        for suburl in parseurls:
+            if suburl not in known:
+                yield Request(
+                    suburl,
+                    callback=self.parse_mf_press,
+                    meta={'is_ch_url': is_ch_url}
+                )
+            elif self.recheck_known:
+                yield Request(
+                    suburl,
+                    callback=self.parse_mf_press,
+                    headers=self.seen.conditional_headers(suburl),
+                    meta={'is_ch_url': is_ch_url, 'handle_httpstatus_list': [304]}
+                )
+
+        # stop paging once a whole listing page is already known
+        page = response.meta.get('page')
+        if self.incremental and page is not None:
+            self.logger.info('Listing page %d: %d of %d articles already known',
+                             page, len(known), len(parseurls))
+            if len(known) < len(parseurls) and page < self.max_page[rooturl]:
+                yield Request(
+                    listing_url(rooturl, page + 1),
+                    callback=self.parse,
+                    meta={'page': page + 1}
+                )
 
 
     def parse_mf_press(self, response):
         is_ch_url = response.meta['is_ch_url']
 
+        # known article that hasn't changed since the last scrape
+        if response.status == 304:
+            self.logger.info('Not modified: %s', response.url)
+            self.seen.touch(response.url)
+            return
+
+        # keep the raw page so it can be re-parsed later without a crawl
+        if self.archive is not None and not self.replay:
+            self.archive.add(response, is_ch_url)
+
         # if it's a Chinese URL, need to use different XPath selectors
         if is_ch_url:
             title = response.xpath('//*[(@id = "News_Body_Title")]/text()').getall()
             date = response.xpath('//*[(@id = "News_Body_Time")]/text()').getall()
-            initial_text = response.xpath('//p').getall()
 
         # XPath selectors for English statements
         else:
             title = response.xpath('//title/text()').getall()
             date = [None]  # English pages don't have date
-            initial_text = response.xpath('//p').getall()
 
-        # parse the text, because some lines are split by <br><br>
+        # walk each paragraph once for its plain text, split where lines are
+        # separated by <br><br>, and flag bold parts (questions)
         text = []
-        for t in initial_text:
-            split_text = t.replace("<BR><BR>", "<br><br>")
-            split_text = re.sub("^<br><br>", "", split_text)
-            split_text = re.sub("<br><br>$", "", split_text)
-            split_text = split_text.split("<br><br>")
-            text.extend(split_text)
+        bold = []
+        for p in response.xpath('//p'):
+            for segment_text, segment_bold in paragraph_segments(p.root):
+                text.append(segment_text)
+                bold.append(int(segment_bold))
 
         # log the title
         self.logger.info('Finished parsing %s', title[0])
@@ -89,9 +399,19 @@ class ChinaFmSpider(scrapy.Spider):
         items['title'] = title
         items['date'] = date
         items['text'] = text
+        items['bold'] = bold
         items['url'] = response.url
         items['lang'] = 'Chinese' if is_ch_url else 'English'
         items['scrape_date'] = datetime.today().strftime("%Y%m%d")
 
+        # remember the article so later runs can skip it
+        if not self.replay:
+            self.seen.record(
+                response.url,
+                items['lang'],
+                etag=response.headers.get('ETag', b'').decode('latin-1') or None,
+                last_modified=response.headers.get('Last-Modified', b'').decode('latin-1') or None
+            )
+
         # output info
         yield items
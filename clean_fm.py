@@ -1,151 +1,210 @@
-import json
-import pandas as pd
+import argparse
+import os
 import re
-import csv
-from dateutil import parser
+import time
 from datetime import datetime
 from utils_clean import *
+from utils_metrics import RunMetrics, write_metrics
+from utils_store import *
 
 
-## READ IN SCRAPED FILE --------------------------------------------------------
-fname = "C:/Users/clara/Documents/china_fm/chinafm_scraper/rawdata/chinafm_press_" + datetime.today().strftime("%Y%m%d") + ".json"
-fname
-#fname = "C:/Users/clara/Documents/china_fm/chinafm_scraper/rawdata/chinafm_press_20200704.json"
+# the scraper and app directories of this repo, unless CHINAFM_RAW_DIR or
+# CHINAFM_APP_DIR say otherwise
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+raw_dir = os.environ.get("CHINAFM_RAW_DIR", repo_dir + "/chinafm_scraper/rawdata")
+app_dir = os.environ.get("CHINAFM_APP_DIR", repo_dir + "/chinafm_app")
+store_path = app_dir + "/clean_fm.sqlite"
 
-with open(fname, 'rt', encoding='utf-8') as f:
-    data = json.load(f, encoding="utf-8")
+# JSON Lines scrapes written by the pipeline, including backfill shards
+raw_file_re = re.compile(r"^chinafm_press_.*\.jsonl(\.gz|\.zst)?$")
 
-len(data)
+
+def default_raw_file():
+    # today's scrape, in whichever format the pipeline wrote it
+    stem = raw_dir + "/chinafm_press_" + datetime.today().strftime("%Y%m%d")
+    for ext in [".jsonl", ".jsonl.gz", ".jsonl.zst", ".json"]:
+        if os.path.exists(stem + ext):
+            return(stem + ext)
+    return(stem + ".json")
 
 
 ## PARSE SCRAPED DATA ----------------------------------------------------------
-# initialize empty lists to store clean output
-clean_output_ch = list()
-clean_output_en = list()
-
-for entry in data:
-    text = entry['text']
-    clean_lang = entry['lang']
-    clean_scrape_date = datetime.strptime(entry['scrape_date'], "%Y%m%d").strftime("%Y-%m-%d")
-    clean_url = entry['url']
-
-    # flag for whether it's in Chinese
-    is_ch = clean_lang == "Chinese"
-
-    # clean title and date information
-    orig_spox, clean_spox = get_clean_spox(entry, is_ch)
-    clean_date = get_clean_date(entry, is_ch)
-    clean_remarkstype = get_clean_type(entry, is_ch)
-
-    # initialize empty lists to store cleaned lines information
-    clean_remarks = []
-    clean_order = []
-    clean_contenttype = []
-    clean_string = ''
-    order_start = 1
-
-    # iterate through each line and parse
-    for line in text:
-        stripped_text, question_flag = get_clean_remarks(line)
-
-        # only parse the line if it's not empty
-        if stripped_text.strip() != "":
-
-            # check if it's a question or answer block
-            q_or_a = check_qa(stripped_text, is_ch) or question_flag
-            answer_flag = check_answer(stripped_text, orig_spox, is_ch)
-
-            if answer_flag:
-                blocktype = "A"
-            elif question_flag:
-                blocktype = "Q"
-            else:
-                blocktype = "None"
-
-            # if just beginning, set cleaned string as start
-            if clean_string == '':
-                clean_string = stripped_text
-                clean_type = blocktype
-
-            # if it's a question or answer, set the start of new clean string
-            # to this beginning question or answer
-            elif q_or_a:
-                # add the current info to list
-                clean_remarks.append(clean_string)
-                clean_order.append(order_start)
-                clean_contenttype.append(clean_type)
-
-                # reset values to signal start of answer or question
-                order_start += 1
-                clean_string = stripped_text
-                clean_type = blocktype
-
-            # if it's not the beginning of a section, add it to the string
-            else:
-                clean_string = clean_string + '<br><br>' + stripped_text
-
-    # add the last paragraph to the lists
-    clean_remarks.append(clean_string)
-    clean_order.append(order_start)
-    clean_contenttype.append(clean_type)
-
-    # make dictionary to store cleaned info
-    out = {
-        "title": entry['title'][0],
-        "spox": clean_spox,
-        "date": clean_date,
-        "type": clean_remarkstype,
-        "content": clean_remarks,
-        "content_order": clean_order,
-        "content_type": clean_contenttype,
-        'url': clean_url,
-        'lang': clean_lang,
-        'scrape_date': clean_scrape_date
-    }
-
-    if is_ch:
-        clean_output_ch.append(out)
+def count_entry(metrics, out):
+    metrics.counts['entries'] += 1
+    metrics.counts[('rows', 'lang', out.lang)] += len(out.content)
+    metrics.counts.update(('blocks', 'content_type', t) for t in out.content_type)
+    for t, n in out.line_types.items():
+        metrics.counts[('lines', 'classified', t)] += n
+
+
+def clean_batch(fname, workers=1, metrics=None):
+    # cleaned blocks of the whole file as one BlockTable per language
+    # (table.rows() to write them, table.frame() for a data frame)
+    metrics = metrics or RunMetrics()
+    blocks_en = BlockTable()
+    blocks_ch = BlockTable()
+
+    entries = metrics.timed('parse', read_raw_entries(fname))
+    for out in metrics.timed('clean', iter_clean_entries(entries, workers)):
+        count_entry(metrics, out)
+        with metrics.stage('explode'):
+            (blocks_ch if out.lang == "Chinese" else blocks_en).add(out)
+    return(blocks_en, blocks_ch)
+
+
+def clean_entries(entries, conn, workers=1, metrics=None):
+    # upsert cleaned rows as each record is read, so memory stays flat
+    # however big the crawl is
+    metrics = metrics or RunMetrics()
+
+    def rows():
+        for out in metrics.timed('clean', iter_clean_entries(metrics.timed('parse', entries), workers)):
+            count_entry(metrics, out)
+            with metrics.stage('explode'):
+                out_rows = list(iter_clean_rows(out))
+            yield from out_rows
+
+    with metrics.stage('merge'):
+        return(upsert_rows(conn, rows()))
+
+
+def clean_stream(fname, conn, workers=1, metrics=None):
+    return(clean_entries(read_raw_entries(fname), conn, workers, metrics))
+
+
+## MERGE INTO STORE ------------------------------------------------------------
+def open_clean_store(path=store_path):
+    # first run against an existing app directory: seed the store from the
+    # csv files earlier versions of this script kept rewriting
+    is_new = not os.path.exists(path)
+    conn = open_store(path)
+    if is_new:
+        for lang in ['en', 'ch']:
+            fname_csv = app_dir + "/clean_fm_" + lang + ".csv"
+            if os.path.exists(fname_csv):
+                print("seeding store from", fname_csv, import_csv(conn, fname_csv))
+    return(conn)
+
+
+## WATCH RAW DATA -------------------------------------------------------------
+def clean_new_records(fname, conn, workers=1, metrics=None):
+    # clean only what was appended to a JSON Lines scrape since it was last
+    # read, and move its checkpoint past it; returns (records, rows changed)
+    name = os.path.basename(fname)
+    stat = os.stat(fname)
+    checkpoint = get_raw_checkpoint(conn, name)
+    start = 0
+    if checkpoint is not None:
+        offset, size, mtime = checkpoint
+        if (size, mtime) == (stat.st_size, stat.st_mtime):
+            return(0, 0)
+        # a file that shrank was replaced, so it is read again from the start
+        if stat.st_size >= size:
+            start = offset
+
+    read = {'records': 0, 'offset': start}
+
+    def entries():
+        for entry, offset in read_raw_entries(fname, start, offsets=True):
+            read['records'] += 1
+            read['offset'] = offset
+            yield(entry)
+
+    changed = clean_entries(entries(), conn, workers, metrics)
+    set_raw_checkpoint(conn, name, read['offset'], stat.st_size, stat.st_mtime)
+    return(read['records'], changed)
+
+
+def watch(conn, dirpath=raw_dir, interval=2.0, workers=1, metrics_dir=None, once=False):
+    # poll the raw data directory and clean records as the crawler appends
+    # them; runs until interrupted, or for a single pass with once
+    while True:
+        metrics = RunMetrics()
+        records = 0
+        for name in sorted(os.listdir(dirpath)):
+            if raw_file_re.match(name):
+                n, changed = clean_new_records(os.path.join(dirpath, name), conn, workers, metrics)
+                if n:
+                    print(datetime.now().strftime("%H:%M:%S"), name, n, "records,", changed, "rows changed")
+                    metrics.counts['rows_changed'] += changed
+                    records += n
+        if records and metrics_dir:
+            write_metrics(metrics, metrics_dir)
+        if once:
+            return
+        time.sleep(interval)
+
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(description="Clean scraped China FM statements")
+    argparser.add_argument("fname", nargs="?", default=None,
+                           help="scraped file (.json, .jsonl, .jsonl.gz or .jsonl.zst); defaults to today's scrape")
+    argparser.add_argument("--stream", action="store_true",
+                           help="clean one record at a time and write rows as they are cleaned")
+    argparser.add_argument("--workers", type=int, default=1,
+                           help="clean entries across this many processes")
+    argparser.add_argument("--export-csv", action="store_true",
+                           help="also rewrite clean_fm_en.csv/clean_fm_ch.csv from the store")
+    argparser.add_argument("--export-parquet", action="store_true",
+                           help="also rewrite clean_fm_en.parquet/clean_fm_ch.parquet from the store")
+    argparser.add_argument("--metrics-dir", default=app_dir + "/metrics",
+                           help="where to write chinafm_clean.prom and chinafm_clean.json")
+    argparser.add_argument("--profile", metavar="FILE", default=None,
+                           help="write cProfile stats for the run to FILE")
+    argparser.add_argument("--watch", action="store_true",
+                           help="keep cleaning records as they are appended to the scrapes in --raw-dir")
+    argparser.add_argument("--once", action="store_true",
+                           help="with --watch, clean what is new and stop")
+    argparser.add_argument("--interval", type=float, default=2.0,
+                           help="seconds between --watch passes")
+    argparser.add_argument("--raw-dir", default=raw_dir)
+    args = argparser.parse_args(argv)
+
+    if args.watch:
+        conn = open_clean_store()
+        try:
+            watch(conn, args.raw_dir, args.interval, args.workers, args.metrics_dir, args.once)
+        except KeyboardInterrupt:
+            pass
+        conn.close()
+        return
+
+    fname = args.fname or default_raw_file()
+    print(fname)
+
+    metrics = RunMetrics()
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    conn = open_clean_store()
+    if args.stream:
+        changed = clean_stream(fname, conn, args.workers, metrics)
     else:
-        clean_output_en.append(out)
-
-
-## STACK AND WRITE DATA --------------------------------------------------------
-# make it a data frame
-full_clean_en = pd.DataFrame(clean_output_en)
-full_clean_en.shape
-full_clean_ch = pd.DataFrame(clean_output_ch)
-full_clean_ch.shape
-
-
-# identify index columns
-index_cols = ['title', 'date', 'spox', 'type', 'url', 'lang', 'scrape_date']
-# explode into rows
-expanded_full_clean_en = full_clean_en.set_index(index_cols).apply(pd.Series.explode).reset_index()
-expanded_full_clean_en.shape
-expanded_full_clean_ch = full_clean_ch.set_index(index_cols).apply(pd.Series.explode).reset_index()
-expanded_full_clean_ch.shape
-
-# read in original files
-original_en = pd.read_csv('C:/Users/clara/Documents/china_fm/chinafm_app/clean_fm_en.csv', encoding='utf-8', index_col=0)
-original_en.shape
-original_ch = pd.read_csv('C:/Users/clara/Documents/china_fm/chinafm_app/clean_fm_ch.csv', encoding='utf-8', index_col=0)
-original_ch.shape
-
-# stack dataframes
-stacked_en = pd.concat([original_en, expanded_full_clean_en])
-stacked_en.shape
-stacked_ch = pd.concat([original_ch, expanded_full_clean_ch])
-stacked_ch.shape
-
-stacked_en = stacked_en.drop(columns=['scrape_date'])
-stacked_ch = stacked_ch.drop(columns=['scrape_date'])
-
-# remove duplicates
-stacked_en.drop_duplicates(subset=list(stacked_en), keep='first', inplace=True)
-stacked_en.shape
-stacked_ch.drop_duplicates(subset=list(stacked_ch), keep='first', inplace=True)
-stacked_ch.shape
-
-# write to csv
-stacked_en.to_csv("C:/Users/clara/Documents/china_fm/chinafm_app/clean_fm_en.csv")
-stacked_ch.to_csv("C:/Users/clara/Documents/china_fm/chinafm_app/clean_fm_ch.csv")
+        new_en, new_ch = clean_batch(fname, args.workers, metrics)
+        print(len(new_en), len(new_ch))
+        with metrics.stage('merge'):
+            changed = upsert_rows(conn, new_en.rows()) + upsert_rows(conn, new_ch.rows())
+    metrics.counts['rows_changed'] += changed
+    print("rows changed:", changed)
+
+    # csv copies for anything still reading the old files
+    with metrics.stage('write'):
+        if args.export_csv:
+            export_csv(conn, "English", app_dir + "/clean_fm_en.csv")
+            export_csv(conn, "Chinese", app_dir + "/clean_fm_ch.csv")
+        if args.export_parquet:
+            export_parquet(conn, "English", app_dir + "/clean_fm_en.parquet")
+            export_parquet(conn, "Chinese", app_dir + "/clean_fm_ch.parquet")
+    conn.close()
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+    write_metrics(metrics, args.metrics_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import argparse
+import time
+from clean_fm import app_dir, store_path
+from utils_store import open_store
+from utils_cube import WordCube
+
+
+cube_path = app_dir + "/cube_fm"
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        description="Build or query the word-frequency cube over cleaned China FM statements")
+    argparser.add_argument("--rebuild", action="store_true",
+                           help="count the whole store again instead of only the days with changed rows")
+    argparser.add_argument("--top", action="store_true",
+                           help="print the most frequent words instead of updating")
+    argparser.add_argument("--lang", default="English", choices=["English", "Chinese"])
+    argparser.add_argument("--start", default=None, help="first date, YYYY-MM-DD")
+    argparser.add_argument("--end", default=None, help="last date, YYYY-MM-DD")
+    argparser.add_argument("--spox", action="append", default=None,
+                           help="spokesperson label, e.g. 'HUA Chunying (华春莹)' (repeatable)")
+    argparser.add_argument("--type", action="append", default=None,
+                           help="type of remarks, e.g. 'Regular Press Conference' (repeatable)")
+    argparser.add_argument("--remove", nargs="+", default=[], help="words to leave out")
+    argparser.add_argument("--min-freq", type=int, default=1)
+    argparser.add_argument("--limit", type=int, default=50)
+    args = argparser.parse_args()
+
+    cube = WordCube(cube_path)
+    if not args.top:
+        store_conn = open_store(store_path)
+        start = time.perf_counter()
+        print("days counted:", cube.update(store_conn, args.rebuild))
+        print("cells: %d, terms: %d, %.1fs" % (len(cube.keys), len(cube.terms), time.perf_counter() - start))
+        store_conn.close()
+    else:
+        start = time.perf_counter()
+        words = cube.top_terms(args.lang, args.start, args.end, args.spox, args.type,
+                               args.remove, args.min_freq, args.limit)
+        print("%d words in %.1f ms" % (len(words), (time.perf_counter() - start) * 1000))
+        for word, freq in words:
+            print(freq, word)
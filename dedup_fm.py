@@ -0,0 +1,32 @@
+import argparse
+import csv
+from clean_fm import app_dir, store_path
+from utils_store import open_store
+from utils_dedup import *
+
+
+dedup_path = app_dir + "/dedup_fm.sqlite"
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        description="Cluster near-duplicate content blocks in the cleaned China FM statements")
+    argparser.add_argument("--rebuild", action="store_true",
+                           help="sign and cluster the whole store again instead of only new rows")
+    argparser.add_argument("--export", metavar="FILE", default=None,
+                           help="write url, lang, content_order, cluster and cluster_size to a csv")
+    args = argparser.parse_args()
+
+    conn = open_dedup(dedup_path)
+    store_conn = open_store(store_path)
+    print("blocks signed:", update_dedup(conn, store_conn, args.rebuild))
+    store_conn.close()
+
+    if args.export:
+        with open(args.export, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['url', 'lang', 'content_order', 'cluster', 'cluster_size'])
+            writer.writerows(conn.execute(
+                "SELECT url, lang, content_order, cluster, cluster_size FROM block_clusters "
+                "ORDER BY lang, url, content_order"))
+    conn.close()
@@ -0,0 +1,33 @@
+import argparse
+from clean_fm import app_dir, store_path
+from utils_store import open_store
+from utils_index import *
+
+
+index_path = app_dir + "/index_fm.sqlite"
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        description="Build or query the word index over cleaned China FM statements")
+    argparser.add_argument("--rebuild", action="store_true",
+                           help="index the whole store again instead of only new rows")
+    argparser.add_argument("--query", nargs="+", default=None,
+                           help="list responses that use these words instead of updating")
+    argparser.add_argument("--lang", default="English", choices=["English", "Chinese"])
+    argparser.add_argument("--any", action="store_true",
+                           help="match responses using any of the words rather than all")
+    args = argparser.parse_args()
+
+    conn = open_index(index_path)
+    if args.query is None:
+        store_conn = open_store(store_path)
+        print("responses indexed:", update_index(conn, store_conn, args.rebuild))
+        store_conn.close()
+    else:
+        ids = search(conn, args.lang, args.query, 'any' if args.any else 'all')
+        print(len(ids), "responses")
+        for i in ids[:20]:
+            print(conn.execute(
+                "SELECT id, date, spox, url FROM responses WHERE id = ?", (i,)).fetchone())
+    conn.close()
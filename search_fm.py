@@ -0,0 +1,57 @@
+import argparse
+import subprocess
+import sys
+import time
+from clean_fm import app_dir, store_path
+from utils_store import open_store
+from utils_search import SearchIndex
+
+
+search_path = app_dir + "/search_fm"
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        description="Full-text BM25 search over cleaned China FM content blocks")
+    argparser.add_argument("query", nargs="*", help="words to search for (English or Chinese)")
+    argparser.add_argument("--update", action="store_true",
+                           help="add blocks merged into the store since the last update")
+    argparser.add_argument("--rebuild", action="store_true",
+                           help="index the whole store again in a single segment")
+    argparser.add_argument("--merge", action="store_true",
+                           help="fold all segments into one, dropping deleted blocks (an update starts "
+                                "this in the background once there are too many segments)")
+    argparser.add_argument("--lang", default=None, choices=["English", "Chinese"])
+    argparser.add_argument("--start", default=None, help="first date, YYYY-MM-DD")
+    argparser.add_argument("--end", default=None, help="last date, YYYY-MM-DD")
+    argparser.add_argument("--spox", action="append", default=None,
+                           help="spokesperson label, e.g. 'HUA Chunying (华春莹)' (repeatable)")
+    argparser.add_argument("--type", action="append", default=None,
+                           help="type of remarks, e.g. 'Regular Press Conference' (repeatable)")
+    argparser.add_argument("--limit", type=int, default=10)
+    args = argparser.parse_args()
+
+    index = SearchIndex(search_path)
+    store_conn = open_store(store_path)
+    if args.update or args.rebuild:
+        print("blocks indexed:", index.update(store_conn, args.rebuild))
+        if index.needs_merge() and not args.merge:
+            # queries keep using the current segments until it is done
+            merger = subprocess.Popen([sys.executable, __file__, "--merge"], start_new_session=True)
+            print("merging %d segments in the background (pid %d)" % (len(index.segments), merger.pid))
+    if args.merge:
+        index.merge()
+    print("segments:", len(index.segments))
+
+    if args.query:
+        start = time.perf_counter()
+        hits = index.search(" ".join(args.query), args.lang, args.start, args.end,
+                            args.spox, args.type, args.limit)
+        print("%d hits in %.1f ms" % (len(hits), (time.perf_counter() - start) * 1000))
+        for hit in hits:
+            content = store_conn.execute(
+                "SELECT content FROM clean_fm WHERE url = ? AND lang = ? AND content_order = ?",
+                (hit['url'], hit['lang'], hit['content_order'])).fetchone()
+            print("%.2f %s %s %s" % (hit['score'], hit['date'], hit['spox'], hit['url']))
+            print("   ", (content[0] if content else "")[:150])
+    store_conn.close()
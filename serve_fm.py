@@ -0,0 +1,215 @@
+import argparse
+import json
+import sqlite3
+import threading
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from clean_fm import store_path
+from cube_fm import cube_path
+from index_fm import index_path
+from utils_cube import WordCube
+from utils_index import get_meta, search
+from utils_store import change_seq
+from utils_text import iter_responses, response_grouping, tokenize
+
+
+# local query API for the dashboard:
+#   GET /rows?start=2020-07-01&end=2020-07-31&spox=...&lang=English&filter=trade&page=1
+#   GET /words?start=...&end=...&lang=Chinese&remove=中国&min_freq=3&max_words=50
+# results are kept in an LRU cache keyed by the normalized query and dropped
+# whenever clean_fm.py writes to the store (rows are read from it) or
+# index_fm.py or cube_fm.py merges new data
+
+
+class QueryCache(object):
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.version = None
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            if version != self.version:
+                self.items.clear()
+                self.version = version
+                return(None)
+            if key in self.items:
+                self.items.move_to_end(key)
+                return(self.items[key])
+        return(None)
+
+    def put(self, key, version, value):
+        with self.lock:
+            if version != self.version:
+                return
+            self.items[key] = value
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+
+local = threading.local()
+cube_lock = threading.Lock()
+cube = None
+
+
+def connections():
+    # one read-only connection to each database per server thread
+    if not hasattr(local, 'index'):
+        local.index = sqlite3.connect("file:" + index_path + "?mode=ro", uri=True)
+        local.store = sqlite3.connect("file:" + store_path + "?mode=ro", uri=True)
+    return(local.index, local.store)
+
+
+def get_cube():
+    # one word cube for all threads, reloaded when cube_fm.py writes a new version
+    global cube
+    with cube_lock:
+        if cube is None:
+            cube = WordCube(cube_path)
+        cube.refresh()
+        return(cube)
+
+
+def normalize_query(params):
+    # same query, same cache key, whatever order or case the terms came in
+    def terms(name):
+        words = params.get(name, [])
+        if lang == "English":
+            words = [w.lower() for w in words]
+        return(tuple(sorted(set(w.strip() for w in words if w.strip() != ''))))
+
+    lang = params.get('lang', ["English"])[0]
+    return({
+        'lang': lang,
+        'start': params.get('start', ["0000-00-00"])[0],
+        'end': params.get('end', ["9999-99-99"])[0],
+        'spox': tuple(sorted(set(params.get('spox', [])))),
+        'filter': terms('filter'),
+        'match': params.get('match', ["any"])[0],
+        'remove': terms('remove'),
+        'page': int(params.get('page', ["1"])[0]),
+        'page_size': min(int(params.get('page_size', ["50"])[0]), 500),
+        'min_freq': int(params.get('min_freq', ["1"])[0]),
+        'max_words': int(params.get('max_words', ["300"])[0]),
+    })
+
+
+def matching_responses(index_conn, q):
+    # ids of live responses in the date range, spox and word filters, in date order
+    sql = ("SELECT id, url, grouping FROM responses "
+           "WHERE lang = ? AND live = 1 AND date >= ? AND date <= ?")
+    args = [q['lang'], q['start'], q['end']]
+    if q['spox']:
+        sql += " AND spox IN (%s)" % ",".join("?" * len(q['spox']))
+        args.extend(q['spox'])
+    rows = index_conn.execute(sql + " ORDER BY date, id", args).fetchall()
+    if q['filter']:
+        wanted = set(search(index_conn, q['lang'], q['filter'], q['match']))
+        rows = [r for r in rows if r[0] in wanted]
+    return(rows)
+
+
+def query_rows(q):
+    index_conn, store_conn = connections()
+    rows = matching_responses(index_conn, q)
+    first = (q['page'] - 1) * q['page_size']
+
+    out = []
+    for rid, url, grouping in rows[first:first + q['page_size']]:
+        meta = index_conn.execute(
+            "SELECT date, spox, type, title FROM responses WHERE id = ?", (rid,)).fetchone()
+        blocks = store_conn.execute(
+            "SELECT content_order, content_type, content FROM clean_fm "
+            "WHERE url = ? AND lang = ? AND content_order IN (?, ?) ORDER BY content_order",
+            (url, q['lang'], grouping, grouping + 1)).fetchall()
+        # questions are shown in bold, like the table in the app
+        content = "<br>".join(
+            "<strong>" + text + "</strong>" if ctype == "Q" else text
+            for order, ctype, text in blocks if response_grouping(order, ctype) == grouping)
+        out.append(dict(zip(['date', 'spox', 'type', 'title'], meta),
+                        url=url, response_id=rid, content=content))
+    return({'total': len(rows), 'page': q['page'], 'rows': out})
+
+
+def query_words(q):
+    # without a word filter the counts come from the cube's prefix sums
+    # instead of tokenizing every response in the range
+    if not q['filter']:
+        word_cube = get_cube()
+        if word_cube.manifest['version']:
+            words = word_cube.top_terms(q['lang'], q['start'], q['end'], q['spox'] or None,
+                                        remove=q['remove'], min_freq=q['min_freq'],
+                                        limit=q['max_words'])
+            return({'words': [{'word': w, 'freq': f} for w, f in words]})
+
+    index_conn, store_conn = connections()
+    wanted = set((url, grouping) for _, url, grouping in matching_responses(index_conn, q))
+
+    cols = ['lang', 'url', 'content_order', 'content_type', 'content', 'date', 'spox', 'type', 'title']
+    cur = store_conn.execute(
+        "SELECT " + ", ".join(cols) + " FROM clean_fm "
+        "WHERE lang = ? AND date >= ? AND date <= ? ORDER BY url, content_order",
+        (q['lang'], q['start'], q['end']))
+    counts = Counter()
+    for (lang, url, grouping), meta, text in iter_responses(dict(zip(cols, r)) for r in cur):
+        if (url, grouping) in wanted:
+            counts.update(tokenize(text, lang))
+
+    for word in q['remove']:
+        counts.pop(word, None)
+    words = [{'word': w, 'freq': f} for w, f in counts.most_common()
+             if f >= q['min_freq']][:q['max_words']]
+    return({'words': words})
+
+
+endpoints = {'/rows': query_rows, '/words': query_words}
+# the query parameters each endpoint depends on, so the cache key ignores the rest
+endpoint_params = {
+    '/rows': ['lang', 'start', 'end', 'spox', 'filter', 'match', 'page', 'page_size'],
+    '/words': ['lang', 'start', 'end', 'spox', 'filter', 'match', 'remove', 'min_freq', 'max_words'],
+}
+cache = QueryCache()
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        endpoint = endpoints.get(parsed.path)
+        if endpoint is None:
+            self.send_error(404)
+            return
+        try:
+            q = normalize_query(parse_qs(parsed.query))
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+
+        index_conn, store_conn = connections()
+        version = (change_seq(store_conn), get_meta(index_conn, 'version'), get_cube().manifest['version'])
+        key = (parsed.path,) + tuple(q[p] for p in endpoint_params[parsed.path])
+        result = cache.get(key, version)
+        if result is None:
+            result = json.dumps(endpoint(q), ensure_ascii=False).encode('utf-8')
+            cache.put(key, version, result)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(result)))
+        self.end_headers()
+        self.wfile.write(result)
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Serve queries over cleaned China FM statements")
+    argparser.add_argument("--host", default="127.0.0.1")
+    argparser.add_argument("--port", type=int, default=8765)
+    argparser.add_argument("--cache-size", type=int, default=256,
+                           help="number of query results kept in the LRU cache")
+    args = argparser.parse_args()
+
+    cache.maxsize = args.cache_size
+    server = ThreadingHTTPServer((args.host, args.port), QueryHandler)
+    print("serving on http://%s:%d" % (args.host, args.port))
+    server.serve_forever()
@@ -0,0 +1,14 @@
+import os
+import sys
+
+# the scripts and utils_*.py modules live at the top of the repo
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(tests_dir))
+
+
+def article(url, date, paragraphs, scrape_date="2020-07-28", spox="HUA Chunying (华春莹)", lang="English"):
+    # store rows in row_cols order, a question followed by its answers,
+    # numbered from 1 like utils_clean.iter_clean_rows
+    return([["Regular Press Conference on " + date, date, spox, "Regular Press Conference", url,
+             lang, scrape_date, text, order, "Q" if order == 1 else "A"]
+            for order, text in enumerate(paragraphs, 1)])
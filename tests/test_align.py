@@ -0,0 +1,27 @@
+from conftest import article
+from utils_align import open_align, update_alignments
+from utils_store import open_store, upsert_rows
+
+
+def alignments(conn):
+    return(conn.execute("SELECT * FROM alignments ORDER BY date, spox, pair").fetchall())
+
+
+def test_incremental_alignments_match_rebuild(tmp_path):
+    store = open_store(str(tmp_path / "clean_fm.sqlite"))
+    upsert_rows(store, article("en1", "2020-07-27", ["trade 2020?", "tariffs hurt 5 firms"]))
+    upsert_rows(store, article("ch1", "2020-07-27", ["贸易 2020?", "关税 5"], lang="Chinese"))
+    upsert_rows(store, article("en2", "2020-07-28", ["vaccine?", "vaccines help", "masks?", "masks help"]))
+    inc = open_align(str(tmp_path / "inc.sqlite"))
+    update_alignments(inc, store)
+
+    # an article moved to another day from an older scrape, and one losing blocks
+    upsert_rows(store, article("en1", "2020-07-26", ["trade 2020?", "tariffs hurt 5 firms"],
+                               scrape_date="2020-07-01"))
+    upsert_rows(store, article("en2", "2020-07-28", ["vaccine?", "vaccines help"], scrape_date="2020-07-29"))
+    update_alignments(inc, store)
+
+    full = open_align(str(tmp_path / "full.sqlite"))
+    update_alignments(full, store, rebuild=True)
+    assert alignments(inc) == alignments(full)
+    assert "2020-07-26" in [row[0] for row in alignments(inc)]
@@ -0,0 +1,47 @@
+import multiprocessing
+import os
+import sys
+from types import SimpleNamespace
+
+from conftest import tests_dir
+
+sys.path.insert(0, os.path.join(os.path.dirname(tests_dir), "chinafm_scraper"))
+from chinafm_scraper.archive import ResponseArchive
+
+
+def fake_response(url):
+    return(SimpleNamespace(url=url, status=200, headers={'Content-Type': b'text/html'},
+                           body=("<p>%s</p>" % url).encode('utf-8') * 50))
+
+
+def add_urls(dirpath, shard, n):
+    archive = ResponseArchive(dirpath)
+    for i in range(n):
+        archive.add(fake_response("https://example.org/%d/%d.shtml" % (shard, i)), False)
+    archive.close()
+
+
+def test_shards_share_one_archive(tmp_path):
+    # several backfill processes appending to the same responses.dat
+    dirpath = str(tmp_path / "archive")
+    ctx = multiprocessing.get_context("spawn")
+    procs = [ctx.Process(target=add_urls, args=(dirpath, shard, 200)) for shard in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+        assert p.exitcode == 0
+
+    archive = ResponseArchive(dirpath)
+    urls = archive.urls()
+    assert len(urls) == 800
+    for url, _ in urls:
+        header, body = archive.get(url)
+        assert header['url'] == url
+        assert body == fake_response(url).body
+
+    # the index rebuilt from the data file agrees
+    before = archive.conn.execute("SELECT url, offset, length FROM responses ORDER BY url").fetchall()
+    archive.rebuild_index()
+    assert archive.conn.execute("SELECT url, offset, length FROM responses ORDER BY url").fetchall() == before
+    archive.close()
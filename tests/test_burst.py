@@ -0,0 +1,70 @@
+import json
+import os
+
+import numpy as np
+
+from conftest import article
+from utils_burst import BurstState, open_bursts, write_bursts
+from utils_cube import WordCube, term_mask
+from utils_store import open_store, upsert_rows
+
+feed = dict(min_count=1, min_score=1.0, warmup=2)
+
+
+def statement(store, day, lang):
+    # the same remarks every day, until a new word takes over on the 20th
+    text = {"English": "trade cooperation partners", "Chinese": "贸易 合作 伙伴"}[lang]
+    if day >= 20:
+        text += {"English": " walrus walrus walrus", "Chinese": " 海象 海象 海象"}[lang]
+    date = "2020-07-%02d" % day
+    upsert_rows(store, article(lang + date, date, ["question?", text], lang=lang))
+
+
+def state_arrays(state):
+    state.flush()
+    return([state.slices, state.steps.tolist(), state.last_days.tolist()] +
+           [state.main[col].tolist() for col in ["keys", "s1", "s2", "last"]])
+
+
+def test_slices_fed_out_of_order(tmp_path):
+    store = open_store(str(tmp_path / "clean_fm.sqlite"))
+    cube = WordCube(str(tmp_path / "cube"))
+    bursts = open_bursts(str(tmp_path / "bursts.sqlite"))
+    state_dir = str(tmp_path / "state")
+
+    def run():
+        cube.update(store)
+        state = BurstState.load(state_dir, 30.0, cube)
+        since = state.fed_up_to()
+        found = state.update(cube, **feed)
+        write_bursts(bursts, found, since)
+        state.save(state_dir)
+        return(found)
+
+    for day in range(10, 20):
+        statement(store, day, "English")
+        statement(store, day, "Chinese")
+    run()
+    # the Chinese statement of the 21st is cleaned before the English one of the 20th
+    statement(store, 21, "Chinese")
+    run()
+    with open(os.path.join(state_dir, "state.json")) as f:
+        main = json.load(f)['main']
+    statement(store, 20, "English")
+    assert [(day, lang) for day, lang, _, _ in run()] == [("2020-07-20", "English")]
+
+    # the run wrote only the rows of the words said that day
+    with open(os.path.join(state_dir, "state.json")) as f:
+        meta = json.load(f)
+    assert meta['main'] == main
+    with np.load(os.path.join(state_dir, meta['deltas'][-1])) as f:
+        assert [str(cube.terms[k & term_mask]) for k in f['keys'].tolist()] == \
+            sorted(["question", "trade", "cooperation", "partners", "walrus"], key=cube.term_ids.get)
+
+    state = BurstState.load(state_dir, 30.0, cube)
+    full = BurstState()
+    full_bursts = open_bursts(str(tmp_path / "full.sqlite"))
+    write_bursts(full_bursts, full.update(cube, **feed))
+    assert state_arrays(state) == state_arrays(full)
+    query = "SELECT * FROM bursts ORDER BY date, lang, spox, rank"
+    assert bursts.execute(query).fetchall() == full_bursts.execute(query).fetchall()
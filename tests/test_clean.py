@@ -0,0 +1,24 @@
+from clean_fm import count_entry
+from utils_clean import clean_entry
+from utils_metrics import RunMetrics
+
+
+def test_lines_classified_before_merging():
+    entry = {
+        'title': ["Foreign Ministry Spokesperson Wang Wenbin's Regular Press Conference on July 27, 2020"],
+        'date': [None], 'url': "https://example.org/t1.shtml", 'lang': "English", 'scrape_date': "20200728",
+        'text': ["<p>Wang Wenbin: Good afternoon.</p>",
+                 "<p>Two events this week.</p>",
+                 "<p><b>Q: On trade?</b></p>",
+                 "<p>A: We oppose tariffs.</p>",
+                 "<p>They hurt both sides.</p>",
+                 "<p></p>"]}
+    out = clean_entry(entry)
+    # lines that start no new turn are merged into the block before them
+    assert out.content_type == ["A", "Q", "A"]
+    assert out.line_types == {"A": 2, "None": 2, "Q": 1}
+
+    metrics = RunMetrics()
+    count_entry(metrics, out)
+    assert metrics.counts[('lines', 'classified', 'None')] == 2
+    assert metrics.counts[('blocks', 'content_type', 'None')] == 0
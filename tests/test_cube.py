@@ -0,0 +1,40 @@
+import numpy as np
+
+from conftest import article
+from utils_cube import WordCube, day_bits, day_mask, term_bits, term_mask
+from utils_store import open_store, upsert_rows
+
+
+def cells(cube):
+    # {(slice, term, day): count}, independent of the ids a build handed out
+    keys = np.asarray(cube.keys).tolist()
+    counts = np.diff(np.asarray(cube.cum)).tolist()
+    terms = cube.terms.tolist()
+    return({(cube.slices[k >> (term_bits + day_bits)], terms[(k >> day_bits) & term_mask], k & day_mask): n
+            for k, n in zip(keys, counts)})
+
+
+def test_incremental_cube_matches_rebuild(tmp_path):
+    store = open_store(str(tmp_path / "clean_fm.sqlite"))
+    upsert_rows(store, article("u1", "2020-07-27", ["trade?", "tariffs hurt firms"]))
+    upsert_rows(store, article("u2", "2020-07-28", ["vaccine?", "vaccines help"]))
+    cube = WordCube(str(tmp_path / "inc"))
+    cube.update(store)
+
+    # a date override re-cleaned from an older scrape moves u1 to another day
+    upsert_rows(store, article("u1", "2020-07-26", ["trade?", "tariffs hurt firms"], scrape_date="2020-07-01"))
+    assert cube.update(store) == 2
+    version = cube.manifest['version']
+    assert cube.update(store) == 0
+    # rows without a date change the store but no day of the cube
+    rows = article("u3", "2020-07-29", ["question?", "answer"])
+    for row in rows:
+        row[1] = None
+    upsert_rows(store, rows)
+    assert cube.update(store) == 0
+    assert WordCube(str(tmp_path / "inc")).manifest['version'] == version
+
+    full = WordCube(str(tmp_path / "full"))
+    full.update(store, rebuild=True)
+    assert cells(cube) == cells(full)
+    assert cube.totals("English", "2020-07-27", "2020-07-27").sum() == 0
@@ -0,0 +1,21 @@
+from utils_date import DateNormalizer, get_date_normalizer, parse_date
+
+
+def test_missing_year_override_for_late_september():
+    # "September 20" used to take the " on ..." path and get the current year
+    normalizer = get_date_normalizer()
+    for day in [3, 19, 20, 29]:
+        title = "Foreign Ministry Spokesperson Geng Shuang's Regular Press Conference on September %d" % day
+        assert normalizer.normalize("https://example.org/t1.shtml", title) == "2018-09-%02d" % day
+
+
+def test_title_with_year():
+    normalizer = DateNormalizer([])
+    assert normalizer.title_date("Regular Press Conference on July 28, 2020") == "2020-07-28"
+    assert normalizer.title_date("Regular Press Conference on 28 July 2020") == "2020-07-28"
+
+
+def test_no_current_year_for_year_less_dates():
+    assert parse_date("March 20") is None
+    assert parse_date("20th of March") is None
+    assert DateNormalizer([]).title_date("Regular Press Conference on March 20") is None
@@ -0,0 +1,34 @@
+from conftest import article
+from utils_dedup import open_dedup, update_dedup
+from utils_store import open_store, upsert_rows
+
+answer = ("China firmly opposes the so-called sanctions announced by the United States and urges "
+          "the US side to immediately correct its mistakes, stop interfering in China's internal "
+          "affairs and stop going further down the wrong path.")
+
+
+def clusters(conn):
+    groups = {}
+    for url, order, cluster in conn.execute("SELECT url, content_order, cluster FROM blocks"):
+        groups.setdefault(cluster, set()).add((url, order))
+    return(sorted(sorted(g) for g in groups.values()))
+
+
+def test_cluster_survives_losing_its_representative(tmp_path):
+    store = open_store(str(tmp_path / "clean_fm.sqlite"))
+    for url in ["u1", "u2", "u3"]:
+        upsert_rows(store, article(url, "2020-07-28", ["sanctions?", answer]))
+    conn = open_dedup(str(tmp_path / "dedup.sqlite"))
+    update_dedup(conn, store)
+    assert [("u1", 2), ("u2", 2), ("u3", 2)] in clusters(conn)
+
+    # u1's answer was the one in the band buckets, the copies only matched it
+    upsert_rows(store, article("u1", "2020-07-28", ["sanctions?"]))
+    update_dedup(conn, store)
+    upsert_rows(store, article("u4", "2020-07-29", ["sanctions?", answer]))
+    update_dedup(conn, store)
+    assert [("u2", 2), ("u3", 2), ("u4", 2)] in clusters(conn)
+
+    full = open_dedup(str(tmp_path / "full.sqlite"))
+    update_dedup(full, store, rebuild=True)
+    assert clusters(conn) == clusters(full)
@@ -0,0 +1,85 @@
+import multiprocessing
+import os
+
+import pytest
+
+from conftest import article
+from utils_search import SearchIndex
+from utils_store import open_store, upsert_rows
+
+
+def live_blocks(index):
+    # (url, lang, content_order) of every live block, repeats included
+    return(sorted(seg.key(doc) for seg in index.segments for doc in seg.live.nonzero()[0]))
+
+
+def store_blocks(store):
+    return(sorted(store.execute(
+        "SELECT url, lang, content_order FROM clean_fm WHERE trim(content) != ''").fetchall()))
+
+
+def test_incremental_search_matches_rebuild(tmp_path):
+    store = open_store(str(tmp_path / "clean_fm.sqlite"))
+    upsert_rows(store, article("u1", "2020-07-27", ["trade?", "tariffs hurt", "walrus?", "walrus"]))
+    upsert_rows(store, article("u2", "2020-07-28", ["vaccine?", "vaccines help"]))
+    index = SearchIndex(str(tmp_path / "inc"))
+    assert index.update(store) == 6
+
+    # nothing changed: no segment and no deletion file is written again
+    files = sorted(os.listdir(str(tmp_path / "inc")))
+    assert index.update(store) == 0
+    assert sorted(os.listdir(str(tmp_path / "inc"))) == files
+
+    # re-cleaned from an older scrape, and an article that lost blocks
+    upsert_rows(store, article("u2", "2020-07-28", ["vaccine?", "vaccines help everyone"],
+                               scrape_date="2020-07-01"))
+    upsert_rows(store, article("u1", "2020-07-27", ["trade?", "tariffs hurt"], scrape_date="2020-07-29"))
+    assert index.update(store) == 4
+    assert [hit['url'] for hit in index.search("everyone")] == ["u2"]
+    assert index.search("walrus") == []
+
+    full = SearchIndex(str(tmp_path / "full"))
+    full.update(store, rebuild=True)
+    assert live_blocks(index) == live_blocks(full) == store_blocks(store)
+
+
+def update_and_merge(dirpath, store_path, rounds):
+    index = SearchIndex(dirpath)
+    store = open_store(store_path)
+    for _ in range(rounds):
+        index.update(store)
+        index.merge()
+        index.search("tariffs")
+    store.close()
+
+
+def test_concurrent_updates_and_merges(tmp_path):
+    store_path = str(tmp_path / "clean_fm.sqlite")
+    dirpath = str(tmp_path / "search")
+    store = open_store(store_path)
+    ctx = multiprocessing.get_context("spawn")
+    procs = [ctx.Process(target=update_and_merge, args=(dirpath, store_path, 20)) for _ in range(3)]
+    for p in procs:
+        p.start()
+    for i in range(60):
+        upsert_rows(store, article("u%d" % (i % 20), "2020-07-28", ["trade?", "tariffs %d" % i]))
+    for p in procs:
+        p.join()
+        assert p.exitcode == 0
+
+    index = SearchIndex(dirpath)
+    index.update(store)
+    assert live_blocks(index) == store_blocks(store)
+
+
+def test_missing_segment_file_raises(tmp_path):
+    store = open_store(str(tmp_path / "clean_fm.sqlite"))
+    upsert_rows(store, article("u1", "2020-07-27", ["trade?", "tariffs hurt"]))
+    dirpath = str(tmp_path / "search")
+    index = SearchIndex(dirpath)
+    index.update(store)
+
+    # the manifest still names the segment, so there is nothing newer to read
+    os.remove(os.path.join(dirpath, index.segments[0].name, "post_docs.npy"))
+    with pytest.raises(FileNotFoundError):
+        SearchIndex(dirpath)
@@ -0,0 +1,33 @@
+import json
+import threading
+from http.server import ThreadingHTTPServer
+from urllib.request import urlopen
+
+import serve_fm
+from conftest import article
+from utils_index import open_index, update_index
+from utils_store import open_store, upsert_rows
+
+
+def test_cached_rows_follow_the_store(tmp_path, monkeypatch):
+    store = open_store(str(tmp_path / "clean_fm.sqlite"))
+    upsert_rows(store, article("u1", "2020-07-27", ["trade?", "tariffs hurt"]))
+    index = open_index(str(tmp_path / "index_fm.sqlite"))
+    update_index(index, store)
+    monkeypatch.setattr(serve_fm, "store_path", str(tmp_path / "clean_fm.sqlite"))
+    monkeypatch.setattr(serve_fm, "index_path", str(tmp_path / "index_fm.sqlite"))
+    monkeypatch.setattr(serve_fm, "cube_path", str(tmp_path / "cube_fm"))
+    monkeypatch.setattr(serve_fm, "cube", None)
+    monkeypatch.setattr(serve_fm, "cache", serve_fm.QueryCache())
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), serve_fm.QueryHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%d/rows?lang=English" % server.server_address[1]
+    try:
+        assert "tariffs hurt" in json.load(urlopen(url))['rows'][0]['content']
+        # re-cleaned text, before index_fm.py runs again
+        upsert_rows(store, article("u1", "2020-07-27", ["trade?", "tariffs hurt firms"]))
+        assert "tariffs hurt firms" in json.load(urlopen(url))['rows'][0]['content']
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,66 @@
+from conftest import article
+from utils_index import decode_deltas, get_meta, open_index, update_index
+from utils_store import change_seq, changed_keys, open_store, upsert_rows
+
+
+def index_state(conn):
+    # live responses with their labels, and the (term, response) pairs
+    # pointing at them
+    live = {row[0]: row[1:] for row in conn.execute(
+        "SELECT id, url, grouping, hash, date, spox, type, title FROM responses WHERE live = 1")}
+    postings = set()
+    for term, blob in conn.execute("SELECT term, ids FROM postings"):
+        postings.update((term, live[i][:2]) for i in decode_deltas(blob) if i in live)
+    return(set(live.values()), postings)
+
+
+def test_change_log(tmp_path):
+    store = open_store(str(tmp_path / "clean_fm.sqlite"))
+    upsert_rows(store, article("u1", "2020-07-27", ["trade?", "tariffs hurt", "more tariffs"]))
+    seen = change_seq(store)
+    assert upsert_rows(store, article("u1", "2020-07-27", ["trade?", "tariffs hurt", "more tariffs"])) == 0
+    assert changed_keys(store, seen) == []
+
+    # moved to another day and lost a block, re-cleaned from an older scrape
+    upsert_rows(store, article("u1", "2020-07-28", ["trade?", "tariffs hurt"], scrape_date="2020-01-01"))
+    assert changed_keys(store, seen) == [("English", "u1")]
+    assert sorted(changed_keys(store, seen, "date")) == [("2020-07-27",), ("2020-07-28",)]
+
+
+def test_incremental_index_matches_rebuild(tmp_path):
+    store = open_store(str(tmp_path / "clean_fm.sqlite"))
+    upsert_rows(store, article("u1", "2020-07-27", ["trade?", "tariffs hurt", "walrus?", "walrus"],
+                               scrape_date="2020-07-27"))
+    upsert_rows(store, article("u2", "2020-07-28", ["vaccine?", "vaccines help"]))
+    inc = open_index(str(tmp_path / "inc.sqlite"))
+    update_index(inc, store)
+
+    # an older scrape re-cleaned with new text: no row gets a newer scrape date
+    upsert_rows(store, article("u2", "2020-07-28", ["vaccine?", "vaccines help everyone"],
+                               scrape_date="2020-07-27"))
+    # a newer scrape of an article that lost blocks: the rows left are unchanged
+    upsert_rows(store, article("u1", "2020-07-27", ["trade?", "tariffs hurt"], scrape_date="2020-07-29"))
+    update_index(inc, store)
+
+    full = open_index(str(tmp_path / "full.sqlite"))
+    update_index(full, store, rebuild=True)
+    assert index_state(inc) == index_state(full)
+
+
+def test_index_follows_moved_labels(tmp_path):
+    store = open_store(str(tmp_path / "clean_fm.sqlite"))
+    upsert_rows(store, article("u1", "2020-07-26", ["trade?", "tariffs hurt"]))
+    inc = open_index(str(tmp_path / "inc.sqlite"))
+    update_index(inc, store)
+    version = get_meta(inc, 'version')
+
+    # same text, another day and spokesperson
+    upsert_rows(store, article("u1", "2020-07-27", ["trade?", "tariffs hurt"], spox="GENG Shuang (耿爽)"))
+    assert update_index(inc, store) == 0
+    assert get_meta(inc, 'version') != version
+    assert inc.execute("SELECT DISTINCT date, spox FROM responses WHERE live = 1").fetchall() == [
+        ("2020-07-27", "GENG Shuang (耿爽)")]
+
+    full = open_index(str(tmp_path / "full.sqlite"))
+    update_index(full, store, rebuild=True)
+    assert index_state(inc) == index_state(full)
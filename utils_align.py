@@ -0,0 +1,207 @@
+import csv
+import hashlib
+import os
+import re
+import sqlite3
+from utils_date import months
+from utils_index import get_change_seq, set_meta
+from utils_store import change_seq, changed_keys
+from utils_text import data_dir, iter_responses
+
+
+# Chinese/English response alignment. Responses are partitioned by (date,
+# spox); inside a partition each language keeps its order, and a banded
+# dynamic program pairs responses by a cheap similarity score (shared numbers,
+# shared named entities, length ratio), leaving a response unpaired when
+# nothing on the other side is close enough
+
+en_per_ch = 3.0      # English characters per Chinese character, roughly
+min_similarity = 0.35
+band = 4             # how far off the diagonal the alignment may wander
+
+entities_file = os.path.join(data_dir, "entities.csv")
+number_re = re.compile(r"\d+(?:[.,]\d+)*")
+acronym_re = re.compile(r"\b[A-Z][A-Z0-9-]+\b")
+month_re = re.compile(r"\b(" + "|".join(m.capitalize() for m in sorted(months, key=len, reverse=True)) + r")\b")
+fullwidth_digits = str.maketrans("０１２３４５６７８９", "0123456789")
+
+
+def load_entities(fname=entities_file):
+    # {lang: {name: entity id}}, several names may share an id
+    names = {'English': {}, 'Chinese': {}}
+    with open(fname, 'rt', encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            names['English'][row['en']] = row['id']
+            names['Chinese'][row['ch']] = row['id']
+    return(names)
+
+
+class Features(object):
+    def __init__(self, fname=entities_file):
+        self.names = load_entities(fname)
+        self.patterns = {
+            lang: re.compile("|".join(re.escape(n) for n in sorted(names, key=len, reverse=True)))
+            for lang, names in self.names.items()}
+
+    def __call__(self, text, lang):
+        # (length in characters, numbers, entities)
+        if lang == "Chinese":
+            text = text.translate(fullwidth_digits)
+        numbers = set(n.replace(",", "") for n in number_re.findall(text))
+        names = self.names[lang]
+        entities = set(names[m.group()] for m in self.patterns[lang].finditer(text))
+        # acronyms (WHO, G20, COVID-19) are written the same in both languages
+        entities.update(acronym_re.findall(text))
+        if lang == "English":
+            numbers.update(str(months[m.lower()]) for m in month_re.findall(text))
+            length = len(text)
+        else:
+            length = len(text.replace(" ", "")) * en_per_ch
+        return(length, numbers, entities)
+
+
+def similarity(ch, en):
+    # weighted mean of the signals; a set signal only counts when either
+    # side has something in it
+    score = 0.4 * min(ch[0], en[0]) / max(ch[0], en[0], 1)
+    weight = 0.4
+    for a, b in [(ch[1], en[1]), (ch[2], en[2])]:
+        if a or b:
+            score += 0.3 * len(a & b) / len(a | b)
+            weight += 0.3
+    return(score / weight)
+
+
+def align(ch, en):
+    # ch and en are lists of features in document order; returns
+    # [(ch index or None, en index or None, score)] covering both sides.
+    # only cells within `band` of the diagonal are filled, so the work is
+    # linear in the partition size
+    n, m = len(ch), len(en)
+    width = band + abs(n - m)
+
+    def window(i):
+        centre = i * m // n if n else 0
+        return(max(0, centre - width), min(m, centre + width))
+
+    best = {(0, 0): (0.0, None)}
+    for i in range(n + 1):
+        lo, hi = window(i)
+        for j in range(lo, hi + 1):
+            if i == 0 and j == 0:
+                continue
+            options = []
+            if i > 0 and (i - 1, j) in best:
+                options.append((best[(i - 1, j)][0], 'ch'))
+            if j > 0 and (i, j - 1) in best:
+                options.append((best[(i, j - 1)][0], 'en'))
+            if i > 0 and j > 0 and (i - 1, j - 1) in best:
+                sim = similarity(ch[i - 1], en[j - 1])
+                if sim >= min_similarity:
+                    options.append((best[(i - 1, j - 1)][0] + sim - min_similarity, ('pair', sim)))
+            if options:
+                best[(i, j)] = max(options, key=lambda o: o[0])
+
+    pairs = []
+    i, j = n, m
+    while (i, j) != (0, 0):
+        move = best[(i, j)][1]
+        if move == 'ch':
+            i -= 1
+            pairs.append((i, None, None))
+        elif move == 'en':
+            j -= 1
+            pairs.append((None, j, None))
+        else:
+            i -= 1
+            j -= 1
+            pairs.append((i, j, move[1]))
+    pairs.reverse()
+    return(pairs)
+
+
+def open_align(path):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS alignments ("
+        "date TEXT, spox TEXT, pair INTEGER, ch_url TEXT, ch_grouping INTEGER, "
+        "en_url TEXT, en_grouping INTEGER, score REAL, "
+        "PRIMARY KEY (date, spox, pair)) WITHOUT ROWID")
+    conn.execute("CREATE INDEX IF NOT EXISTS alignments_ch ON alignments (ch_url)")
+    conn.execute("CREATE INDEX IF NOT EXISTS alignments_en ON alignments (en_url)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS partitions ("
+        "date TEXT, spox TEXT, digest TEXT, PRIMARY KEY (date, spox)) WITHOUT ROWID")
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.commit()
+    return(conn)
+
+
+def touched_partitions(store_conn, since=None):
+    # (date, spox) of every partition with rows added, changed or removed
+    # after change sequence `since` (all partitions when None), including the
+    # ones rows moved out of when their date or spox changed
+    if since is None:
+        partitions = store_conn.execute("SELECT DISTINCT date, spox FROM clean_fm").fetchall()
+    else:
+        partitions = changed_keys(store_conn, since, "date, spox")
+    return(set(p for p in partitions if p[0] is not None and p[1] is not None))
+
+
+def partition_responses(store_conn, date, spox):
+    # {lang: [(url, grouping, type, text)]} in document order
+    cols = ['lang', 'url', 'content_order', 'content_type', 'content', 'date', 'spox', 'type', 'title']
+    cur = store_conn.execute(
+        "SELECT " + ", ".join(cols) + " FROM clean_fm WHERE date = ? AND spox = ? "
+        "ORDER BY lang, url, content_order", (date, spox))
+    out = {'English': [], 'Chinese': []}
+    for (lang, url, grouping), meta, text in iter_responses(dict(zip(cols, r)) for r in cur):
+        if text.strip() != '':
+            out[lang].append((url, grouping, meta['type'], text))
+    for responses in out.values():
+        # both languages put the same kind of statement in the same place
+        responses.sort(key=lambda r: (r[2], r[0], r[1]))
+    return(out)
+
+
+def update_alignments(conn, store_conn, rebuild=False, features=None):
+    # re-align only the partitions new data touched; returns how many changed
+    if rebuild:
+        conn.execute("DELETE FROM alignments")
+        conn.execute("DELETE FROM partitions")
+        conn.execute("DELETE FROM meta WHERE key = 'change_seq'")
+    features = features or Features()
+    since = get_change_seq(conn)
+    newest = change_seq(store_conn)
+
+    changed = 0
+    for date, spox in sorted(touched_partitions(store_conn, since)):
+        responses = partition_responses(store_conn, date, spox)
+        digest = hashlib.sha1(repr(sorted(responses.items())).encode('utf-8')).hexdigest()
+        old = conn.execute(
+            "SELECT digest FROM partitions WHERE date = ? AND spox = ?", (date, spox)).fetchone()
+        if old is not None and old[0] == digest:
+            continue
+
+        conn.execute("DELETE FROM alignments WHERE date = ? AND spox = ?", (date, spox))
+        ch, en = responses['Chinese'], responses['English']
+        if not ch and not en:
+            conn.execute("DELETE FROM partitions WHERE date = ? AND spox = ?", (date, spox))
+            changed += 1
+            continue
+        pairs = align([features(r[3], 'Chinese') for r in ch], [features(r[3], 'English') for r in en])
+        conn.executemany(
+            "INSERT INTO alignments VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(date, spox, k,
+              None if i is None else ch[i][0], None if i is None else ch[i][1],
+              None if j is None else en[j][0], None if j is None else en[j][1], score)
+             for k, (i, j, score) in enumerate(pairs)])
+        conn.execute(
+            "INSERT INTO partitions VALUES (?, ?, ?) ON CONFLICT(date, spox) "
+            "DO UPDATE SET digest = excluded.digest", (date, spox, digest))
+        changed += 1
+
+    set_meta(conn, 'change_seq', newest)
+    conn.commit()
+    return(changed)
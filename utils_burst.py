@@ -0,0 +1,280 @@
+import json
+import os
+import sqlite3
+import numpy as np
+from datetime import date
+from utils_cube import day_bits, day_mask, term_bits, term_mask
+from utils_files import remove_unlisted, write_atomic
+
+
+# streaming word statistics per (lang, spox) slice, for spotting words that
+# suddenly come up far more than usual. every day a slice has statements is
+# one step, and a word's value on a step is its share of the words said that
+# day. the state per (slice, word) is an exponentially weighted mean of that
+# share and of its square as of the last step the word occurred on: the steps
+# in between only multiply both by the decay, so a new day updates the words
+# it contains and nothing else. a word bursts when its share is many standard
+# deviations above its weighted mean.
+#
+# words are stored under the cube's term ids and kept sorted by
+# slice << term_bits | term, in a main set of arrays and a small tail that
+# takes every word a day updates, shadowing its row in main, until it is
+# worth merging. on disk main is a directory of .npy files opened
+# memory-mapped and only rewritten by a merge; each run adds a delta file
+# with the rows it updated, and the tail is those deltas read back in order
+
+state_cols = ['keys', 's1', 's2', 'last']
+max_deltas = 32      # delta files kept before they are merged into main
+
+
+def empty_level():
+    return({'keys': np.zeros(0, np.int64), 's1': np.zeros(0), 's2': np.zeros(0),
+            'last': np.zeros(0, np.int32)})
+
+
+def find(level, keys):
+    # insert positions of sorted keys in a level, and which are already there
+    pos = np.searchsorted(level['keys'], keys)
+    found = pos < len(level['keys'])
+    found[found] = level['keys'][pos[found]] == keys[found]
+    return(pos, found)
+
+
+def overlay(base, top):
+    # the rows of both levels, top's where a key is in both
+    _, shadowed = find(top, np.asarray(base['keys']))
+    base = {col: np.asarray(base[col])[~shadowed] for col in state_cols}
+    at = np.searchsorted(base['keys'], top['keys'])
+    return({col: np.insert(base[col], at, top[col]) for col in state_cols})
+
+
+class BurstState(object):
+    def __init__(self, half_life=30.0):
+        self.half_life = half_life
+        self.decay = 0.5 ** (1 / half_life)
+        self.slices = []
+        self.steps = np.zeros(0, np.int32)
+        self.last_days = np.zeros(0, np.int32)  # last day fed, per slice
+        # the cube's term ids and the cube version fed up to
+        self.cube_ids = None
+        self.cube_version = None
+        self.main = empty_level()
+        self.tail = empty_level()
+        self.touched = []   # keys updated since the last save
+        self.main_name = None   # on-disk main arrays, None once merged in memory
+        self.deltas = []
+        self.next = 1
+
+    @classmethod
+    def load(cls, dirpath, half_life=30.0, cube=None):
+        # a missing state is a fresh one; a different half-life means the
+        # stored averages mean something else, and a rebuilt cube gave the
+        # words other ids, so start over for those too
+        state = cls(half_life)
+        meta_path = os.path.join(dirpath, "state.json")
+        if not os.path.exists(meta_path):
+            return(state)
+        with open(meta_path, 'rt', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta['half_life'] != half_life:
+            return(state)
+        if cube is not None and meta['cube_ids'] != cube.manifest.get('ids_version'):
+            return(state)
+        state.slices = [tuple(s) for s in meta['slices']]
+        state.steps = np.array(meta['steps'], np.int32)
+        state.last_days = np.array(meta['last_days'], np.int32)
+        state.cube_ids, state.cube_version = meta['cube_ids'], meta['cube_version']
+        state.main_name, state.deltas, state.next = meta['main'], meta['deltas'], meta['next']
+        state.main = {col: np.load(os.path.join(dirpath, state.main_name, col + ".npy"), mmap_mode='r')
+                      for col in state_cols}
+        for name in state.deltas:
+            with np.load(os.path.join(dirpath, name)) as f:
+                state.tail = overlay(state.tail, {col: f[col] for col in state_cols})
+        return(state)
+
+    def save(self, dirpath):
+        # main only when a merge changed it, else a delta with the rows
+        # updated since the last save
+        os.makedirs(dirpath, exist_ok=True)
+        if len(self.deltas) >= max_deltas:
+            self.flush()
+        if self.main_name is None:
+            self.main_name = self.new_name(dirpath, "main_%06d")
+            os.makedirs(os.path.join(dirpath, self.main_name))
+            for col in state_cols:
+                np.save(os.path.join(dirpath, self.main_name, col + ".npy"), self.main[col])
+            self.deltas = []
+        if self.touched:
+            keys = np.unique(np.concatenate(self.touched))
+            pos = np.searchsorted(self.tail['keys'], keys)
+            name = self.new_name(dirpath, "delta_%06d.npz")
+            np.savez(os.path.join(dirpath, name), **{col: self.tail[col][pos] for col in state_cols})
+            self.deltas.append(name)
+            self.touched = []
+        meta = {'half_life': self.half_life, 'slices': [list(s) for s in self.slices],
+                'steps': self.steps.tolist(), 'last_days': self.last_days.tolist(),
+                'cube_ids': self.cube_ids, 'cube_version': self.cube_version,
+                'main': self.main_name, 'deltas': self.deltas, 'next': self.next}
+        write_atomic(os.path.join(dirpath, "state.json"), json.dumps(meta, ensure_ascii=False))
+        remove_unlisted(dirpath, "main_", [self.main_name])
+        remove_unlisted(dirpath, "delta_", self.deltas)
+
+    def new_name(self, dirpath, pattern):
+        # never one a reader may still have open, even for a fresh state
+        # saved over an old one
+        while os.path.exists(os.path.join(dirpath, pattern % self.next)):
+            self.next += 1
+        self.next += 1
+        return(pattern % (self.next - 1))
+
+    def flush(self):
+        # merge the tail into main; the rows it updated since the last save
+        # are in the new main, so the next save writes no delta
+        if len(self.tail['keys']):
+            self.main = overlay(self.main, self.tail)
+            self.tail = empty_level()
+            self.main_name = None
+            self.touched = []
+
+    def slice_id(self, lang, spox):
+        key = (lang, spox)
+        if key not in self.slices:
+            self.slices.append(key)
+            self.steps = np.append(self.steps, np.int32(0))
+            self.last_days = np.append(self.last_days, np.int32(0))
+        return(self.slices.index(key))
+
+    def fed_up_to(self):
+        # {(lang, spox): last day fed} as ISO dates
+        return({key: date.fromordinal(int(day)).isoformat()
+                for key, day in zip(self.slices, self.last_days.tolist()) if day})
+
+    def update(self, cube, min_count=3, min_score=3.0, warmup=5, limit=20):
+        # feed every slice the days the cube has after the last one that
+        # slice was fed, in order, so a slice whose day is cleaned after a
+        # later day of another slice still gets it. only the cells of days
+        # the cube recounted since the version last fed are looked at, or
+        # every cell when its log does not reach back that far. days changed
+        # in the cube after they were fed are not fed again (rebuild the
+        # state for that); returns the bursts as
+        # [(date, lang, spox, [(term, count, expected, score)])]
+        ids = cube.manifest.get('ids_version')
+        if self.cube_ids is not None and ids != self.cube_ids:
+            raise ValueError("the word cube was rebuilt with new term ids, start a new state")
+        changed = None if self.cube_version is None else cube.changes(self.cube_version)
+        if changed is None:
+            keys = np.asarray(cube.keys)
+        else:
+            keys, counts = changed
+        self.cube_ids, self.cube_version = ids, cube.manifest['version']
+        days = keys & day_mask
+        slice_map = np.array([self.slice_id(lang, spox) for lang, spox, _ in cube.slices], np.int64)
+        slices = slice_map[keys >> (term_bits + day_bits)] if len(keys) else np.zeros(0, np.int64)
+        new = np.flatnonzero(days > self.last_days[slices])
+        if not len(new):
+            return([])
+        new = new[np.argsort(days[new], kind='stable')]
+        if changed is None:
+            counts = cube.cum[new + 1] - cube.cum[new]
+        else:
+            counts = counts[new]
+        counts = np.asarray(counts, np.float64)
+        cells = (slices[new] << term_bits) | ((keys[new] >> day_bits) & term_mask)
+        days = days[new]
+
+        bursts = []
+        bounds = np.flatnonzero(np.r_[True, days[1:] != days[:-1], True])
+        for i, j in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            day = date.fromordinal(int(days[i])).isoformat()
+            for s, found in self.add_day(cells[i:j], counts[i:j], cube.terms,
+                                         min_count, min_score, warmup, limit):
+                bursts.append((day, self.slices[s][0], self.slices[s][1], found))
+        np.maximum.at(self.last_days, slices[new], days.astype(np.int32))
+        return(bursts)
+
+    def add_day(self, cells, counts, terms, min_count, min_score, warmup, limit):
+        # one step for every slice with statements on the day
+        # types of remarks on the same day fold into one count per word
+        keys, inv = np.unique(cells, return_inverse=True)
+        counts = np.bincount(inv, weights=counts)
+        slices = keys >> term_bits
+        totals = np.bincount(slices, weights=counts, minlength=len(self.slices))
+        self.steps[totals > 0] += 1
+        step = self.steps[slices]
+        total = totals[slices]
+
+        # last seen state of each word, zero for new ones; the tail's rows
+        # are newer than main's
+        s1, s2 = np.zeros(len(keys)), np.zeros(len(keys))
+        last = np.zeros(len(keys), np.int32)
+        pos, found = find(self.main, keys)
+        for col, values in [('s1', s1), ('s2', s2), ('last', last)]:
+            values[found] = self.main[col][pos[found]]
+        tail_pos, in_tail = find(self.tail, keys)
+        for col, values in [('s1', s1), ('s2', s2), ('last', last)]:
+            values[in_tail] = self.tail[col][tail_pos[in_tail]]
+
+        # the averages before today, decayed over the steps the word missed
+        # and scaled up for the weight the slice's history does not have yet
+        # (the averages start at zero)
+        x = counts / total
+        gone = self.decay ** (step - 1 - last)
+        weight = 1 - self.decay ** (step - 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(weight > 0, s1 * gone / weight, 0)
+            var = np.maximum(np.where(weight > 0, s2 * gone / weight, 0) - mean ** 2, 0)
+        # at least one more mention of the word than expected, so a word
+        # that always had the same share is not infinitely surprising
+        score = (x - mean) / np.sqrt(var + (1 / total) ** 2)
+
+        s1 = self.decay * s1 * gone + (1 - self.decay) * x
+        s2 = self.decay * s2 * gone + (1 - self.decay) * x ** 2
+        # every updated word goes to the tail; main stays as it was loaded
+        for col, values in [('s1', s1), ('s2', s2), ('last', step)]:
+            self.tail[col][tail_pos[in_tail]] = values[in_tail]
+        added = ~in_tail
+        for col, values in [('keys', keys), ('s1', s1), ('s2', s2), ('last', step)]:
+            self.tail[col] = np.insert(self.tail[col], tail_pos[added],
+                                       values[added].astype(self.tail[col].dtype))
+        self.touched.append(keys)
+        if len(self.tail['keys']) > max(4096, len(self.main['keys']) // 8):
+            self.flush()
+
+        out = []
+        hits = np.flatnonzero((counts >= min_count) & (score >= min_score) & (step > warmup))
+        for s in np.unique(slices[hits]).tolist():
+            top = hits[slices[hits] == s]
+            top = top[np.lexsort((keys[top], -score[top]))][:limit]
+            out.append((s, [(str(terms[keys[t] & term_mask]), int(counts[t]),
+                             float(mean[t] * total[t]), float(score[t])) for t in top.tolist()]))
+        return(out)
+
+
+def open_bursts(path):
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS bursts ("
+        "date TEXT, lang TEXT, spox TEXT, rank INTEGER, term TEXT, "
+        "count INTEGER, expected REAL, score REAL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS bursts_date ON bursts (date, lang)")
+    conn.commit()
+    return(conn)
+
+
+def write_bursts(conn, bursts, since=None):
+    # replaces whatever the table has after the day each slice's state had
+    # reached (since is BurstState.fed_up_to() from before the update; all of
+    # a slice not in it, and everything for None), in case an earlier run
+    # wrote those days and stopped before saving its state
+    if since is None:
+        conn.execute("DELETE FROM bursts")
+    else:
+        for lang, spox in conn.execute("SELECT DISTINCT lang, spox FROM bursts").fetchall():
+            conn.execute("DELETE FROM bursts WHERE lang = ? AND spox = ? AND date > ?",
+                         (lang, spox, since.get((lang, spox), "")))
+    conn.executemany(
+        "INSERT INTO bursts VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        ((day, lang, spox, rank, term, count, expected, score)
+         for day, lang, spox, found in bursts
+         for rank, (term, count, expected, score) in enumerate(found, 1)))
+    conn.commit()
@@ -1,9 +1,171 @@
+import html
 import json
-import pandas as pd
 import re
 import csv
+import sys
+from array import array
 from datetime import datetime
-from dateutil import parser
+from functools import lru_cache
+from itertools import islice
+from utils_date import get_date_normalizer
+from utils_spox import get_spox_matcher
+
+
+# columns of one cleaned row, in the order they are written out
+row_cols = ['title', 'date', 'spox', 'type', 'url', 'lang', 'scrape_date',
+            'content', 'content_order', 'content_type']
+
+# the per-entry part of a row, shared by all of an entry's blocks
+entry_cols = row_cols[:7]
+
+# values from a small set that repeat on every entry
+interned_cols = ['date', 'spox', 'type', 'lang', 'scrape_date']
+
+
+class CleanEntry(object):
+    # one cleaned scrape entry: its metadata once, and its blocks as parallel
+    # lists of content, content_order and content_type; line_types counts the
+    # non-empty lines classified Q, A and None before they were merged
+    __slots__ = row_cols + ['line_types']
+
+    def __init__(self, *values, line_types=None):
+        for col, value in zip(row_cols, values):
+            setattr(self, col, value)
+        self.line_types = line_types or {}
+
+    def intern(self):
+        # share one copy of each repeated value, e.g. after unpickling from
+        # a worker process
+        for col in interned_cols:
+            value = getattr(self, col)
+            if value is not None:
+                setattr(self, col, sys.intern(value))
+        return(self)
+
+
+class BlockTable(object):
+    # cleaned blocks of many entries in columns: each entry's metadata is one
+    # tuple in entries, which blocks point to by id, and content types are
+    # one-byte codes, so only the content strings grow with the row count
+    __slots__ = ['entries', 'entry_id', 'content', 'content_order', 'content_type', 'type_codes']
+
+    def __init__(self):
+        self.entries = []
+        self.entry_id = array('i')
+        self.content = []
+        self.content_order = array('i')
+        self.content_type = array('b')
+        self.type_codes = {}
+
+    def __len__(self):
+        return(len(self.content))
+
+    def add(self, out):
+        entry_id = len(self.entries)
+        self.entries.append(tuple(getattr(out, col) for col in entry_cols))
+        self.entry_id.extend([entry_id] * len(out.content))
+        self.content.extend(out.content)
+        self.content_order.extend(out.content_order)
+        self.content_type.extend(self.type_codes.setdefault(t, len(self.type_codes))
+                                 for t in out.content_type)
+
+    def rows(self):
+        # one list per block in row_cols order, built as it is consumed
+        content_types = list(self.type_codes)
+        for i, content in enumerate(self.content):
+            row = list(self.entries[self.entry_id[i]])
+            row.extend([content, self.content_order[i], content_types[self.content_type[i]]])
+            yield(row)
+
+    def frame(self):
+        # the blocks as a data frame, with the entry columns and content_type
+        # as categoricals
+        import numpy as np
+        import pandas as pd
+
+        ids = np.frombuffer(self.entry_id, np.int32)
+        columns = {}
+        for j, col in enumerate(entry_cols):
+            levels = {}
+            codes = np.array([-1 if e[j] is None else levels.setdefault(e[j], len(levels))
+                              for e in self.entries], np.int32)
+            columns[col] = pd.Categorical.from_codes(codes[ids], categories=list(levels))
+        columns['content'] = self.content
+        columns['content_order'] = np.frombuffer(self.content_order, np.int32)
+        columns['content_type'] = pd.Categorical.from_codes(
+            np.frombuffer(self.content_type, np.int8), categories=list(self.type_codes))
+        return(pd.DataFrame(columns, columns=row_cols))
+
+
+def iter_raw_lines(fname, start=0, offsets=False, chunk_size=1 << 16):
+    # decompress incrementally so a truncated .gz/.zst from a crashed crawl
+    # still gives back every complete line before the point it was cut off.
+    # start is an offset into the decompressed data; with offsets each line
+    # comes with the offset just past its newline, and an unterminated last
+    # line is held back since the crawl may still be writing it
+    if fname.endswith('.gz'):
+        import zlib
+        new_decompressor = lambda: zlib.decompressobj(wbits=31)
+    elif fname.endswith('.zst'):
+        import zstandard
+        new_decompressor = zstandard.ZstdDecompressor().decompressobj
+    else:
+        new_decompressor = None
+
+    buffer = b''
+    pos = start
+    with open(fname, 'rb') as f:
+        decompressor = new_decompressor() if new_decompressor else None
+        # compressed data can only be skipped by decompressing it
+        skip = start if decompressor is not None else 0
+        if decompressor is None:
+            f.seek(start)
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            if decompressor is not None:
+                data = b''
+                # appended runs leave several gzip members / zstd frames
+                while chunk:
+                    data += decompressor.decompress(chunk)
+                    if not decompressor.eof:
+                        break
+                    chunk = decompressor.unused_data
+                    decompressor = new_decompressor()
+                chunk = data
+            if skip:
+                chunk, skip = chunk[skip:], max(0, skip - len(chunk))
+            lines = (buffer + chunk).split(b'\n')
+            buffer = lines.pop()
+            for line in lines:
+                pos += len(line) + 1
+                yield((line, pos) if offsets else line)
+    if buffer and not offsets:
+        yield(buffer)
+
+
+def read_raw_entries(fname, start=0, offsets=False):
+    # old JSON array output has to be loaded whole
+    if fname.endswith('.json'):
+        with open(fname, 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+        yield from data
+        return
+
+    # JSON Lines output (optionally .gz/.zst) is read one record at a time,
+    # as (entry, offset past it) pairs with offsets
+    for line in iter_raw_lines(fname, start, offsets):
+        if offsets:
+            line, offset = line
+        if line.strip() == b'':
+            continue
+        try:
+            entry = json.loads(line.decode('utf-8'))
+        except ValueError:
+            # a crawl that died mid-write leaves a truncated last line
+            continue
+        yield((entry, offset) if offsets else entry)
 
 
 def check_answer(clean_remarks, spox, ch=True):
@@ -36,6 +198,55 @@ def get_clean_remarks(remarks):
     return(clean, question_flag)
 
 
+# precompiled patterns for classify_line; stripping tags with a plain
+# replacement string keeps the substitution in C, which is faster than a
+# callback that also checks for bold tags
+tags_re = re.compile('<[^>\\n]*>|[<>\\u3000]')
+bold_re = re.compile('</(?:b|strong)>', re.IGNORECASE)
+entity_re = re.compile('&#?\\w+;')
+
+
+@lru_cache(maxsize=None)
+def line_prefix_re(spox, ch=True):
+    # speaker turn and answer prefixes for one spox, compiled once; the turn
+    # check sits in a lookahead so both flags come out of a single match
+    if ch:
+        turn = "[\\u4e00-\\u9fff]{1,15}："
+        answer = "答：|" + re.escape(spox) + "："
+    else:
+        turn = "[A-Za-z ]{1,30}:"
+        answer = "A:|" + re.escape(spox) + ":"
+    return(re.compile("(?:(?=(" + turn + "))|)(" + answer + ")?"))
+
+
+def classify_text(clean, question_flag, spox, ch=True):
+    # flag a line that is already plain text;
+    # returns (text, is_question, is_answer, is_speaker_turn)
+    if clean == '':
+        return(clean, question_flag, False, False)
+
+    turn, answer = line_prefix_re(spox, ch).match(clean).group(1, 2)
+    return(clean, question_flag, answer is not None, turn is not None)
+
+
+def classify_line(remarks, spox, ch=True):
+    # strip tags and entities, normalize whitespace and flag the line
+    question_flag = bold_re.search(remarks) is not None
+    clean = tags_re.sub('', remarks)
+    if '&' in clean:
+        clean = entity_re.sub(lambda m: html.unescape(m.group()), clean)
+    return(classify_text(' '.join(clean.split()), question_flag, spox, ch))
+
+
+def classify_entry(scraped_entry, spox, ch=True):
+    # the spider now sends plain text with a bold flag per line; older files
+    # have the raw <p> html, which still needs its tags stripped
+    if 'bold' in scraped_entry:
+        return(classify_text(' '.join(line.replace('\u3000', '').split()), bool(bold), spox, ch)
+               for line, bold in zip(scraped_entry['text'], scraped_entry['bold']))
+    return(classify_line(line, spox, ch) for line in scraped_entry['text'])
+
+
 def get_clean_type(scraped_entry, ch=True):
     titleraw = scraped_entry['title'][0]
 
@@ -54,53 +265,122 @@ def get_clean_type(scraped_entry, ch=True):
 
 
 def get_clean_date(scraped_entry, ch=True):
+    # English pages have no date field, so it comes from the title
+    dateraw = scraped_entry['date'][0] if ch else None
+    return(get_date_normalizer().normalize(scraped_entry['url'], scraped_entry['title'][0], dateraw))
+
+
+def get_clean_spox(scraped_entry, ch=True, date=None):
     titleraw = scraped_entry['title'][0]
-    dateraw = scraped_entry['date'][0]
+    matcher = get_spox_matcher()
 
-    if ch:
-        return(dateraw)
-    else:
-        datestring = re.findall("(?<= on )(.*)(?=)", titleraw)
-        clean_date = None
-        if len(datestring) > 0:
-            if "20" in datestring[0]:
-                clean_date = datestring[0]
-                clean_date = parser.parse(clean_date).strftime("%Y-%m-%d")
-        return(clean_date)
+    found = matcher.match(titleraw, ch, date)
+    # if don't find spox in title, check first two lines of content for name
+    if found is None and ch:
+        textinitialraw = scraped_entry['text'][0]
+        if len(scraped_entry['text']) > 1:
+            textinitialraw = textinitialraw + scraped_entry['text'][1]
+        found = matcher.match(textinitialraw, ch, date)
 
+    if found is None:
+        return("None", "None")
+    return(found)
 
 
-def get_clean_spox(scraped_entry, ch=True):
-    titleraw = scraped_entry['title'][0]
-    textinitialraw = scraped_entry['text'][0]
-    if len(scraped_entry['text']) > 1:
-        textinitialraw = textinitialraw + scraped_entry['text'][1]
-
-    # lookup dictionary for chinese foreign ministry spox
-    spox_lookup = {
-        ('Zhao Lijian', '赵立坚'): 'ZHAO Lijian (赵立坚)',
-        ('Lu Kang', '陆慷'): 'LU Kang (陆慷)',
-        ('Hua Chunying', '华春莹'): 'HUA Chunying (华春莹)',
-        ('Geng Shuang', '耿爽'): 'GENG Shuang (耿爽)',
-        ('Wang Wenbin', '汪文斌'): 'WANG Wenbin (汪文斌)'
-    }
-
-    index = 1 if ch else 0
-    # spox = re.findall("(?<=^Foreign Ministry Spokesperson )(.+?)(?=')", titleraw)[0]
-    outspox = "None"
-    outspox_orig = "None"
-    for key, value in spox_lookup.items():
-        spoxfind = key[index]
-        if spoxfind in titleraw:
-            outspox = value
-            outspox_orig = spoxfind
-            break
-    # if don't find spox in title, check first two lines of content for name
-    if outspox == "None" and ch:
-        for key, value in spox_lookup.items():
-            spoxfind = key[index]
-            if spoxfind in textinitialraw:
-                outspox = value
-                outspox_orig = spoxfind
+def clean_entry(entry):
+    clean_lang = entry['lang']
+    clean_scrape_date = datetime.strptime(entry['scrape_date'], "%Y%m%d").strftime("%Y-%m-%d")
+    clean_url = entry['url']
+
+    # flag for whether it's in Chinese
+    is_ch = clean_lang == "Chinese"
+
+    # clean title and date information
+    clean_date = get_clean_date(entry, is_ch)
+    orig_spox, clean_spox = get_clean_spox(entry, is_ch, clean_date)
+    clean_remarkstype = get_clean_type(entry, is_ch)
+
+    # initialize empty lists to store cleaned lines information
+    clean_remarks = []
+    clean_order = []
+    clean_contenttype = []
+    clean_string = ''
+    clean_type = "None"
+    order_start = 1
+    line_types = {}
+
+    # iterate through each line and parse
+    for stripped_text, question_flag, answer_flag, turn_flag in classify_entry(entry, orig_spox, is_ch):
+
+        # only parse the line if it's not empty
+        if stripped_text != "":
+
+            # check if it's a question or answer block
+            q_or_a = turn_flag or question_flag
+
+            if answer_flag:
+                blocktype = "A"
+            elif question_flag:
+                blocktype = "Q"
+            else:
+                blocktype = "None"
+            line_types[blocktype] = line_types.get(blocktype, 0) + 1
+
+            # if just beginning, set cleaned string as start
+            if clean_string == '':
+                clean_string = stripped_text
+                clean_type = blocktype
+
+            # if it's a question or answer, set the start of new clean string
+            # to this beginning question or answer
+            elif q_or_a:
+                # add the current info to list
+                clean_remarks.append(clean_string)
+                clean_order.append(order_start)
+                clean_contenttype.append(clean_type)
+
+                # reset values to signal start of answer or question
+                order_start += 1
+                clean_string = stripped_text
+                clean_type = blocktype
+
+            # if it's not the beginning of a section, add it to the string
+            else:
+                clean_string = clean_string + '<br><br>' + stripped_text
+
+    # add the last paragraph to the lists
+    clean_remarks.append(clean_string)
+    clean_order.append(order_start)
+    clean_contenttype.append(clean_type)
+
+    out = CleanEntry(entry['title'][0], clean_date, clean_spox, clean_remarkstype,
+                     clean_url, clean_lang, clean_scrape_date,
+                     clean_remarks, clean_order, clean_contenttype, line_types=line_types)
+    return(out.intern())
+
+
+def iter_clean_entries(entries, workers=1, chunksize=64):
+    # clean entries in input order; with workers > 1 the entries are handed to
+    # a process pool in bounded batches so a streamed file is never read whole
+    if workers <= 1:
+        for entry in entries:
+            yield(clean_entry(entry))
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    entries = iter(entries)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            batch = list(islice(entries, workers * chunksize * 4))
+            if not batch:
                 break
-    return(outspox_orig, outspox)
+            # map returns results in submission order, same as the serial path
+            for out in executor.map(clean_entry, batch, chunksize=chunksize):
+                yield(out.intern())
+
+
+def iter_clean_rows(out):
+    # one flat row per content block of a cleaned entry, in row_cols order
+    for content, order, contenttype in zip(out.content, out.content_order, out.content_type):
+        yield([out.title, out.date, out.spox, out.type, out.url,
+               out.lang, out.scrape_date, content, order, contenttype])
@@ -0,0 +1,246 @@
+import json
+import os
+import numpy as np
+from collections import Counter
+from datetime import date
+from utils_files import remove_unlisted, write_atomic
+from utils_store import change_seq, changed_keys
+from utils_text import iter_responses, tokenize
+
+
+# word counts by (lang, spox, type) slice, term and day, kept as running totals
+# so the counts for any date range are the difference of two prefix sums. a
+# dense day x term table per slice would be mostly zeros, so only the days a
+# term occurs on are stored: one sorted int64 key per (slice, term, day) cell
+# and, in the same order, the prefix sum of the counts. the cells of one
+# (slice, term) run are contiguous and in day order, so a range is two binary
+# searches per run, done for all runs of a slice at once
+
+day_bits = 20        # date.toordinal() for any date we will see fits here
+term_bits = 32
+day_mask = (1 << day_bits) - 1
+term_mask = (1 << term_bits) - 1
+
+log_keep = 64        # updates whose recounted cells stay readable through changes()
+
+cube_cols = ['lang', 'url', 'content_order', 'content_type', 'content', 'date', 'spox', 'type', 'title']
+
+
+def day_number(value):
+    try:
+        return(date.fromisoformat(value).toordinal())
+    except (TypeError, ValueError):
+        return(None)
+
+
+class WordCube(object):
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        os.makedirs(dirpath, exist_ok=True)
+        self.reload()
+
+    def reload(self):
+        # pick up whatever the manifest says now
+        manifest_path = os.path.join(self.dirpath, "cube.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'rt', encoding='utf-8') as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'version': 0, 'change_seq': None, 'slices': []}
+        self.slices = [tuple(s) for s in self.manifest['slices']]
+        self._term_ids = None
+        if self.manifest['version']:
+            path = os.path.join(self.dirpath, "v%06d" % self.manifest['version'])
+            load = lambda fname: np.load(os.path.join(path, fname), mmap_mode='r')
+            self.keys = load("keys.npy")
+            self.cum = load("cum.npy")
+            self.runs = load("runs.npy")
+            self.terms = load("terms.npy")
+        else:
+            self.keys = np.zeros(0, np.int64)
+            self.cum = np.zeros(1, np.int64)
+            self.runs = np.zeros(0, np.int64)
+            self.terms = np.array([], 'U1')
+
+    def refresh(self):
+        # reload if cube_fm.py has written a new version; returns the version
+        manifest_path = os.path.join(self.dirpath, "cube.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'rt', encoding='utf-8') as f:
+                if json.load(f)['version'] != self.manifest['version']:
+                    self.reload()
+        return(self.manifest['version'])
+
+    @property
+    def term_ids(self):
+        # term -> id, built the first time a term has to be looked up
+        if self._term_ids is None:
+            self._term_ids = {t: i for i, t in enumerate(self.terms.tolist())}
+        return(self._term_ids)
+
+    def save(self, keys, cum, terms, slices, seq, recounted=None, rebuild=False):
+        # a new version directory, then the manifest pointing at it.
+        # recounted is (keys, counts, days) of the days an incremental update
+        # counted again, logged for changes(); None after a full count
+        version = self.manifest['version'] + 1
+        path = os.path.join(self.dirpath, "v%06d" % version)
+        os.makedirs(path, exist_ok=True)
+        runs = keys >> day_bits
+        runs = runs[np.r_[True, runs[1:] != runs[:-1]]] if len(runs) else runs
+        np.save(os.path.join(path, "keys.npy"), keys)
+        np.save(os.path.join(path, "cum.npy"), cum)
+        np.save(os.path.join(path, "runs.npy"), runs)
+        np.save(os.path.join(path, "terms.npy"), np.array(terms, dtype=str) if terms else np.array([], 'U1'))
+
+        # term ids hold from the last rebuild on, and the log covers every
+        # version after log_base
+        ids_version = self.manifest.get('ids_version')
+        if rebuild or ids_version is None:
+            ids_version = version
+        if recounted is None:
+            log_base = version
+        else:
+            log_base = max(self.manifest.get('log_base', version - 1), version - log_keep)
+            log_keys, log_counts, log_days = recounted
+            np.savez(os.path.join(self.dirpath, "log_%06d.npz" % version),
+                     keys=log_keys, counts=log_counts, days=np.array(log_days, np.int64))
+        self.write_manifest({'version': version, 'change_seq': seq, 'ids_version': ids_version,
+                             'log_base': log_base, 'slices': [list(s) for s in slices]})
+        self.reload()
+        remove_unlisted(self.dirpath, "v", ["v%06d" % version])
+        remove_unlisted(self.dirpath, "log_", ["log_%06d.npz" % v for v in range(log_base + 1, version + 1)])
+
+    def changes(self, since):
+        # (keys, counts) of the cells of every day recounted after version
+        # `since`, as of its latest recount, sorted by key; None when the log
+        # does not reach back that far (a full count came in between, or the
+        # entries were dropped)
+        version = self.manifest['version']
+        if since < self.manifest.get('log_base', version):
+            return(None)
+        keys, counts = [np.zeros(0, np.int64)], [np.zeros(0, np.int64)]
+        seen = np.zeros(0, np.int64)
+        for v in range(version, since, -1):
+            with np.load(os.path.join(self.dirpath, "log_%06d.npz" % v)) as f:
+                keep = ~np.isin(f['keys'] & day_mask, seen)
+                keys.append(f['keys'][keep])
+                counts.append(f['counts'][keep])
+                seen = np.union1d(seen, f['days'])
+        keys, counts = np.concatenate(keys), np.concatenate(counts)
+        order = np.argsort(keys, kind='stable')
+        return(keys[order], counts[order])
+
+    def write_manifest(self, manifest):
+        write_atomic(os.path.join(self.dirpath, "cube.json"), json.dumps(manifest, ensure_ascii=False))
+        self.manifest = manifest
+
+    def update(self, store_conn, rebuild=False):
+        # recount every day with rows added, changed or removed after the
+        # last update's change sequence (including the days rows moved away
+        # from) and merge those days into the cube; returns the number of
+        # days counted. a cube without a sequence is counted from scratch
+        since = None if rebuild else self.manifest.get('change_seq')
+        newest = change_seq(store_conn)
+        if since is None:
+            cur = store_conn.execute(
+                "SELECT " + ", ".join(cube_cols) + " FROM clean_fm ORDER BY lang, url, content_order")
+            days = None
+        else:
+            days = [d for (d,) in changed_keys(store_conn, since, "date") if d is not None]
+            if not days:
+                # keep the version, so readers holding this one keep their
+                # caches; only the watermark moves
+                if newest != since:
+                    self.write_manifest(dict(self.manifest, change_seq=newest))
+                return(0)
+            cur = self.day_rows(store_conn, days)
+
+        terms = [] if rebuild else self.terms.tolist()
+        term_ids = {} if rebuild else dict(self.term_ids)
+        slices = [] if rebuild else list(self.slices)
+        slice_ids = {s: i for i, s in enumerate(slices)}
+
+        counts = Counter()
+        counted_days = set()
+        for (lang, url, grouping), meta, text in iter_responses(dict(zip(cube_cols, r)) for r in cur):
+            day = day_number(meta['date'])
+            if day is None:
+                continue
+            counted_days.add(day)
+            key = (lang, meta['spox'], meta['type'])
+            s = slice_ids.get(key)
+            if s is None:
+                s = slice_ids[key] = len(slices)
+                slices.append(key)
+            prefix = (s << (term_bits + day_bits)) | day
+            for term, n in Counter(tokenize(text, lang)).items():
+                t = term_ids.get(term)
+                if t is None:
+                    t = term_ids[term] = len(terms)
+                    terms.append(term)
+                counts[prefix | (t << day_bits)] += n
+
+        new_keys = np.array(sorted(counts), np.int64)
+        new_counts = np.array([counts[k] for k in new_keys.tolist()], np.int64)
+        recounted = None
+        if rebuild or since is None:
+            keys, values = new_keys, new_counts
+        else:
+            # drop the recounted days, then merge: both sides are sorted and
+            # share no keys, so inserting at the search positions keeps order
+            keys = np.asarray(self.keys)
+            values = np.diff(np.asarray(self.cum))
+            touched = [d for d in (day_number(d) for d in days) if d is not None]
+            keep = ~np.isin(keys & day_mask, touched)
+            keys, values = keys[keep], values[keep]
+            at = np.searchsorted(keys, new_keys)
+            keys = np.insert(keys, at, new_keys)
+            values = np.insert(values, at, new_counts)
+            recounted = (new_keys, new_counts, touched)
+
+        cum = np.zeros(len(values) + 1, np.int64)
+        np.cumsum(values, out=cum[1:])
+        self.save(keys, cum, terms, slices, newest, recounted, rebuild)
+        return(len(counted_days) if days is None else len(days))
+
+    def day_rows(self, store_conn, days):
+        # store rows of whole days, article by article
+        for i in range(0, len(days), 500):
+            chunk = days[i:i + 500]
+            yield from store_conn.execute(
+                "SELECT " + ", ".join(cube_cols) + " FROM clean_fm WHERE date IN (%s) "
+                "ORDER BY lang, url, content_order" % ",".join("?" * len(chunk)), chunk)
+
+    def totals(self, lang, start=None, end=None, spox=None, type=None):
+        # count per term id over the slices and date range (None for no limit)
+        lo_day = day_number(start) or 0
+        hi_day = day_number(end) or day_mask
+        totals = np.zeros(len(self.terms), np.int64)
+        if lo_day > hi_day:
+            return(totals)
+        runs = self.runs
+        for i, (s_lang, s_spox, s_type) in enumerate(self.slices):
+            if s_lang != lang or (spox and s_spox not in spox) or (type and s_type not in type):
+                continue
+            # the runs of one slice sit together, and no term repeats in them
+            a, b = np.searchsorted(runs, [i << term_bits, (i + 1) << term_bits])
+            r = np.asarray(runs[a:b])
+            lo = np.searchsorted(self.keys, (r << day_bits) | lo_day)
+            hi = np.searchsorted(self.keys, (r << day_bits) | hi_day, side='right')
+            totals[r & term_mask] += self.cum[hi] - self.cum[lo]
+        return(totals)
+
+    def top_terms(self, lang, start=None, end=None, spox=None, type=None,
+                  remove=(), min_freq=1, limit=300):
+        # the most frequent terms as (term, count), most frequent first
+        totals = self.totals(lang, start, end, spox, type)
+        for term in remove:
+            if term in self.term_ids:
+                totals[self.term_ids[term]] = 0
+        top = np.flatnonzero(totals >= max(min_freq, 1))
+        if len(top) > limit:
+            # keep every term tied with the last one so the order below is stable
+            cutoff = np.partition(totals[top], len(top) - limit)[len(top) - limit]
+            top = top[totals[top] >= cutoff]
+        out = sorted(((self.terms[t], int(totals[t])) for t in top.tolist()), key=lambda x: (-x[1], x[0]))
+        return([(str(t), n) for t, n in out[:limit]])
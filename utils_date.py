@@ -0,0 +1,115 @@
+import csv
+import os
+import re
+from datetime import date, datetime
+from functools import lru_cache
+
+
+# corrections for dates the titles get wrong, one per row:
+#   url           the article at `pattern` is dated `value` (YYYY-MM-DD)
+#   missing_year  English titles with no year: the text matching the regex
+#                 `pattern` is parsed as a date in year `value`
+overrides_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "date_overrides.csv")
+
+months = {}
+for i, name in enumerate(["january", "february", "march", "april", "may", "june", "july",
+                          "august", "september", "october", "november", "december"], 1):
+    months[name] = i
+    months[name[:3]] = i
+months["sept"] = 9
+
+# the formats titles actually use, tried before dateutil
+iso_re = re.compile(r"(\d{4})-(\d{1,2})-(\d{1,2})$")
+month_day_year_re = re.compile(r"([A-Za-z]+)\.? (\d{1,2}),? (\d{4})$")
+day_month_year_re = re.compile(r"(\d{1,2}) ([A-Za-z]+)\.?,? (\d{4})$")
+title_date_re = re.compile(" on (.*)")
+year_re = re.compile(r"(?<!\d)\d{4}(?!\d)")
+
+# what dateutil fills in for the parts a date leaves out; a date without a
+# year would otherwise get the current one
+no_year = datetime(1, 1, 1)
+
+
+def load_overrides(fname=overrides_file):
+    with open(fname, 'rt', encoding='utf-8', newline='') as f:
+        return([row for row in csv.DictReader(f)])
+
+
+def strict_date(text):
+    # YYYY-MM-DD for the known formats, or None
+    text = text.strip()
+    m = iso_re.match(text)
+    if m is not None:
+        year, month, day = m.groups()
+    else:
+        m = month_day_year_re.match(text)
+        if m is not None:
+            month, day, year = m.groups()
+        else:
+            m = day_month_year_re.match(text)
+            if m is None:
+                return(None)
+            day, month, year = m.groups()
+        month = months.get(month.lower())
+        if month is None:
+            return(None)
+    try:
+        return(date(int(year), int(month), int(day)).isoformat())
+    except ValueError:
+        return(None)
+
+
+@lru_cache(maxsize=None)
+def parse_date(text):
+    # fast strict parsers first, dateutil only when none of them match
+    clean_date = strict_date(text)
+    if clean_date is None:
+        from dateutil import parser
+        try:
+            parsed = parser.parse(text, default=no_year)
+            clean_date = None if parsed.year == no_year.year else parsed.strftime("%Y-%m-%d")
+        except (ValueError, OverflowError):
+            clean_date = None
+    return(clean_date)
+
+
+class DateNormalizer(object):
+    def __init__(self, overrides):
+        self.urls = {}
+        self.missing_year = []
+        for row in overrides:
+            if row['kind'] == 'url':
+                self.urls[row['pattern']] = row['value']
+            elif row['kind'] == 'missing_year':
+                self.missing_year.append((re.compile(row['pattern']), row['value']))
+            else:
+                raise ValueError("unknown date override kind: " + row['kind'])
+        self.title_date = lru_cache(maxsize=None)(self._title_date)
+
+    def _title_date(self, title):
+        # English titles end in "... on July 28, 2020"; the ones without a
+        # year get it from the missing_year overrides
+        if year_re.search(title) is None:
+            for pattern, year in self.missing_year:
+                m = pattern.search(title)
+                if m is not None:
+                    return(parse_date(m.group() + ", " + year))
+        found = title_date_re.search(title)
+        if found is not None:
+            return(parse_date(found.group(1)))
+        return(None)
+
+    def normalize(self, url, title, dateraw=None):
+        # dateraw is the date the page gives (Chinese pages), else None
+        override = self.urls.get(url)
+        if override is not None:
+            return(override)
+        if dateraw is not None:
+            return(parse_date(dateraw) or dateraw)
+        return(self.title_date(title))
+
+
+@lru_cache(maxsize=None)
+def get_date_normalizer(fname=overrides_file):
+    # loaded and compiled once per process
+    return(DateNormalizer(load_overrides(fname)))
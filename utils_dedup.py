@@ -0,0 +1,287 @@
+import hashlib
+import re
+import sqlite3
+import zlib
+import numpy as np
+from itertools import groupby
+from utils_index import changed_rows, get_change_seq, set_meta
+from utils_store import change_seq
+
+
+# near-duplicate content blocks: each block is shingled (word 3-grams in
+# English, character 3-grams in Chinese) and summarized by a MinHash
+# signature; signatures are cut into LSH bands, and blocks sharing any band
+# are candidates, kept when their signatures agree on enough positions.
+# signatures and bands are stored, so a new day only looks up its own blocks.
+# only the first block of a cluster to use a band key goes into its bucket;
+# when that block is deleted, the oldest member left takes its place
+
+num_perm = 64
+n_bands = 16
+band_rows = num_perm // n_bands
+threshold = 0.7      # estimated Jaccard similarity that counts as a duplicate
+shingle_size = 3
+batch_blocks = 1000  # blocks signed, then written out, at a time
+batch_shingles = 16384  # shingles hashed at once: a (num_perm, n) uint64 array
+
+prime = (1 << 31) - 1
+# fixed seed so signatures from different runs are comparable
+perm_rng = np.random.RandomState(20200728)
+perm_a = perm_rng.randint(1, prime, num_perm).astype(np.uint64)
+perm_b = perm_rng.randint(0, prime, num_perm).astype(np.uint64)
+
+word_re = re.compile(r"[a-z0-9']+")
+
+
+class WordHashes(dict):
+    # crc32 of each word, computed the first time the word is seen
+    def __missing__(self, word):
+        value = self[word] = zlib.crc32(word.encode('utf-8'))
+        return(value)
+
+
+word_hashes = WordHashes()
+nonword_re = re.compile(r"[\W_]+")
+
+
+def shingle_hashes(text, lang):
+    # hashes of the word (English) or character (Chinese) 3-grams, built from
+    # one hash per unit so no shingle string is ever made
+    text = text.replace("<br>", " ")
+    if lang == "Chinese":
+        # code points of the letters and digits
+        units = np.frombuffer(nonword_re.sub('', text).encode('utf-32-le'), np.uint32).astype(np.uint64)
+    else:
+        words = word_re.findall(text.lower())
+        units = np.fromiter(map(word_hashes.__getitem__, words), np.uint64, len(words))
+    if len(units) < shingle_size:
+        units = np.concatenate([units, np.zeros(shingle_size - len(units), np.uint64)])
+    n = len(units) - shingle_size + 1
+    hashes = units[:n].copy()
+    for i in range(1, shingle_size):
+        hashes = (hashes * np.uint64(1000003) + units[i:i + n]) & np.uint64(0xffffffff)
+    return(hashes)
+
+
+def signatures(hash_lists):
+    # MinHash signatures of several blocks at once, one row per block, in
+    # chunks of about batch_shingles shingles
+    sigs = np.zeros((len(hash_lists), num_perm), np.uint32)
+    start = 0
+    while start < len(hash_lists):
+        end = start + 1
+        n = len(hash_lists[start])
+        while end < len(hash_lists) and n + len(hash_lists[end]) <= batch_shingles:
+            n += len(hash_lists[end])
+            end += 1
+        chunk = hash_lists[start:end]
+        offsets = np.cumsum([0] + [len(h) for h in chunk[:-1]])
+        x = np.concatenate(chunk)
+        values = (perm_a[:, None] * x[None, :] + perm_b[:, None]) % prime
+        sigs[start:end] = np.minimum.reduceat(values, offsets, axis=1).T
+        start = end
+    return(sigs)
+
+
+def band_keys(sigs):
+    # each band's rows hashed into one integer key, with the band number in
+    # the low bits so keys from different bands never meet; one row per block
+    bands = sigs.reshape(len(sigs), n_bands, band_rows).astype(np.uint64)
+    keys = np.zeros((len(sigs), n_bands), np.uint64)
+    for i in range(band_rows):
+        keys = keys * np.uint64(0x9E3779B1) + bands[:, :, i]
+    keys = ((keys & np.uint64(0x07ffffffffffffff)) << np.uint64(4)) | np.arange(n_bands, dtype=np.uint64)
+    return(keys.astype(np.int64))
+
+
+def open_dedup(path):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS blocks ("
+        "id INTEGER PRIMARY KEY, url TEXT, lang TEXT, content_order INTEGER, "
+        "hash TEXT, signature BLOB, cluster INTEGER)")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS blocks_key ON blocks (url, lang, content_order)")
+    conn.execute("CREATE INDEX IF NOT EXISTS blocks_cluster ON blocks (cluster)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS bands ("
+        "key INTEGER, block_id INTEGER, PRIMARY KEY (key, block_id)) WITHOUT ROWID")
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    # what analysts join on: the cluster of every block and how many blocks share it
+    conn.execute(
+        "CREATE VIEW IF NOT EXISTS block_clusters AS "
+        "SELECT url, lang, content_order, cluster, "
+        "count(*) OVER (PARTITION BY cluster) AS cluster_size FROM blocks")
+    conn.commit()
+    return(conn)
+
+
+class Clusters(object):
+    # union-find over cluster labels; the smallest label wins. labels that
+    # stop being a root are kept in `merged` until the stored blocks carrying
+    # them are relabelled
+    def __init__(self):
+        self.parent = {}
+        self.merged = []
+
+    def find(self, label):
+        root = label
+        while self.parent.get(root, root) != root:
+            root = self.parent[root]
+        while label != root:
+            label, self.parent[label] = self.parent.get(label, label), root
+        return(root)
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            self.parent[max(a, b)] = min(a, b)
+            self.merged.append(max(a, b))
+
+
+def drop_block(conn, rid):
+    # returns the block's cluster if it was in any band bucket, else None
+    row = conn.execute("SELECT signature, cluster FROM blocks WHERE id = ?", (rid,)).fetchone()
+    keys = band_keys(np.frombuffer(row[0], np.uint32)[None, :])[0]
+    removed = conn.executemany(
+        "DELETE FROM bands WHERE key = ? AND block_id = ?", ((int(key), rid) for key in keys)).rowcount
+    conn.execute("DELETE FROM blocks WHERE id = ?", (rid,))
+    return(row[1] if removed else None)
+
+
+def elect_representative(conn, cluster):
+    # the other members matched the dropped block instead of going into its
+    # buckets, so without this later duplicates could not find them
+    row = conn.execute(
+        "SELECT id, signature FROM blocks WHERE cluster = ? ORDER BY id LIMIT 1", (cluster,)).fetchone()
+    if row is not None:
+        keys = band_keys(np.frombuffer(row[1], np.uint32)[None, :])[0]
+        conn.executemany("INSERT OR IGNORE INTO bands VALUES (?, ?)", ((int(key), row[0]) for key in keys))
+
+
+def update_dedup(conn, store_conn, rebuild=False):
+    # sign blocks from articles that changed since the last update and
+    # cluster them with their near duplicates; returns the blocks signed.
+    # a block goes into a band bucket only if it matched nothing already in
+    # it, so an answer repeated a thousand times is one bucket entry, not a
+    # thousand candidates for the next repeat
+    if rebuild:
+        conn.execute("DELETE FROM blocks")
+        conn.execute("DELETE FROM bands")
+        conn.execute("DELETE FROM meta WHERE key = 'change_seq'")
+    since = get_change_seq(conn)
+    newest = change_seq(store_conn)
+    # with an empty index there is nothing stored to look candidates up in
+    lookup_stored = conn.execute("SELECT 1 FROM blocks LIMIT 1").fetchone() is not None
+
+    next_id = (conn.execute("SELECT max(id) FROM blocks").fetchone()[0] or 0) + 1
+    signatures_of = {}  # id -> signature, for the batch's blocks and candidates
+    clusters_of = {}    # id -> cluster label
+    buckets = {}        # band key -> ids added to the bucket in this run
+    clusters = Clusters()
+    new_rows = []
+    signed = 0
+
+    def bucket(key):
+        members = buckets.get(key)
+        if lookup_stored:
+            stored = [r[0] for r in conn.execute(
+                "SELECT block_id FROM bands WHERE key = ?", (key,))]
+            if stored:
+                members = (members or []) + stored
+        return(members)
+
+    def load(ids):
+        missing = [i for i in ids if i not in signatures_of]
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            for rid, sig, cluster in conn.execute(
+                    "SELECT id, signature, cluster FROM blocks WHERE id IN (%s)"
+                    % ",".join("?" * len(chunk)), chunk):
+                signatures_of[rid] = np.frombuffer(sig, np.uint32)
+                clusters_of[rid] = cluster
+
+    def sign(pending):
+        # pending is [(url, lang, content_order, hash, content)]
+        nonlocal next_id
+        sigs = signatures([shingle_hashes(p[4], p[1]) for p in pending])
+        all_keys = band_keys(sigs).tolist()
+        for (url, lang, order, digest, _), sig, keys in zip(pending, sigs, all_keys):
+            rid = next_id
+            next_id += 1
+            members = [bucket(key) for key in keys]
+            found = list(set().union(*(m for m in members if m)))
+            matched = set()
+            if found:
+                load(found)
+                matrix = np.stack([signatures_of[i] for i in found])
+                agree = (matrix == sig).mean(axis=1)
+                for i, sim in zip(found, agree):
+                    if sim >= threshold:
+                        matched.add(i)
+                        clusters.union(rid, clusters_of[i])
+
+            signatures_of[rid] = sig
+            clusters_of[rid] = rid
+            for key, m in zip(keys, members):
+                if m is None:
+                    buckets[key] = [rid]
+                elif matched.isdisjoint(m):
+                    buckets.setdefault(key, []).append(rid)
+            new_rows.append((rid, url, lang, order, digest, sig.tobytes()))
+
+    def flush(pending, dropped):
+        # sign the batch, swap in its blocks for the changed and deleted ones,
+        # then relabel stored clusters the batch joined together
+        nonlocal signed
+        if pending:
+            sign(pending)
+        orphaned = set(c for c in (drop_block(conn, rid) for rid in dropped) if c is not None)
+        conn.executemany(
+            "INSERT INTO blocks (id, url, lang, content_order, hash, signature, cluster) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((rid, url, lang, order, digest, sig, clusters.find(rid))
+             for rid, url, lang, order, digest, sig in new_rows))
+        for label in clusters.merged:
+            conn.execute("UPDATE blocks SET cluster = ? WHERE cluster = ?", (clusters.find(label), label))
+        for cluster in set(clusters.find(c) for c in orphaned):
+            elect_representative(conn, cluster)
+        signed += len(new_rows)
+        del new_rows[:]
+        del clusters.merged[:]
+        # read back from the db if a later batch needs them
+        signatures_of.clear()
+        clusters_of.clear()
+
+    pending = []
+    dropped = []
+    for (lang, url), rows in groupby(changed_rows(store_conn, since), key=lambda r: (r['lang'], r['url'])):
+        stored = {order: (rid, digest) for rid, order, digest in conn.execute(
+            "SELECT id, content_order, hash FROM blocks WHERE lang = ? AND url = ?", (lang, url))}
+        for row in rows:
+            content = row['content'] or ''
+            digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+            old = stored.pop(row['content_order'], None)
+            if old is not None:
+                if old[1] == digest:
+                    continue
+                # changed block: drop it and sign it again under a new id
+                dropped.append(old[0])
+            if content.strip() != '':
+                pending.append((url, lang, row['content_order'], digest, content))
+
+        # blocks that disappeared when the article was re-scraped
+        dropped.extend(rid for rid, _ in stored.values())
+        if len(pending) >= batch_blocks:
+            flush(pending, dropped)
+            pending, dropped = [], []
+    flush(pending, dropped)
+
+    # in key order, which is much faster to insert into the band table's b-tree
+    conn.executemany(
+        "INSERT OR IGNORE INTO bands VALUES (?, ?)",
+        ((key, rid) for key in sorted(buckets) for rid in buckets[key]))
+
+    set_meta(conn, 'change_seq', newest)
+    conn.commit()
+    return(signed)
@@ -0,0 +1,51 @@
+import os
+import shutil
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks on Windows: one writer at a time there
+    fcntl = None
+
+
+# helpers for the on-disk stores (search index, word cube, burst state) that
+# readers open while a writer replaces them: files are written whole and
+# renamed into place, and a manifest says which ones are current
+
+
+def write_atomic(fname, text):
+    # written next to fname and renamed over it, so a reader sees the old
+    # file or the new one
+    with open(fname + ".tmp", 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(fname + ".tmp", fname)
+
+
+@contextmanager
+def file_lock(path):
+    # exclusive lock on the file at path, created if missing
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def remove_unlisted(dirpath, prefix, wanted):
+    # remove the files and directories starting with prefix that the
+    # manifest no longer names; a reader that still has them mapped keeps
+    # them alive on POSIX, elsewhere try next time
+    for name in os.listdir(dirpath):
+        if name.startswith(prefix) and name not in wanted:
+            path = os.path.join(dirpath, name)
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError:
+                pass
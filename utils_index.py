@@ -0,0 +1,212 @@
+import hashlib
+import sqlite3
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+from itertools import groupby
+from utils_store import change_seq
+from utils_text import iter_responses, tokenize
+
+
+# inverted index from each term to the sorted ids of the responses that use
+# it; posting lists are stored as varint-encoded gaps between ids, and new
+# responses always get larger ids, so a day's update only appends bytes
+
+def encode_deltas(ids, prev=0):
+    out = bytearray()
+    for i in ids:
+        gap = i - prev
+        prev = i
+        while gap >= 0x80:
+            out.append((gap & 0x7f) | 0x80)
+            gap >>= 7
+        out.append(gap)
+    return(bytes(out))
+
+
+def decode_deltas(blob):
+    ids = array('q')
+    value = shift = prev = 0
+    for byte in blob:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            prev += value
+            ids.append(prev)
+            value = shift = 0
+    return(ids)
+
+
+def open_index(path):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS responses ("
+        "id INTEGER PRIMARY KEY, lang TEXT, url TEXT, grouping INTEGER, "
+        "date TEXT, spox TEXT, type TEXT, title TEXT, hash TEXT, live INTEGER)")
+    conn.execute("CREATE INDEX IF NOT EXISTS responses_url ON responses (lang, url, live)")
+    conn.execute("CREATE INDEX IF NOT EXISTS responses_date ON responses (lang, live, date)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS postings ("
+        "lang TEXT, term TEXT, n INTEGER, last_id INTEGER, ids BLOB, "
+        "PRIMARY KEY (lang, term)) WITHOUT ROWID")
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.commit()
+    return(conn)
+
+
+def get_meta(conn, key):
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return(None if row is None else row[0])
+
+
+def set_meta(conn, key, value):
+    conn.execute(
+        "INSERT INTO meta (key, value) VALUES (?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, value))
+
+
+def get_change_seq(conn):
+    # the store's change sequence as of the last update, or None before the
+    # first one (or for an index built from scrape dates, which starts over)
+    value = get_meta(conn, 'change_seq')
+    return(None if value is None else int(value))
+
+
+def changed_rows(store_conn, since=None):
+    # every row of each article with a row added, changed or removed after
+    # change sequence `since` (all rows when None), sorted the way
+    # iter_responses expects
+    cols = "lang, url, content_order, content_type, content, date, spox, type, title"
+    if since is None:
+        cur = store_conn.execute(
+            "SELECT " + cols + " FROM clean_fm ORDER BY lang, url, content_order")
+    else:
+        cur = store_conn.execute(
+            "SELECT " + cols + " FROM clean_fm WHERE (lang, url) IN ("
+            "SELECT lang, url FROM changes WHERE seq > ?) "
+            "ORDER BY lang, url, content_order", (since,))
+    names = [c.strip() for c in cols.split(",")]
+    for row in cur:
+        yield(dict(zip(names, row)))
+
+
+def update_index(conn, store_conn, rebuild=False):
+    # index responses from articles that changed since the last update;
+    # returns the number of responses (re)indexed
+    if rebuild:
+        conn.execute("DELETE FROM responses")
+        conn.execute("DELETE FROM postings")
+        conn.execute("DELETE FROM meta WHERE key = 'change_seq'")
+    since = get_change_seq(conn)
+    newest = change_seq(store_conn)
+
+    next_id = (conn.execute("SELECT max(id) FROM responses").fetchone()[0] or 0) + 1
+    new_postings = defaultdict(lambda: array('q'))
+    indexed = 0
+    retired = 0
+    relabelled = 0
+
+    responses = iter_responses(changed_rows(store_conn, since))
+    for (lang, url), article in groupby(responses, key=lambda r: r[0][:2]):
+        live = {
+            grouping: (rid, digest, labels) for rid, grouping, digest, *labels in conn.execute(
+                "SELECT id, grouping, hash, date, spox, type, title FROM responses "
+                "WHERE lang = ? AND url = ? AND live = 1", (lang, url))}
+
+        for (_, _, grouping), meta, text in article:
+            digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+            old = live.pop(grouping, None)
+            if old is not None:
+                if old[1] == digest:
+                    # same text: the postings stand, only the date, spox,
+                    # type or title may have moved
+                    labels = [meta['date'], meta['spox'], meta['type'], meta['title']]
+                    if labels != old[2]:
+                        conn.execute(
+                            "UPDATE responses SET date = ?, spox = ?, type = ?, title = ? WHERE id = ?",
+                            labels + [old[0]])
+                        relabelled += 1
+                    continue
+                # changed response: retire the old id, index it again under a new one
+                conn.execute("UPDATE responses SET live = 0 WHERE id = ?", (old[0],))
+                retired += 1
+
+            conn.execute(
+                "INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1)",
+                (next_id, lang, url, grouping, meta['date'], meta['spox'],
+                 meta['type'], meta['title'], digest))
+            for term in set(tokenize(text, lang)):
+                new_postings[(lang, term)].append(next_id)
+            next_id += 1
+            indexed += 1
+
+        # responses that disappeared when the article was re-scraped
+        for rid, _, _ in live.values():
+            conn.execute("UPDATE responses SET live = 0 WHERE id = ?", (rid,))
+            retired += 1
+
+    for (lang, term), ids in new_postings.items():
+        row = conn.execute(
+            "SELECT n, last_id, ids FROM postings WHERE lang = ? AND term = ?",
+            (lang, term)).fetchone()
+        if row is None:
+            conn.execute(
+                "INSERT INTO postings VALUES (?, ?, ?, ?, ?)",
+                (lang, term, len(ids), ids[-1], encode_deltas(ids)))
+        else:
+            conn.execute(
+                "UPDATE postings SET n = ?, last_id = ?, ids = ? WHERE lang = ? AND term = ?",
+                (row[0] + len(ids), ids[-1], row[2] + encode_deltas(ids, row[1]), lang, term))
+
+    set_meta(conn, 'change_seq', newest)
+    # readers holding cached results compare this to know when to drop them
+    if indexed or retired or relabelled or rebuild:
+        set_meta(conn, 'version', str(int(get_meta(conn, 'version') or 0) + 1))
+    conn.commit()
+    return(indexed)
+
+
+def get_postings(conn, lang, term):
+    row = conn.execute(
+        "SELECT ids FROM postings WHERE lang = ? AND term = ?", (lang, term)).fetchone()
+    return(array('q') if row is None else decode_deltas(row[0]))
+
+
+def intersect_sorted(small, large):
+    # binary search each id of the shorter list in the longer one
+    out = array('q')
+    lo = 0
+    n = len(large)
+    for i in small:
+        lo = bisect_left(large, i, lo)
+        if lo == n:
+            break
+        if large[lo] == i:
+            out.append(i)
+    return(out)
+
+
+def search(conn, lang, terms, mode='all'):
+    # ids of live responses using all (or any) of the terms
+    lists = sorted((get_postings(conn, lang, t) for t in terms), key=len)
+    if not lists:
+        return([])
+    if mode == 'all':
+        result = lists[0]
+        for other in lists[1:]:
+            if not result:
+                break
+            result = intersect_sorted(result, other)
+    else:
+        result = sorted(set().union(*lists))
+
+    result = list(result)
+    live = set()
+    for i in range(0, len(result), 500):
+        chunk = result[i:i + 500]
+        live.update(r[0] for r in conn.execute(
+            "SELECT id FROM responses WHERE live = 1 AND id IN (%s)" % ",".join("?" * len(chunk)),
+            chunk))
+    return([i for i in result if i in live])
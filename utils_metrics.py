@@ -0,0 +1,81 @@
+import json
+import os
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from utils_files import write_atomic
+
+
+# per-stage timings and counters for a clean_fm.py run. stages nest (the
+# merge stage pulls rows through clean, which pulls entries through parse),
+# so each stage is charged only for its own time, not its upstream stages'
+class RunMetrics(object):
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.counts = Counter()
+        self.started = time.time()
+        self._children = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        self._children.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.seconds[name] += elapsed - self._children.pop()
+            if self._children:
+                self._children[-1] += elapsed
+
+    def timed(self, name, iterable):
+        # wraps an iterator so the time spent producing each item counts toward `name`
+        it = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def summary(self):
+        return({
+            'start_time': datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            'elapsed_seconds': time.time() - self.started,
+            'stage_seconds': dict(self.seconds),
+            'counts': {"/".join(map(str, k)) if isinstance(k, tuple) else k: n
+                       for k, n in self.counts.items()},
+        })
+
+
+def write_metrics(metrics, dirpath, name="chinafm_clean"):
+    # Prometheus textfile (name.prom) and JSON run summary (name.json);
+    # counters keyed (metric, label, value) become one metric with a label
+    os.makedirs(dirpath, exist_ok=True)
+    summary = metrics.summary()
+    lines = ["# HELP %s_stage_seconds Time spent in each stage of the last run." % name,
+             "# TYPE %s_stage_seconds gauge" % name]
+    lines += ['%s_stage_seconds{stage="%s"} %f' % (name, stage, s)
+              for stage, s in sorted(summary['stage_seconds'].items())]
+
+    grouped = defaultdict(list)
+    for key, n in metrics.counts.items():
+        kind, label = (key[0], '{%s="%s"}' % key[1:]) if isinstance(key, tuple) else (key, '')
+        grouped[kind].append((label, n))
+    for kind, values in sorted(grouped.items()):
+        metric = "%s_%s" % (name, kind)
+        lines += ["# HELP %s Count of %s in the last run." % (metric, kind.replace("_", " ")),
+                  "# TYPE %s gauge" % metric]
+        lines += ["%s%s %d" % (metric, label, n) for label, n in sorted(values)]
+
+    lines += ["# HELP %s_duration_seconds Length of the last run." % name,
+              "# TYPE %s_duration_seconds gauge" % name,
+              "%s_duration_seconds %f" % (name, summary['elapsed_seconds']),
+              "# HELP %s_last_run_timestamp_seconds When the last run finished." % name,
+              "# TYPE %s_last_run_timestamp_seconds gauge" % name,
+              "%s_last_run_timestamp_seconds %d" % (name, time.time())]
+    write_atomic(os.path.join(dirpath, name + ".prom"), "\n".join(lines) + "\n")
+    write_atomic(os.path.join(dirpath, name + ".json"), json.dumps(summary, indent=1))
+    return(summary)
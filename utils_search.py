@@ -0,0 +1,504 @@
+import json
+import os
+import re
+import numpy as np
+from contextlib import contextmanager
+from datetime import date
+from functools import lru_cache
+from itertools import groupby
+from utils_files import file_lock, remove_unlisted, write_atomic
+from utils_text import en_strip_re, en_token_re, load_stopwords
+
+
+# BM25 full-text search over content blocks. the index is a directory of
+# immutable segments, each a handful of .npy arrays opened memory-mapped, and
+# a manifest naming the live segments. a daily update appends a segment and
+# marks superseded blocks deleted; merging folds segments together. readers
+# only ever see whole segments, because the manifest is replaced atomically.
+# writers (updates and merges) take a lock on the directory for the whole
+# read-modify-write of the manifest
+
+k1 = 1.2
+b = 0.75
+max_segments = 8     # ask for a merge once there are more segments than this
+reload_attempts = 5  # manifests a reader follows while merges remove segments under it
+
+cjk_run_re = re.compile("[㐀-䶿一-鿿豈-﫿]+")
+
+
+## ANALYZERS -------------------------------------------------------------------
+def _cons(word, i):
+    if word[i] in "aeiou":
+        return(False)
+    if word[i] == "y":
+        return(i == 0 or not _cons(word, i - 1))
+    return(True)
+
+
+def _measure(stem):
+    # number of vowel-consonant sequences
+    n = 0
+    prev_vowel = False
+    for i in range(len(stem)):
+        vowel = not _cons(stem, i)
+        if prev_vowel and not vowel:
+            n += 1
+        prev_vowel = vowel
+    return(n)
+
+
+def _has_vowel(stem):
+    return(any(not _cons(stem, i) for i in range(len(stem))))
+
+
+def _cvc(word):
+    # consonant-vowel-consonant ending, last consonant not w, x or y
+    return(len(word) >= 3 and _cons(word, len(word) - 3) and not _cons(word, len(word) - 2)
+           and _cons(word, len(word) - 1) and word[-1] not in "wxy")
+
+
+def _double_cons(word):
+    return(len(word) >= 2 and word[-1] == word[-2] and _cons(word, len(word) - 1))
+
+
+step2_suffixes = [
+    ("ational", "ate"), ("tional", "tion"), ("enci", "ence"), ("anci", "ance"), ("izer", "ize"),
+    ("abli", "able"), ("alli", "al"), ("entli", "ent"), ("eli", "e"), ("ousli", "ous"),
+    ("ization", "ize"), ("ation", "ate"), ("ator", "ate"), ("alism", "al"), ("iveness", "ive"),
+    ("fulness", "ful"), ("ousness", "ous"), ("aliti", "al"), ("iviti", "ive"), ("biliti", "ble")]
+step3_suffixes = [
+    ("icate", "ic"), ("ative", ""), ("alize", "al"), ("iciti", "ic"), ("ical", "ic"),
+    ("ful", ""), ("ness", "")]
+step4_suffixes = [
+    "al", "ance", "ence", "er", "ic", "able", "ible", "ant", "ement", "ment", "ent",
+    "ion", "ou", "ism", "ate", "iti", "ous", "ive", "ize"]
+
+
+def _replace(word, suffixes, min_measure):
+    for suffix, repl in suffixes:
+        if word.endswith(suffix):
+            stem = word[:-len(suffix)]
+            return(stem + repl if _measure(stem) > min_measure else word)
+    return(word)
+
+
+@lru_cache(maxsize=None)
+def stem(word):
+    # Porter (1980) stemmer
+    if len(word) <= 2:
+        return(word)
+
+    # step 1a: plurals
+    if word.endswith("sses") or word.endswith("ies"):
+        word = word[:-2]
+    elif word.endswith("s") and not word.endswith("ss"):
+        word = word[:-1]
+
+    # step 1b: -ed and -ing
+    if word.endswith("eed"):
+        if _measure(word[:-3]) > 0:
+            word = word[:-1]
+    else:
+        for suffix in ("ed", "ing"):
+            if word.endswith(suffix) and _has_vowel(word[:-len(suffix)]):
+                word = word[:-len(suffix)]
+                if word.endswith(("at", "bl", "iz")):
+                    word += "e"
+                elif _double_cons(word) and word[-1] not in "lsz":
+                    word = word[:-1]
+                elif _measure(word) == 1 and _cvc(word):
+                    word += "e"
+                break
+
+    # step 1c: y to i
+    if word.endswith("y") and _has_vowel(word[:-1]):
+        word = word[:-1] + "i"
+
+    word = _replace(word, step2_suffixes, 0)
+    word = _replace(word, step3_suffixes, 0)
+
+    # step 4: drop suffixes from longer stems
+    for suffix in step4_suffixes:
+        if word.endswith(suffix):
+            stem_ = word[:-len(suffix)]
+            if _measure(stem_) > 1 and (suffix != "ion" or stem_.endswith(("s", "t"))):
+                word = stem_
+            break
+
+    # step 5: final e and double l
+    if word.endswith("e"):
+        stem_ = word[:-1]
+        m = _measure(stem_)
+        if m > 1 or (m == 1 and not _cvc(stem_)):
+            word = stem_
+    if word.endswith("ll") and _measure(word) > 1:
+        word = word[:-1]
+    return(word)
+
+
+def analyze(text, lang):
+    # English: stemmed words without stop words; Chinese: overlapping
+    # character bigrams of each run of Chinese characters (a lone character
+    # stands for itself), so no segmenter is needed, plus the English terms
+    # of whatever Latin text (WHO, G20, COVID-19) sits between the runs
+    if lang == "English":
+        stopwords = load_stopwords(lang)
+        text = en_strip_re.sub(" ", text).replace("’", "'").lower()
+        return([stem(w) for w in en_token_re.findall(text) if w not in stopwords])
+    terms = []
+    for run in cjk_run_re.findall(text.replace("<br>", "")):
+        if len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    terms.extend(analyze(cjk_run_re.sub(" ", text), "English"))
+    return(terms)
+
+
+## SEGMENTS --------------------------------------------------------------------
+langs = ["English", "Chinese"]
+
+
+def date_number(value):
+    # days since 0001-01-01, or -1 when the date is missing
+    try:
+        return(date.fromisoformat(value).toordinal())
+    except (TypeError, ValueError):
+        return(-1)
+
+
+def save_segment(dirpath, name, arrays, meta):
+    # written under a temporary name and renamed once complete
+    tmp = os.path.join(dirpath, name + ".tmp")
+    os.makedirs(tmp)
+    for fname, values in arrays.items():
+        np.save(os.path.join(tmp, fname + ".npy"), values)
+    with open(os.path.join(tmp, "meta.json"), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.rename(tmp, os.path.join(dirpath, name))
+
+
+def str_array(values):
+    return(np.array(values, dtype=str) if len(values) else np.array([], 'U1'))
+
+
+def write_segment(dirpath, name, docs):
+    # docs are dicts with url, lang, content_order, date, spox, type, content
+    levels = {'spox': {}, 'type': {}}
+    postings = {}
+    arrays = {col: np.zeros(len(docs), dtype) for col, dtype in
+              [('doc_len', np.int32), ('doc_date', np.int32), ('doc_lang', np.int8),
+               ('doc_spox', np.int16), ('doc_type', np.int16),
+               ('doc_url', np.int32), ('doc_order', np.int32)]}
+    urls = {}
+    for i, doc in enumerate(docs):
+        terms = analyze(doc['content'] or '', doc['lang'])
+        arrays['doc_len'][i] = len(terms)
+        counts = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        for term, tf in counts.items():
+            postings.setdefault(term, []).append((i, tf))
+        arrays['doc_date'][i] = date_number(doc['date'])
+        arrays['doc_lang'][i] = langs.index(doc['lang'])
+        for col in ['spox', 'type']:
+            arrays['doc_' + col][i] = levels[col].setdefault(doc[col], len(levels[col]))
+        arrays['doc_url'][i] = urls.setdefault(doc['url'], len(urls))
+        arrays['doc_order'][i] = doc['content_order']
+
+    terms = sorted(postings)
+    arrays['offsets'] = np.zeros(len(terms) + 1, np.int64)
+    np.cumsum([len(postings[t]) for t in terms], out=arrays['offsets'][1:])
+    flat = [p for t in terms for p in postings[t]]
+    arrays['terms'] = str_array(terms)
+    arrays['urls'] = str_array(list(urls))
+    arrays['post_docs'] = np.array([p[0] for p in flat], np.int32)
+    arrays['post_tf'] = np.array([p[1] for p in flat], np.int32)
+    meta = {'n_docs': len(docs), 'total_len': int(arrays['doc_len'].sum()),
+            'spox': list(levels['spox']), 'type': list(levels['type'])}
+    save_segment(dirpath, name, arrays, meta)
+
+
+def merge_segments(dirpath, name, segments):
+    # one segment with the live blocks of several, built from their postings
+    all_terms = np.unique(np.concatenate([np.asarray(seg.terms) for seg in segments]))
+    levels = {col: list(dict.fromkeys(v for seg in segments for v in seg.meta[col]))
+              for col in ['spox', 'type']}
+    arrays = {col: [] for col in ['doc_len', 'doc_date', 'doc_lang', 'doc_spox', 'doc_type',
+                                  'doc_url', 'doc_order']}
+    term_ids, post_docs, post_tf = [], [], []
+    urls = {}
+    base = 0
+    for seg in segments:
+        live = np.flatnonzero(seg.live)
+        new_id = np.full(seg.meta['n_docs'], -1, np.int64)
+        new_id[live] = base + np.arange(len(live))
+        base += len(live)
+
+        arrays['doc_len'].append(np.asarray(seg.doc_len)[live])
+        arrays['doc_date'].append(np.asarray(seg.columns['date'])[live])
+        arrays['doc_lang'].append(np.asarray(seg.columns['lang'])[live])
+        arrays['doc_order'].append(np.asarray(seg.doc_order)[live])
+        for col in ['spox', 'type']:
+            recode = np.array([levels[col].index(v) for v in seg.meta[col]] or [0], np.int16)
+            arrays['doc_' + col].append(recode[np.asarray(seg.columns[col])[live]])
+        recode = np.array([urls.setdefault(url, len(urls)) for url in seg.urls.tolist()] or [0], np.int32)
+        arrays['doc_url'].append(recode[np.asarray(seg.doc_url)[live]])
+
+        # every posting of the segment, as (merged term id, merged doc id, tf)
+        seg_terms = np.searchsorted(all_terms, np.asarray(seg.terms))
+        counts = np.diff(np.asarray(seg.offsets))
+        docs = new_id[np.asarray(seg.post_docs)]
+        keep = docs >= 0
+        term_ids.append(np.repeat(seg_terms, counts)[keep])
+        post_docs.append(docs[keep])
+        post_tf.append(np.asarray(seg.post_tf)[keep])
+
+    term_ids = np.concatenate(term_ids)
+    post_docs = np.concatenate(post_docs)
+    order = np.lexsort((post_docs, term_ids))
+    term_ids = term_ids[order]
+    used = np.unique(term_ids)
+    merged = {col: np.concatenate(values) for col, values in arrays.items()}
+    merged['terms'] = all_terms[used] if len(used) else np.array([], 'U1')
+    merged['urls'] = str_array(list(urls))
+    merged['offsets'] = np.zeros(len(used) + 1, np.int64)
+    np.cumsum(np.bincount(np.searchsorted(used, term_ids), minlength=len(used)), out=merged['offsets'][1:])
+    merged['post_docs'] = post_docs[order].astype(np.int32)
+    merged['post_tf'] = np.concatenate(post_tf)[order].astype(np.int32)
+    meta = {'n_docs': base, 'total_len': int(merged['doc_len'].sum()),
+            'spox': levels['spox'], 'type': levels['type']}
+    save_segment(dirpath, name, merged, meta)
+
+
+class Segment(object):
+    def __init__(self, dirpath, name, deleted=None):
+        path = os.path.join(dirpath, name)
+        self.name = name
+        with open(os.path.join(path, "meta.json"), 'rt', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        load = lambda fname: np.load(os.path.join(path, fname), mmap_mode='r')
+        self.terms = load("terms.npy")
+        self.offsets = load("offsets.npy")
+        self.post_docs = load("post_docs.npy")
+        self.post_tf = load("post_tf.npy")
+        self.doc_len = load("doc_len.npy")
+        self.doc_url = load("doc_url.npy")
+        self.doc_order = load("doc_order.npy")
+        self.urls = load("urls.npy")
+        self.columns = {col: load("doc_" + col + ".npy") for col in ['date', 'lang', 'spox', 'type']}
+        self.live = np.ones(self.meta['n_docs'], bool)
+        if deleted:
+            self.live[np.load(os.path.join(dirpath, deleted))] = False
+        self.deleted_file = deleted
+        self.path = path
+
+    def key(self, doc):
+        # (url, lang, content_order) of one doc
+        return((str(self.urls[self.doc_url[doc]]), langs[self.columns['lang'][doc]],
+                int(self.doc_order[doc])))
+
+    def live_urls(self):
+        # (lang, url, doc) of every live doc
+        urls = self.urls.tolist()
+        doc_url = np.asarray(self.doc_url)
+        lang = np.asarray(self.columns['lang'])
+        return([(langs[lang[doc]], urls[doc_url[doc]], int(doc)) for doc in np.flatnonzero(self.live)])
+
+    def postings(self, term):
+        i = np.searchsorted(self.terms, term)
+        if i == len(self.terms) or self.terms[i] != term:
+            return(None, None)
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        return(self.post_docs[lo:hi], self.post_tf[lo:hi])
+
+    def mask(self, lang=None, start=None, end=None, spox=None, type=None):
+        mask = self.live.copy()
+        if lang is not None:
+            mask &= self.columns['lang'] == langs.index(lang)
+        if start is not None:
+            mask &= self.columns['date'] >= date_number(start)
+        if end is not None:
+            mask &= self.columns['date'] <= date_number(end)
+        for col, wanted in [('spox', spox), ('type', type)]:
+            if wanted is not None:
+                codes = [i for i, v in enumerate(self.meta[col]) if v in wanted]
+                mask &= np.isin(self.columns[col], codes)
+        return(mask)
+
+
+## INDEX -----------------------------------------------------------------------
+class SearchIndex(object):
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        os.makedirs(dirpath, exist_ok=True)
+        self.reload()
+
+    def reload(self):
+        # pick up whatever the manifest says now (after an update or merge)
+        self.manifest = self.read_manifest()
+        for attempt in range(reload_attempts):
+            try:
+                self.segments = [Segment(self.dirpath, s['name'], s.get('deleted'))
+                                 for s in self.manifest['segments']]
+                return
+            except FileNotFoundError:
+                # a merge may have replaced the manifest and removed the
+                # segments it named between the two reads: read the new one.
+                # a file missing from the current manifest is a broken index
+                manifest = self.read_manifest()
+                if manifest == self.manifest or attempt == reload_attempts - 1:
+                    raise
+                self.manifest = manifest
+
+    def read_manifest(self):
+        manifest_path = os.path.join(self.dirpath, "manifest.json")
+        if not os.path.exists(manifest_path):
+            return({'segments': [], 'next': 1, 'change_seq': None})
+        with open(manifest_path, 'rt', encoding='utf-8') as f:
+            return(json.load(f))
+
+    @contextmanager
+    def locked(self):
+        # hold the writer lock and work on the current manifest
+        with file_lock(os.path.join(self.dirpath, "lock")):
+            self.reload()
+            yield
+
+    def write_manifest(self):
+        self.manifest['segments'] = [{'name': s.name, 'deleted': s.deleted_file} for s in self.segments]
+        write_atomic(os.path.join(self.dirpath, "manifest.json"), json.dumps(self.manifest))
+
+    def new_name(self, prefix="seg"):
+        name = "%s_%06d" % (prefix, self.manifest['next'])
+        self.manifest['next'] += 1
+        return(name)
+
+    def save_deleted(self, segment):
+        # liveness is the only thing about a segment that changes, and it
+        # goes to a new file each time so open readers keep their snapshot
+        name = self.new_name(segment.name + ".del")
+        np.save(os.path.join(self.dirpath, name + ".npy"), np.flatnonzero(~segment.live).astype(np.int32))
+        segment.deleted_file = name + ".npy"
+
+    def cleanup(self):
+        # segment files no longer in the manifest
+        wanted = set(s.name for s in self.segments) | set(s.deleted_file for s in self.segments)
+        remove_unlisted(self.dirpath, "seg_", wanted)
+
+    def update(self, store_conn, rebuild=False):
+        # append a segment with the blocks of articles changed after the
+        # last update's change sequence, deleting their older versions;
+        # returns the blocks added. merging is left to merge(), see needs_merge
+        from utils_index import changed_rows
+        from utils_store import change_seq
+        with self.locked():
+            # an index without a sequence (new, or from before the change
+            # log) is built from scratch
+            since = None if rebuild else self.manifest.get('change_seq')
+            if since is None:
+                self.segments = []
+            newest = change_seq(store_conn)
+
+            located = {}
+            if since is not None:
+                for seg in self.segments:
+                    for lang, url, doc in seg.live_urls():
+                        located.setdefault((lang, url), []).append((seg, doc))
+
+            docs = []
+            touched = set()
+            for (lang, url), rows in groupby(changed_rows(store_conn, since), key=lambda r: (r['lang'], r['url'])):
+                for seg, doc in located.get((lang, url), []):
+                    seg.live[doc] = False
+                    touched.add(seg)
+                docs.extend(row for row in rows if (row['content'] or '').strip() != '')
+
+            for seg in touched:
+                self.save_deleted(seg)
+            if docs:
+                name = self.new_name()
+                write_segment(self.dirpath, name, docs)
+                self.segments.append(Segment(self.dirpath, name))
+            self.manifest['change_seq'] = newest
+            self.manifest.pop('last_scrape_date', None)
+            self.write_manifest()
+            self.cleanup()
+        return(len(docs))
+
+    def needs_merge(self):
+        return(len(self.segments) > max_segments)
+
+    def merge(self):
+        # fold every segment into one, dropping deleted blocks. works on the
+        # postings alone and only reads the segments, so queries go on while
+        # it runs; updates wait for it
+        with self.locked():
+            if len(self.segments) < 2 and all(seg.live.all() for seg in self.segments):
+                return
+            name = self.new_name()
+            merge_segments(self.dirpath, name, self.segments)
+            self.segments = [Segment(self.dirpath, name)]
+            self.write_manifest()
+            self.cleanup()
+
+    def stats(self):
+        # number of live blocks and their average length, over all segments
+        n = sum(int(seg.live.sum()) for seg in self.segments)
+        total = sum(int(seg.doc_len[seg.live].sum()) for seg in self.segments)
+        return(max(n, 1), total / max(n, 1))
+
+    def search(self, query, lang=None, start=None, end=None, spox=None, type=None, limit=10):
+        # top blocks by BM25, as dicts with the score and block key
+        search_langs = [lang] if lang is not None else langs
+        terms = set()
+        for l in search_langs:
+            terms.update(analyze(query, l))
+        if not terms:
+            return([])
+        n_docs, avgdl = self.stats()
+
+        # document frequency of live blocks, summed over the segments, so
+        # scores do not depend on how the blocks are split into segments
+        found = {}
+        df = dict.fromkeys(terms, 0)
+        for seg in self.segments:
+            for term in terms:
+                docs, tf = seg.postings(term)
+                if docs is not None:
+                    found[(seg, term)] = (docs, tf)
+                    df[term] += int(seg.live[docs].sum())
+
+        hits = []
+        for seg in self.segments:
+            scores = None
+            for term in terms:
+                if (seg, term) not in found:
+                    continue
+                docs, tf = found[(seg, term)]
+                idf = np.log(1 + (n_docs - df[term] + 0.5) / (df[term] + 0.5))
+                tf = tf.astype(np.float64)
+                norm = k1 * (1 - b + b * seg.doc_len[docs] / avgdl)
+                contrib = idf * tf * (k1 + 1) / (tf + norm)
+                part = np.bincount(docs, weights=contrib, minlength=seg.meta['n_docs'])
+                scores = part if scores is None else scores + part
+            if scores is None:
+                continue
+            scores[~seg.mask(lang, start, end, spox, type)] = 0
+            top = np.flatnonzero(scores)
+            if len(top) > limit:
+                top = top[np.argpartition(-scores[top], limit - 1)[:limit]]
+            hits.extend((float(scores[d]), seg, int(d)) for d in top)
+
+        hits.sort(key=lambda h: -h[0])
+        out = []
+        for score, seg, doc in hits[:limit]:
+            url, doc_lang, order = seg.key(doc)
+            day = int(seg.columns['date'][doc])
+            out.append({
+                'score': score, 'url': url, 'lang': doc_lang, 'content_order': order,
+                'date': date.fromordinal(day).isoformat() if day > 0 else None,
+                'spox': seg.meta['spox'][seg.columns['spox'][doc]],
+                'type': seg.meta['type'][seg.columns['type'][doc]],
+            })
+        return(out)
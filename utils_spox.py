@@ -0,0 +1,52 @@
+import csv
+import os
+import re
+from functools import lru_cache
+
+
+# spokesperson names in both languages with tenure dates; add a row here to
+# add a spokesperson
+roster_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "spox_roster.csv")
+
+
+def load_roster(fname=roster_file):
+    with open(fname, 'rt', encoding='utf-8', newline='') as f:
+        return([row for row in csv.DictReader(f)])
+
+
+class SpoxMatcher(object):
+    # every name of one language compiled into a single alternation, so all
+    # candidate names in a text come out of one scan however long the roster
+    def __init__(self, roster):
+        self.names = {True: {}, False: {}}
+        for row in roster:
+            self.names[True][row['name_ch']] = row
+            self.names[False][row['name_en']] = row
+        self.patterns = {}
+        for ch, names in self.names.items():
+            # longest first so a name is never shadowed by a shorter prefix
+            ordered = sorted(names, key=len, reverse=True)
+            self.patterns[ch] = re.compile("|".join(re.escape(n) for n in ordered))
+
+    def candidates(self, text, ch=True):
+        names = self.names[ch]
+        return([(m.group(), names[m.group()]) for m in self.patterns[ch].finditer(text)])
+
+    def match(self, text, ch=True, date=None):
+        # returns (name as written, label) or None; when several names turn up,
+        # prefer the first one whose tenure covers the date
+        found = self.candidates(text, ch)
+        if not found:
+            return(None)
+        if date is not None:
+            for name, row in found:
+                if row['start'] <= date and (row['end'] == '' or date <= row['end']):
+                    return(name, row['label'])
+        name, row = found[0]
+        return(name, row['label'])
+
+
+@lru_cache(maxsize=None)
+def get_spox_matcher(fname=roster_file):
+    # loaded and compiled once per process
+    return(SpoxMatcher(load_roster(fname)))
@@ -0,0 +1,235 @@
+import csv
+import os
+import sqlite3
+from datetime import date
+from utils_clean import row_cols
+
+
+# cleaned rows live in one SQLite table keyed on (url, lang, content_order),
+# with an index on date so a day's partition can be read or replaced without
+# touching the rest of the archive.
+#
+# every insert, change or delete of a row is logged in `changes` by trigger:
+# the article and the (date, spox) it was in before and after, stamped with
+# the store's change sequence, which upsert_rows moves on once per call.
+# later stages keep the last sequence they processed and read only the
+# articles, partitions or days logged after it
+store_cols = ['title', 'date', 'spox', 'type', 'url', 'lang', 'content',
+              'content_order', 'content_type']
+
+def log_change_sql(row):
+    # row is NEW or OLD; one entry per (article, date, spox), with the latest seq
+    match = ("url = {row}.url AND lang = {row}.lang AND date IS {row}.date "
+             "AND spox IS {row}.spox").format(row=row)
+    seq = "(SELECT value FROM store_meta WHERE key = 'change_seq')"
+    return(
+        "UPDATE changes SET seq = " + seq + " WHERE " + match + " AND seq < " + seq + "; "
+        "INSERT INTO changes (seq, url, lang, date, spox) "
+        "SELECT " + seq + ", {row}.url, {row}.lang, {row}.date, {row}.spox "
+        "WHERE NOT EXISTS (SELECT 1 FROM changes WHERE ".format(row=row) + match + ");")
+
+
+upsert_sql = (
+    "INSERT INTO clean_fm (" + ", ".join(row_cols) + ") "
+    "VALUES (" + ", ".join("?" * len(row_cols)) + ") "
+    "ON CONFLICT(url, lang, content_order) DO UPDATE SET "
+    "title = excluded.title, date = excluded.date, spox = excluded.spox, "
+    "type = excluded.type, content = excluded.content, "
+    "content_type = excluded.content_type, scrape_date = excluded.scrape_date "
+    # leave unchanged rows alone so re-running a day writes nothing
+    "WHERE (title, date, spox, type, content, content_type) IS NOT "
+    "(excluded.title, excluded.date, excluded.spox, excluded.type, "
+    "excluded.content, excluded.content_type)")
+
+
+def open_store(path):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS clean_fm ("
+        "url TEXT NOT NULL, lang TEXT NOT NULL, content_order INTEGER NOT NULL, "
+        "title TEXT, date TEXT, spox TEXT, type TEXT, content TEXT, "
+        "content_type TEXT, scrape_date TEXT, "
+        "PRIMARY KEY (url, lang, content_order)) WITHOUT ROWID")
+    conn.execute("CREATE INDEX IF NOT EXISTS clean_fm_date ON clean_fm (date, lang)")
+    # lets later stages pick up only the rows merged since their last run
+    conn.execute("CREATE INDEX IF NOT EXISTS clean_fm_scrape_date ON clean_fm (scrape_date)")
+    # how far `clean_fm.py --watch` has read each raw file (offset into the
+    # decompressed data), and the file's size and mtime when it did
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS raw_files ("
+        "name TEXT PRIMARY KEY, offset INTEGER, size INTEGER, mtime REAL, cleaned_at TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS store_meta (key TEXT PRIMARY KEY, value INTEGER)")
+    conn.execute("INSERT OR IGNORE INTO store_meta VALUES ('change_seq', 0)")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS changes ("
+        "seq INTEGER, url TEXT, lang TEXT, date TEXT, spox TEXT)")
+    conn.execute("CREATE INDEX IF NOT EXISTS changes_article ON changes (url, lang, date, spox)")
+    conn.execute("CREATE INDEX IF NOT EXISTS changes_seq ON changes (seq)")
+    conn.execute(
+        "CREATE TRIGGER IF NOT EXISTS clean_fm_insert AFTER INSERT ON clean_fm BEGIN "
+        + log_change_sql("NEW") + " END")
+    conn.execute(
+        "CREATE TRIGGER IF NOT EXISTS clean_fm_update AFTER UPDATE ON clean_fm BEGIN "
+        + log_change_sql("OLD") + " " + log_change_sql("NEW") + " END")
+    conn.execute(
+        "CREATE TRIGGER IF NOT EXISTS clean_fm_delete AFTER DELETE ON clean_fm BEGIN "
+        + log_change_sql("OLD") + " END")
+    conn.commit()
+    return(conn)
+
+
+def bump_change_seq(conn):
+    # call inside the transaction of any write to clean_fm made outside
+    # upsert_rows, so the stages that already read the current sequence see it
+    conn.execute("UPDATE store_meta SET value = value + 1 WHERE key = 'change_seq'")
+
+
+def change_seq(conn):
+    # the sequence of the last committed write
+    return(conn.execute("SELECT value FROM store_meta WHERE key = 'change_seq'").fetchone()[0])
+
+
+def changed_keys(conn, since, cols="lang, url"):
+    # distinct values of cols (from url, lang, date, spox) logged after
+    # sequence `since`; dates and spox include the ones rows moved away from
+    return(conn.execute(
+        "SELECT DISTINCT " + cols + " FROM changes WHERE seq > ?", (since,)).fetchall())
+
+
+def upsert_rows(conn, rows):
+    # rows are lists in row_cols order; returns the number of rows inserted,
+    # changed or removed
+    last_order = {}
+
+    def track(rows):
+        for row in rows:
+            row = list(row)
+            row[8] = int(row[8])
+            key = (row[4], row[5])
+            last_order[key] = max(last_order.get(key, 0), row[8])
+            yield(row)
+
+    # rowcount rather than total_changes, which also counts the change log
+    with conn:
+        bump_change_seq(conn)
+        changed = conn.executemany(upsert_sql, track(rows)).rowcount
+        # a re-scraped article with fewer blocks drops its old trailing blocks
+        changed += conn.executemany(
+            "DELETE FROM clean_fm WHERE url = ? AND lang = ? AND content_order > ?",
+            ((url, lang, order) for (url, lang), order in last_order.items())).rowcount
+    return(changed)
+
+
+def get_raw_checkpoint(conn, name):
+    # (offset, size, mtime) of a raw file, or None if it has not been read
+    return(conn.execute(
+        "SELECT offset, size, mtime FROM raw_files WHERE name = ?", (name,)).fetchone())
+
+
+def set_raw_checkpoint(conn, name, offset, size, mtime):
+    with conn:
+        conn.execute(
+            "INSERT INTO raw_files (name, offset, size, mtime, cleaned_at) "
+            "VALUES (?, ?, ?, ?, datetime('now')) ON CONFLICT(name) DO UPDATE SET "
+            "offset = excluded.offset, size = excluded.size, mtime = excluded.mtime, "
+            "cleaned_at = excluded.cleaned_at", (name, offset, size, mtime))
+
+
+def import_csv(conn, fname):
+    # seed the store from a clean_fm_en.csv/clean_fm_ch.csv written by older
+    # versions of clean_fm.py (first column is the pandas index)
+    def rows():
+        with open(fname, 'rt', encoding='utf-8', newline='') as f:
+            for line in csv.DictReader(f):
+                yield([line['title'], line['date'] or None, line['spox'], line['type'],
+                       line['url'], line['lang'], line.get('scrape_date') or None,
+                       line['content'], line['content_order'], line['content_type']])
+    return(upsert_rows(conn, rows()))
+
+
+def export_csv(conn, lang, fname):
+    # write one language back out in the old clean_fm_*.csv layout
+    rows = conn.execute(
+        "SELECT " + ", ".join(store_cols) + " FROM clean_fm WHERE lang = ? "
+        "ORDER BY date, url, content_order", (lang,))
+    with open(fname, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([''] + store_cols)
+        for i, row in enumerate(rows):
+            writer.writerow([i] + list(row))
+
+
+def parse_iso_date(value):
+    try:
+        return(date.fromisoformat(value))
+    except (TypeError, ValueError):
+        return(None)
+
+
+def export_parquet(conn, lang, fname, row_group_rows=10000):
+    # write one language as Parquet: the strings repeated on every content
+    # row are dictionary encoded and everything is zstd compressed. rows are
+    # sorted by date and a row group never splits a date, so each group's
+    # date (and spox) statistics let readers skip whole groups
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    cols = row_cols
+    date_cols = ['date', 'scrape_date']
+    schema = pa.schema([
+        (col, pa.date32() if col in date_cols
+         else pa.int32() if col == 'content_order'
+         else pa.string() if col == 'content'
+         else pa.dictionary(pa.int32(), pa.string()))
+        for col in cols])
+
+    def table(rows):
+        columns = list(zip(*rows))
+        arrays = []
+        for col, values in zip(cols, columns):
+            if col in date_cols:
+                arrays.append(pa.array([parse_iso_date(v) for v in values], pa.date32()))
+            elif col == 'content_order':
+                arrays.append(pa.array(values, pa.int32()))
+            elif col == 'content':
+                arrays.append(pa.array(values, pa.string()))
+            else:
+                arrays.append(pa.array(values, pa.string()).dictionary_encode())
+        return(pa.Table.from_arrays(arrays, schema=schema))
+
+    rows = conn.execute(
+        "SELECT " + ", ".join(cols) + " FROM clean_fm WHERE lang = ? "
+        "ORDER BY date, url, content_order", (lang,))
+    tmp = fname + ".tmp"
+    n = 0
+    with pq.ParquetWriter(tmp, schema, compression='zstd') as writer:
+        group = []
+        for row in rows:
+            # cut only between dates
+            if len(group) >= row_group_rows and row[1] != group[-1][1]:
+                writer.write_table(table(group))
+                group = []
+            group.append(row)
+            n += 1
+        if group:
+            writer.write_table(table(group))
+    os.replace(tmp, fname)
+    return(n)
+
+
+def read_parquet(fname, columns=None, start=None, end=None, spox=None):
+    # load an exported file into a data frame (dictionary columns come back
+    # as categoricals); the date range and spox are pushed down to the row
+    # groups, and only the requested columns are read
+    import pyarrow.parquet as pq
+
+    filters = []
+    if start is not None:
+        filters.append(('date', '>=', date.fromisoformat(start)))
+    if end is not None:
+        filters.append(('date', '<=', date.fromisoformat(end)))
+    if spox is not None:
+        filters.append(('spox', 'in', list(spox)))
+    return(pq.read_table(fname, columns=columns, filters=filters or None).to_pandas())
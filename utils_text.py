@@ -0,0 +1,68 @@
+import os
+import re
+from functools import lru_cache
+
+
+# stop word lists, one word per line; questions/answers are grouped and
+# tokenized the same way clean_spox.R prepares text_en_df/text_ch_df
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+en_token_re = re.compile("[a-z0-9]+(?:'[a-z0-9]+)*")
+en_strip_re = re.compile("A:|Q:|<br>")
+digit_re = re.compile("[0-9]")
+word_re = re.compile("\\w")
+
+
+@lru_cache(maxsize=None)
+def load_stopwords(lang):
+    fname = "stopwords_en.txt" if lang == "English" else "stopwords_ch.txt"
+    with open(os.path.join(data_dir, fname), 'rt', encoding='utf-8') as f:
+        return(frozenset(line.strip() for line in f if line.strip() != ''))
+
+
+@lru_cache(maxsize=None)
+def get_segmenter():
+    # jieba is only needed for Chinese text, so import it on first use
+    import jieba
+    jieba.setLogLevel(60)
+    return(jieba)
+
+
+def tokenize(text, lang):
+    # words with punctuation, stop words and anything containing a number
+    # removed
+    stopwords = load_stopwords(lang)
+    if lang == "English":
+        text = en_strip_re.sub(" ", text).replace("’", "'").lower()
+        words = en_token_re.findall(text)
+    else:
+        words = get_segmenter().lcut(text.replace("<br>", ""))
+    return([w for w in words
+            if word_re.search(w) and w not in stopwords and not digit_re.search(w)])
+
+
+def response_grouping(content_order, content_type):
+    # a question and the answer after it share one response
+    if content_type == "A":
+        return(content_order - 1)
+    return(content_order)
+
+
+def iter_responses(rows):
+    # rows are dicts with the store columns, sorted by lang, url and
+    # content_order; yields (key, meta, text) per question/answer response
+    key = None
+    meta = None
+    parts = []
+    for row in rows:
+        grouping = response_grouping(row['content_order'], row['content_type'])
+        row_key = (row['lang'], row['url'], grouping)
+        if row_key != key:
+            if key is not None:
+                yield(key, meta, " ".join(parts))
+            key = row_key
+            meta = {col: row[col] for col in ['date', 'spox', 'type', 'title']}
+            parts = []
+        parts.append(row['content'] or '')
+    if key is not None:
+        yield(key, meta, " ".join(parts))